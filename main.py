@@ -34,10 +34,16 @@ try:
 except Exception:
     pass
 
+import atexit
 import logging
 import hashlib
 import random
 import math
+import signal
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 
 # ========= LOGGING / VERSION =========
@@ -60,7 +66,88 @@ LOG_PATH = os.path.join(LOG_DIR, "bot.log")
 
 STATE_PATH = os.path.join(LOG_DIR, "bot_state.json")
 
-def _load_state():
+# ========= LOCAL DB (SQLite, WAL) =========
+# קובץ SQLite אחד משותף (תור + מטמונים). WAL מאפשר קריאות במקביל לכתיבה בלי לנעול את כל הבוט.
+BOT_DB_PATH = os.path.join(LOG_DIR, "bot.db")
+_DB_LOCK = threading.RLock()
+_DB_CONN = None
+
+def _db():
+    """Shared autocommit connection (all access is serialized by _DB_LOCK)."""
+    global _DB_CONN
+    if _DB_CONN is None:
+        with _DB_LOCK:
+            if _DB_CONN is None:
+                conn = sqlite3.connect(BOT_DB_PATH, timeout=30, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                except Exception:
+                    pass
+                _DB_CONN = conn
+    return _DB_CONN
+
+@contextmanager
+def _db_tx(conn=None):
+    """BEGIN IMMEDIATE ... COMMIT on the shared connection (ROLLBACK on error)."""
+    with _DB_LOCK:
+        conn = conn or _db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# ========= RATE LIMIT (token bucket) =========
+class _TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`. rate<=0 means unlimited."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(0.0, float(rate or 0.0))
+        self.capacity = max(1.0, float(capacity if capacity is not None else self.rate))
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.0, timeout: float | None = None, reserve: float = 0.0) -> bool:
+        """Block until `n` tokens are available. Returns False if `timeout` would be exceeded.
+        `reserve` tokens are left in the bucket for higher-priority callers.
+        """
+        if self.rate <= 0:
+            return True
+        n = min(float(n), self.capacity)
+        reserve = max(0.0, min(float(reserve), self.capacity - n))
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens - reserve >= n:
+                    self._tokens -= n
+                    return True
+                wait = (n + reserve - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+# ========= BOT STATE =========
+# מצב הבוט נשמר בזיכרון; setters רק מסמנים "מלוכלך" ו-thread רקע כותב לדיסק פעם ב-BOT_STATE_FLUSH_SECONDS
+# (מאחד כתיבות חמות כמו refill_kw_idx / ai_review_pos_*). flush גם ביציאה (atexit / SIGTERM).
+# BOT_STATE_BACKEND=sqlite שומר כל מפתח כשורה ב-bot.db במקום מסמך JSON אחד.
+BOT_STATE_FLUSH_SECONDS = float(os.getenv("BOT_STATE_FLUSH_SECONDS", "2") or 2)
+BOT_STATE_BACKEND = (os.getenv("BOT_STATE_BACKEND", "json") or "json").strip().lower()
+_STATE_LOCK = threading.RLock()
+_STATE_DIRTY: set[str] = set()
+_STATE_FLUSH_EVENT = threading.Event()
+_STATE_FLUSHER = None
+_STATE_SAVE_LOCK = threading.Lock()  # flusher / atexit / SIGTERM: כתיבה אחת בכל פעם (אותו קובץ .tmp)
+_STATE_FLUSHER_LOCK = threading.Lock()
+
+def _load_state_json() -> dict:
     try:
         if not os.path.exists(STATE_PATH):
             return {}
@@ -69,16 +156,107 @@ def _load_state():
     except Exception:
         return {}
 
-def _save_state(state: dict):
+def _state_db():
+    with _DB_LOCK:
+        conn = _db()
+        conn.execute("CREATE TABLE IF NOT EXISTS bot_state (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+        return conn
+
+def _load_state():
+    if BOT_STATE_BACKEND != "sqlite":
+        return _load_state_json()
+    try:
+        with _DB_LOCK:
+            conn = _state_db()
+            state = {r[0]: r[1] for r in conn.execute("SELECT k, v FROM bot_state")}
+            if not state:
+                # מעבר חד-פעמי מ-bot_state.json
+                state = {str(k): str(v if v is not None else "") for k, v in _load_state_json().items()}
+                if state:
+                    with _db_tx(conn):
+                        conn.executemany("INSERT OR REPLACE INTO bot_state(k, v) VALUES (?,?)", list(state.items()))
+        return state
+    except Exception as e:
+        print(f"[WARN] bot_state sqlite load failed, falling back to JSON: {e}", flush=True)
+        return _load_state_json()
+
+def _save_state(state: dict, dirty: set[str] | None = None) -> bool:
     try:
+        if BOT_STATE_BACKEND == "sqlite":
+            keys = set(state) if dirty is None else dirty
+            with _db_tx(_state_db()) as conn:
+                for k in keys:
+                    if k in state:
+                        conn.execute("INSERT OR REPLACE INTO bot_state(k, v) VALUES (?,?)", (k, str(state[k])))
+                    else:
+                        conn.execute("DELETE FROM bot_state WHERE k=?", (k,))
+            return True
         tmp = STATE_PATH + ".tmp"
         with open(tmp, "w", encoding="utf-8") as f:
             json.dump(state or {}, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
         os.replace(tmp, STATE_PATH)
-    except Exception:
-        pass
+        return True
+    except Exception as e:
+        log_warn(f"[STATE] bot_state save failed: {e}")
+        return False
+
+def _flush_state(timeout: float = -1):
+    """Write pending state changes now (no-op when nothing is dirty). Failed keys stay dirty for the next flush."""
+    if not _STATE_SAVE_LOCK.acquire(timeout=timeout):
+        return
+    try:
+        with _STATE_LOCK:
+            if not _STATE_DIRTY:
+                return
+            snapshot = dict(BOT_STATE)
+            dirty = set(_STATE_DIRTY)
+            _STATE_DIRTY.clear()
+        if not _save_state(snapshot, dirty):
+            with _STATE_LOCK:
+                _STATE_DIRTY.update(dirty)
+    finally:
+        _STATE_SAVE_LOCK.release()
+
+def _state_flush_loop():
+    while True:
+        _STATE_FLUSH_EVENT.wait()
+        time.sleep(BOT_STATE_FLUSH_SECONDS)  # coalesce a burst of setters into one write
+        _STATE_FLUSH_EVENT.clear()
+        _flush_state()
+
+def _state_schedule_flush():
+    """Flush now (sync mode) or wake the flusher. Call WITHOUT _STATE_LOCK held: the flush takes
+    _STATE_SAVE_LOCK and then _STATE_LOCK, and that order must hold everywhere."""
+    global _STATE_FLUSHER
+    if BOT_STATE_FLUSH_SECONDS <= 0:
+        _flush_state()
+        return
+    with _STATE_FLUSHER_LOCK:
+        if _STATE_FLUSHER is None:
+            _STATE_FLUSHER = threading.Thread(target=_state_flush_loop, daemon=True, name="state-flush")
+            _STATE_FLUSHER.start()
+    _STATE_FLUSH_EVENT.set()
+
+def _state_on_sigterm(signum, frame):
+    # ה-handler רץ ב-main thread; אם הוא קטע flush באמצע — לא לחכות לעצמנו (ה-flush של atexit ישלים)
+    _flush_state(timeout=5)
+    prev = _PREV_SIGTERM
+    if callable(prev):
+        prev(signum, frame)
+    elif prev != signal.SIG_IGN:
+        raise SystemExit(128 + signum)
 
 BOT_STATE = _load_state()
+atexit.register(_flush_state)
+_PREV_SIGTERM = None
+if threading.current_thread() is threading.main_thread():
+    try:
+        _PREV_SIGTERM = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, _state_on_sigterm)
+    except Exception:
+        pass
 
 def _get_state_str(key: str, default: str = "") -> str:
     v = BOT_STATE.get(key)
@@ -87,8 +265,13 @@ def _get_state_str(key: str, default: str = "") -> str:
     return str(v or "").strip()
 
 def _set_state_str(key: str, value: str):
-    BOT_STATE[key] = (value or "").strip()
-    _save_state(BOT_STATE)
+    value = (value or "").strip()
+    with _STATE_LOCK:
+        if BOT_STATE.get(key) == value:
+            return
+        BOT_STATE[key] = value
+        _STATE_DIRTY.add(key)
+    _state_schedule_flush()
 
 
 def _set_state_bool(key: str, value: bool):
@@ -225,13 +408,19 @@ def log_exc(msg: str):
         print(msg, flush=True)
 
 import csv
-import time
 import re
 import json
+import mmap
 import socket
+import struct
+import tempfile
 import threading
 import hashlib
 import requests
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Full
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from flask import Flask, request
@@ -269,7 +458,7 @@ ADMIN_USER_IDS = set(int(x) for x in ADMIN_USER_IDS_RAW.split(",") if x.strip().
 
 # קבצים (בתיקיית DATA המתמשכת)
 DATA_CSV    = os.path.join(BASE_DIR, "workfile.csv")        # קובץ המקור האחרון שהועלה
-PENDING_CSV = os.path.join(BASE_DIR, "pending.csv")         # תור הפוסטים
+PENDING_CSV = os.path.join(BASE_DIR, "pending.csv")         # תור הפוסטים (ישן: מיובא פעם אחת ל-bot.db, כיום קובץ ייצוא)
 DELAY_FILE  = os.path.join(BASE_DIR, "post_delay.txt")      # מרווח שידור
 PUBLIC_PRESET_FILE  = os.path.join(BASE_DIR, "public_target.preset")
 PRIVATE_PRESET_FILE = os.path.join(BASE_DIR, "private_target.preset")
@@ -282,7 +471,8 @@ ADMIN_CHAT_ID_FILE      = os.path.join(BASE_DIR, "admin_chat_id.txt")  # לשי
 # ========= DEDUP / DIVERSITY HISTORY =========
 # Keeps a rolling history of products we've already queued/sent, to avoid repeating the same product
 # (even when AliExpress returns multiple affiliate links for the same product_id).
-DEDUP_HISTORY_PATH = os.path.join(BASE_DIR, "dedup_history.json")
+DEDUP_HISTORY_PATH = os.path.join(BASE_DIR, "dedup_history.json")   # פורמט ישן: מיובא פעם אחת
+DEDUP_LOG_PATH = os.path.join(BASE_DIR, "dedup_history.jsonl")      # לוג append-only, רשומה לשורה
 
 def _env_int(name: str, default: int) -> int:
     try:
@@ -299,94 +489,338 @@ DEDUP_KEEP_DAYS = _get_state_int("dedup_keep_days", DEDUP_KEEP_DAYS_DEFAULT)
 DEDUP_MAX_RECORDS = _env_int("AE_DEDUP_MAX_RECORDS", 3000)
 DEDUP_RECENT_CAT_WINDOW = _env_int("AE_DEDUP_RECENT_CAT_WINDOW", 200)
 
-def _load_dedup_history() -> dict:
-    try:
-        if not os.path.exists(DEDUP_HISTORY_PATH):
-            return {"items": []}
-        with open(DEDUP_HISTORY_PATH, "r", encoding="utf-8") as f:
-            d = json.load(f) or {}
-        if not isinstance(d, dict):
-            return {"items": []}
-        items = d.get("items") or []
-        if not isinstance(items, list):
-            items = []
-        d["items"] = items
-        return d
-    except Exception:
-        return {"items": []}
+# near-duplicate titles: SimHash index (see _title_simhash)
+AE_NEAR_DUP_ENABLED = env_bool("AE_NEAR_DUP_ENABLED", True)
+AE_NEAR_DUP_DISTANCE = max(0, min(7, _env_int("AE_NEAR_DUP_DISTANCE", 3)))
+AE_NEAR_DUP_MIN_WORDS = 3
+
+class _SimIndex:
+    """SimHash lookup within `distance` bits: the hash is split into distance+1 bands, so any match shares a band."""
+
+    def __init__(self, distance: int = AE_NEAR_DUP_DISTANCE):
+        self.distance = distance
+        self.bands = distance + 1
+        self.width = 64 // self.bands
+        self.mask = (1 << self.width) - 1
+        self.hashes: dict = {}
+        self.tables: list[dict] = [{} for _ in range(self.bands)]
+
+    def _parts(self, h: int):
+        return [(h >> (i * self.width)) & self.mask for i in range(self.bands)]
+
+    def add(self, key, h: int):
+        if not h:
+            return
+        self.remove(key)
+        self.hashes[key] = h
+        for i, part in enumerate(self._parts(h)):
+            self.tables[i].setdefault(part, set()).add(key)
+
+    def remove(self, key):
+        h = self.hashes.pop(key, None)
+        if h is None:
+            return
+        for i, part in enumerate(self._parts(h)):
+            bucket = self.tables[i].get(part)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.tables[i][part]
+
+    def find(self, h: int):
+        """Key of an indexed hash within `distance` bits of h, or None."""
+        if not h:
+            return None
+        for i, part in enumerate(self._parts(h)):
+            for key in self.tables[i].get(part, ()):
+                if bin(self.hashes[key] ^ h).count("1") <= self.distance:
+                    return key
+        return None
 
-def _save_dedup_history(d: dict):
+    def __len__(self):
+        return len(self.hashes)
+
+_NEAR_SENT = _SimIndex()  # כותרות שנשלחו לאחרונה, מתוחזק יחד עם היסטוריית ה-dedup
+
+# אינדקס בזיכרון: deque לפי זמן (תפוגה מהשמאל ב-O(פגי תוקף)), מוני id / title-fingerprint לבדיקת
+# שייכות ב-O(1), ומונה קטגוריות מתגלגל על DEDUP_RECENT_CAT_WINDOW הרשומות האחרונות.
+# על הדיסק: שורה אחת לכל רשומה חדשה, ודחיסה (כתיבה מחדש של הרשומות החיות) רק מדי פעם.
+_DEDUP_LOCK = threading.RLock()
+_DEDUP_ITEMS: deque = deque()
+_DEDUP_IDS: Counter = Counter()
+_DEDUP_TFPS: Counter = Counter()
+_DEDUP_RECENT_CATS: deque = deque()
+_DEDUP_CAT_COUNTS: Counter = Counter()
+_DEDUP_LOG_LINES = 0  # שורות בקובץ הלוג (כולל רשומות שפג תוקפן)
+
+def _dedup_index_add(it: dict):
+    _DEDUP_ITEMS.append(it)
+    if it.get("sh"):
+        _NEAR_SENT.add(id(it), int(it["sh"], 16))
+    if it.get("id"):
+        _DEDUP_IDS[it["id"]] += 1
+    if it.get("tfp"):
+        _DEDUP_TFPS[it["tfp"]] += 1
+    if DEDUP_RECENT_CAT_WINDOW > 0:
+        _DEDUP_RECENT_CATS.append(it.get("cat") or "")
+        _DEDUP_CAT_COUNTS[it.get("cat") or ""] += 1
+        if len(_DEDUP_RECENT_CATS) > DEDUP_RECENT_CAT_WINDOW:
+            _dedup_counter_dec(_DEDUP_CAT_COUNTS, _DEDUP_RECENT_CATS.popleft())
+
+def _dedup_counter_dec(counter: Counter, key: str):
+    if not key:
+        return
+    n = counter.get(key, 0) - 1
+    if n > 0:
+        counter[key] = n
+    else:
+        counter.pop(key, None)
+
+def _dedup_expire(now: float | None = None):
+    """Drop records older than DEDUP_KEEP_DAYS (and beyond DEDUP_MAX_RECORDS) from the left."""
+    keep_seconds = max(1, int(DEDUP_KEEP_DAYS)) * 24 * 3600
+    cutoff = (now or time.time()) - keep_seconds
+    with _DEDUP_LOCK:
+        while _DEDUP_ITEMS and (_DEDUP_ITEMS[0]["ts"] < cutoff or len(_DEDUP_ITEMS) > DEDUP_MAX_RECORDS):
+            # הרשומה שיוצאת היא גם בחלון הקטגוריות רק כשהחלון מכסה את כל ההיסטוריה
+            if _DEDUP_RECENT_CATS and len(_DEDUP_ITEMS) <= len(_DEDUP_RECENT_CATS):
+                _dedup_counter_dec(_DEDUP_CAT_COUNTS, _DEDUP_RECENT_CATS.popleft())
+            it = _DEDUP_ITEMS.popleft()
+            _NEAR_SENT.remove(id(it))
+            _dedup_counter_dec(_DEDUP_IDS, it.get("id") or "")
+            _dedup_counter_dec(_DEDUP_TFPS, it.get("tfp") or "")
+
+def _dedup_clean_record(it) -> dict | None:
+    if not isinstance(it, dict):
+        return None
     try:
-        tmp = DEDUP_HISTORY_PATH + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(d or {"items": []}, f, ensure_ascii=False)
-        os.replace(tmp, DEDUP_HISTORY_PATH)
+        ts = float(it.get("ts") or 0)
     except Exception:
-        pass
+        ts = 0
+    if not ts:
+        return None
+    out = {"ts": ts, "id": str(it.get("id") or "").strip(), "tfp": str(it.get("tfp") or "").strip(),
+           "cat": str(it.get("cat") or "").strip(), "src": str(it.get("src") or "")}
+    if it.get("sh"):
+        out["sh"] = str(it["sh"])
+    return out
 
-DEDUP_HISTORY = _load_dedup_history()
+def _dedup_compact():
+    """Rewrite the log with only the live records (atomic replace)."""
+    global _DEDUP_LOG_LINES
+    with _DEDUP_LOCK:
+        try:
+            tmp = DEDUP_LOG_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for it in _DEDUP_ITEMS:
+                    f.write(json.dumps(it, ensure_ascii=False) + "\n")
+            os.replace(tmp, DEDUP_LOG_PATH)
+            _DEDUP_LOG_LINES = len(_DEDUP_ITEMS)
+        except Exception as e:
+            print(f"[WARN] dedup log compaction failed: {e}", flush=True)
 
-def _dedup_cleanup():
+def _load_dedup_history():
+    global _DEDUP_LOG_LINES
+    records = []
+    migrated = False
     try:
-        keep_seconds = max(1, int(DEDUP_KEEP_DAYS)) * 24 * 3600
-        now = time.time()
-        items = DEDUP_HISTORY.get("items") or []
-        cleaned = []
-        for it in items:
-            try:
-                ts = float(it.get("ts") or 0)
-            except Exception:
-                ts = 0
-            if ts and (now - ts) <= keep_seconds:
-                cleaned.append(it)
-        # cap
-        if len(cleaned) > DEDUP_MAX_RECORDS:
-            cleaned = cleaned[-DEDUP_MAX_RECORDS:]
-        DEDUP_HISTORY["items"] = cleaned
-    except Exception:
-        pass
+        if os.path.exists(DEDUP_LOG_PATH):
+            with open(DEDUP_LOG_PATH, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    _DEDUP_LOG_LINES += 1
+                    try:
+                        records.append(json.loads(line))
+                    except Exception:
+                        continue  # שורה חלקית (קריסה באמצע כתיבה)
+        elif os.path.exists(DEDUP_HISTORY_PATH):
+            with open(DEDUP_HISTORY_PATH, "r", encoding="utf-8") as f:
+                d = json.load(f) or {}
+            records = (d.get("items") or []) if isinstance(d, dict) else []
+            migrated = True
+    except Exception as e:
+        print(f"[WARN] dedup history load failed: {e}", flush=True)
 
-def _dedup_sets() -> tuple[set[str], set[str]]:
-    # returns (seen_ids, seen_titlefps)
-    _dedup_cleanup()
-    ids = set()
-    fps = set()
-    for it in (DEDUP_HISTORY.get("items") or []):
-        iid = str(it.get("id") or "").strip()
-        tfp = str(it.get("tfp") or "").strip()
-        if iid:
-            ids.add(iid)
-        if tfp:
-            fps.add(tfp)
-    return ids, fps
+    clean = [r for r in (_dedup_clean_record(x) for x in records) if r]
+    clean.sort(key=lambda r: r["ts"])
+    with _DEDUP_LOCK:
+        for it in clean:
+            _dedup_index_add(it)
+        _dedup_expire()
+    if migrated or _DEDUP_LOG_LINES > 2 * max(len(_DEDUP_ITEMS), 100):
+        _dedup_compact()
+
+_load_dedup_history()
+
+def dedup_has_id(item_id: str) -> bool:
+    if not item_id:
+        return False
+    _dedup_expire()
+    return item_id in _DEDUP_IDS
+
+def dedup_has_tfp(tfp: str) -> bool:
+    if not tfp:
+        return False
+    _dedup_expire()
+    return tfp in _DEDUP_TFPS
 
 def dedup_recent_category_counts() -> dict[str, int]:
     """Counts categories in the most recent window, to prefer underused categories."""
-    _dedup_cleanup()
-    items = DEDUP_HISTORY.get("items") or []
-    tail = items[-DEDUP_RECENT_CAT_WINDOW:] if DEDUP_RECENT_CAT_WINDOW > 0 else items
-    counts: dict[str, int] = {}
-    for it in tail:
-        c = str(it.get("cat") or "").strip()
-        if not c:
-            continue
-        counts[c] = counts.get(c, 0) + 1
-    return counts
+    _dedup_expire()
+    with _DEDUP_LOCK:
+        return {c: n for c, n in _DEDUP_CAT_COUNTS.items() if c}
+
+# ========= LONG-HORIZON DEDUP (scalable Bloom filter) =========
+# ההיסטוריה למעלה מוגבלת (DEDUP_KEEP_DAYS / DEDUP_MAX_RECORDS). כאן נשמר כל ItemId / title fingerprint
+# שנשלח אי-פעם, בכמה בייטים לפריט: סדרת Bloom filters בקבצי mmap (dedup_bloom_N.bin). כשקובץ מתמלא
+# נפתח קובץ חדש בקיבולת כפולה ו-FP חצוי, כך שסך שגיאת ה-false positive נשארת חסומה.
+DEDUP_LONG_ENABLED = env_bool("AE_DEDUP_LONG_ENABLED", True)
+DEDUP_LONG_CAPACITY = max(1000, _env_int("AE_DEDUP_LONG_CAPACITY", 100000))
+DEDUP_LONG_FP_RATE = min(0.1, max(1e-6, float(os.environ.get("AE_DEDUP_LONG_FP_RATE", "0.001") or 0.001)))
+_BLOOM_MAGIC = b"AEBLOOM1"
+_BLOOM_HDR = struct.Struct("<8sQQII")  # magic, m_bits, capacity, k, count
+_BLOOM_LOCK = threading.Lock()
+_BLOOM_FILTERS: list[dict] = []  # {"path", "f", "mm", "m", "cap", "k", "count"}
+
+def _bloom_path(n: int) -> str:
+    return os.path.join(BASE_DIR, f"dedup_bloom_{n}.bin")
+
+def _bloom_open(path: str) -> dict | None:
+    try:
+        f = open(path, "r+b")
+        mm = mmap.mmap(f.fileno(), 0)
+        magic, m, cap, k, count = _BLOOM_HDR.unpack_from(mm, 0)
+        if magic != _BLOOM_MAGIC or len(mm) < _BLOOM_HDR.size + (m + 7) // 8:
+            raise ValueError("bad header")
+        return {"path": path, "f": f, "mm": mm, "m": m, "cap": cap, "k": k, "count": count}
+    except Exception as e:
+        print(f"[WARN] dedup bloom {os.path.basename(path)} unreadable, ignored: {e}", flush=True)
+        return None
+
+def _bloom_create(n: int) -> dict | None:
+    cap = DEDUP_LONG_CAPACITY * (2 ** n)
+    p = DEDUP_LONG_FP_RATE / (2 ** (n + 1))
+    m = max(8, int(math.ceil(-cap * math.log(p) / (math.log(2) ** 2))))
+    k = max(1, int(round(m / cap * math.log(2))))
+    path = _bloom_path(n)
+    with open(path, "wb") as f:
+        f.write(_BLOOM_HDR.pack(_BLOOM_MAGIC, m, cap, k, 0))
+        f.truncate(_BLOOM_HDR.size + (m + 7) // 8)
+    return _bloom_open(path)
+
+def _bloom_positions(key: str, m: int, k: int):
+    d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(d[:8], "little")
+    h2 = int.from_bytes(d[8:], "little") | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+def _bloom_has(bf: dict, key: str) -> bool:
+    mm, off = bf["mm"], _BLOOM_HDR.size
+    return all(mm[off + (pos >> 3)] & (1 << (pos & 7)) for pos in _bloom_positions(key, bf["m"], bf["k"]))
+
+def _bloom_load():
+    n = 0
+    while os.path.exists(_bloom_path(n)):
+        bf = _bloom_open(_bloom_path(n))
+        if bf is None:
+            break
+        _BLOOM_FILTERS.append(bf)
+        n += 1
+    if not _BLOOM_FILTERS:
+        # קובץ ראשון: זורעים אותו מההיסטוריה הקצרה הקיימת
+        with _DEDUP_LOCK:
+            seed = list(_DEDUP_ITEMS)
+        for it in seed:
+            for key in (("id:" + it["id"]) if it.get("id") else "", ("tfp:" + it["tfp"]) if it.get("tfp") else ""):
+                if key:
+                    _dedup_long_key_add(key)
+
+def _dedup_long_key_add(key: str):
+    if any(_bloom_has(bf, key) for bf in _BLOOM_FILTERS):
+        return
+    if not _BLOOM_FILTERS or _BLOOM_FILTERS[-1]["count"] >= _BLOOM_FILTERS[-1]["cap"]:
+        bf = _bloom_create(len(_BLOOM_FILTERS))
+        if bf is None:
+            return
+        _BLOOM_FILTERS.append(bf)
+    bf = _BLOOM_FILTERS[-1]
+    mm, off = bf["mm"], _BLOOM_HDR.size
+    for pos in _bloom_positions(key, bf["m"], bf["k"]):
+        mm[off + (pos >> 3)] |= 1 << (pos & 7)
+    bf["count"] += 1
+    _BLOOM_HDR.pack_into(mm, 0, _BLOOM_MAGIC, bf["m"], bf["cap"], bf["k"], bf["count"])
+    mm.flush()
+
+def _dedup_long_add(item_id: str, tfp: str):
+    if not DEDUP_LONG_ENABLED:
+        return
+    try:
+        with _BLOOM_LOCK:
+            if item_id:
+                _dedup_long_key_add("id:" + item_id)
+            if tfp:
+                _dedup_long_key_add("tfp:" + tfp)
+    except Exception as e:
+        print(f"[WARN] dedup bloom add failed: {e}", flush=True)
+
+def dedup_long_has(item_id: str = "", tfp: str = "") -> bool:
+    """True if this ItemId (or, when given, title fingerprint) was ever sent. May rarely false-positive."""
+    if not DEDUP_LONG_ENABLED:
+        return False
+    keys = (["id:" + item_id] if item_id else []) + (["tfp:" + tfp] if tfp else [])
+    with _BLOOM_LOCK:
+        return any(_bloom_has(bf, key) for bf in _BLOOM_FILTERS for key in keys)
+
+def dedup_long_stats() -> str:
+    """Keys, files and size of the ever-sent tier, fill of the current file and the estimated false-positive rate."""
+    if not DEDUP_LONG_ENABLED:
+        return "off"
+    with _BLOOM_LOCK:
+        filters = [(bf["count"], bf["cap"], bf["m"], bf["k"], len(bf["mm"])) for bf in _BLOOM_FILTERS]
+    if not filters:
+        return "empty"
+    n = sum(f[0] for f in filters)
+    size = sum(f[4] for f in filters)
+    fill = filters[-1][0] / filters[-1][1] if filters[-1][1] else 0.0
+    # p ≈ (1 - e^(-kn/m))^k לכל קובץ; בדיקה פוגעת אם אחד הקבצים טועה
+    ok = 1.0
+    for count, _, m, k, _ in filters:
+        ok *= 1.0 - (1.0 - math.exp(-k * count / m)) ** k
+    return f"{n} keys in {len(filters)} file(s), {size // 1024}KB, current {fill:.0%} full, est. false-positive {1.0 - ok:.4%}"
 
 def dedup_mark_seen(row: dict, source: str = ""):
+    global _DEDUP_LOG_LINES
     try:
         item_id = str(row.get("ItemId") or "").strip() or _extract_item_id_from_url(row.get("BuyLink") or "")
         tfp = _title_fingerprint(str(row.get("Title") or ""))
         cat = str(row.get("CategoryId") or "").strip()
         if not item_id and not tfp:
             return
-        DEDUP_HISTORY.setdefault("items", [])
-        DEDUP_HISTORY["items"].append({"ts": time.time(), "id": item_id, "tfp": tfp, "cat": cat, "src": source})
-        _dedup_cleanup()
-        _save_dedup_history(DEDUP_HISTORY)
+        it = {"ts": time.time(), "id": item_id, "tfp": tfp, "cat": cat, "src": source}
+        sh = _title_simhash(_near_title(row))
+        if sh:
+            it["sh"] = format(sh, "016x")
+        with _DEDUP_LOCK:
+            _dedup_index_add(it)
+            _dedup_expire(it["ts"])
+            with open(DEDUP_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(it, ensure_ascii=False) + "\n")
+            _DEDUP_LOG_LINES += 1
+            if _DEDUP_LOG_LINES > 2 * max(len(_DEDUP_ITEMS), 100):
+                _dedup_compact()
+        _dedup_long_add(item_id, tfp)
     except Exception:
         pass
 
+if DEDUP_LONG_ENABLED:
+    try:
+        with _BLOOM_LOCK:
+            _bloom_load()
+    except Exception as e:
+        print(f"[WARN] dedup bloom load failed: {e}", flush=True)
+
 USD_TO_ILS_RATE_DEFAULT = float(os.environ.get("USD_TO_ILS_RATE", "3.55") or "3.55")
 
 USD_TO_ILS_RATE = _get_state_float("usd_to_ils_rate", USD_TO_ILS_RATE_DEFAULT)
@@ -485,7 +919,9 @@ for u in _default_candidates:
     if u not in AE_TOP_URL_CANDIDATES:
         AE_TOP_URL_CANDIDATES.append(u)
 
-AE_TOP_URL = AE_TOP_URL_CANDIDATES[0]
+# השער האחרון שעבד נשמר ב-BOT_STATE, כך שאחרי ריסטארט הקריאה הראשונה כבר הולכת אליו
+_saved_top_url = _get_state_str("top_gateway_url", "")
+AE_TOP_URL = _saved_top_url if _saved_top_url in AE_TOP_URL_CANDIDATES else AE_TOP_URL_CANDIDATES[0]
 AE_APP_KEY = (os.environ.get("AE_APP_KEY", "") or "").strip()
 AE_APP_SECRET = (os.environ.get("AE_APP_SECRET", "") or "").strip()
 AE_TRACKING_ID = (os.environ.get("AE_TRACKING_ID", "") or "").strip()
@@ -539,6 +975,19 @@ def set_ai_auto_mode(flag: bool):
 # יציבות/ביצועים
 GPT_TIMEOUT_SECONDS = int(os.environ.get("GPT_TIMEOUT_SECONDS", "45") or "45")
 GPT_MAX_RETRIES = int(os.environ.get("GPT_MAX_RETRIES", "2") or "2")
+# מקביליות: כמה באצ'ים בו-זמנית, ומגבלת קצב (בקשות לדקה / טוקנים משוערים לדקה, 0 = ללא הגבלה)
+GPT_CONCURRENCY = max(1, _env_int("GPT_CONCURRENCY", 3))
+GPT_RPM = float(os.environ.get("GPT_RPM", "60") or "60")
+GPT_TPM = float(os.environ.get("GPT_TPM", "150000") or "150000")
+_AI_REQ_BUCKET = _TokenBucket(GPT_RPM / 60.0, GPT_CONCURRENCY)
+_AI_TOK_BUCKET = _TokenBucket(GPT_TPM / 60.0, max(4000.0, GPT_TPM / 6.0))
+
+# מטמון קופי AI (ב-bot.db): אותו מוצר+כותרת+גרסת פרומפט+מודל -> אותו Opening/Title/Strengths בלי קריאה ל-OpenAI.
+# שנה את AI_PROMPT_VERSION בכל שינוי בפרומפט כדי שתוצאות ישנות לא ימוחזרו.
+AI_PROMPT_VERSION = "2025-12-v1"
+AI_CACHE_ENABLED = env_bool("AI_CACHE_ENABLED", True)
+AI_CACHE_TTL_DAYS = _env_int("AI_CACHE_TTL_DAYS", 30)
+AI_CACHE_MAX_ENTRIES = _env_int("AI_CACHE_MAX_ENTRIES", 20000)
 
 try:
     from openai import OpenAI
@@ -637,6 +1086,10 @@ AE_REFILL_MIN_QUEUE = int(os.environ.get("AE_REFILL_MIN_QUEUE", "30") or "30")
 AE_REFILL_MAX_PAGES = int(os.environ.get("AE_REFILL_MAX_PAGES", "3") or "3")
 AE_REFILL_PAGE_SIZE = int(os.environ.get("AE_REFILL_PAGE_SIZE", "50") or "50")
 AE_REFILL_SORT = (os.environ.get("AE_REFILL_SORT", "LAST_VOLUME_DESC") or "LAST_VOLUME_DESC").strip().upper()
+# Concurrent fetch stage for refill: how many TOP queries run in parallel, and per-gateway pacing (requests/sec).
+AE_REFILL_CONCURRENCY = max(1, _env_int("AE_REFILL_CONCURRENCY", 4))
+AE_TOP_RATE_PER_SEC = float(os.environ.get("AE_TOP_RATE_PER_SEC", "4") or "4")
+AE_TOP_RATE_BURST = max(1, _env_int("AE_TOP_RATE_BURST", 4))
 
 # Optional price filtering (ILS buckets) for refill results.
 # Example: AE_PRICE_BUCKETS=1-5,5-10,10-20,20-50,50+
@@ -734,11 +1187,141 @@ def set_price_buckets_raw(raw: str):
 # Keep last refill stats for debugging
 LAST_REFILL_STATS = {"added": 0, "dup": 0, "skipped_no_link": 0, "price_filtered": 0, "last_error": None, "last_page": 0}
 
+# ========= TELEGRAM RATE LIMIT =========
+# כל קריאה יוצאת לטלגרם עוברת דרך apihelper.CUSTOM_REQUEST_SENDER: דלי גלובלי לבוט, דלי לכל צ'אט
+# (פרטי ~1/ש׳, קבוצה/ערוץ ~20/דק׳) ודלי נפרד לפוסטים בערוצים. על 429 ממתינים בדיוק retry_after
+# ומנסים שוב; הצ'אט (או כל הבוט, כשאין צ'אט בבקשה) מוקפא לאותו זמן גם לשאר השולחים.
+# הודעות רקע (התראות, עדכוני משימות, לולאת השידור) משאירות עתודה בדליים, כך שתגובות לממשק האדמין עוברות ראשונות.
+TG_RATE_GLOBAL_PER_SEC = float(os.getenv("TG_RATE_GLOBAL_PER_SEC", "25") or 25)
+TG_RATE_PRIVATE_PER_SEC = float(os.getenv("TG_RATE_PRIVATE_PER_SEC", "1") or 1)
+TG_RATE_GROUP_PER_MIN = float(os.getenv("TG_RATE_GROUP_PER_MIN", "20") or 20)
+TG_RATE_CHANNEL_POSTS_PER_MIN = float(os.getenv("TG_RATE_CHANNEL_POSTS_PER_MIN", "20") or 20)
+TG_429_MAX_RETRIES = 3
+TG_BACKGROUND_RESERVE = 0.3  # חלק מכל דלי ששמור לקריאות בעדיפות גבוהה
+_TG_LIMITED_PREFIXES = ("send", "edit", "copyMessage", "forwardMessage")
+_TG_POST_PREFIXES = ("send", "copyMessage", "forwardMessage")
+
+_TG_GLOBAL = _TokenBucket(TG_RATE_GLOBAL_PER_SEC, TG_RATE_GLOBAL_PER_SEC)
+_TG_CHANNEL_POSTS = _TokenBucket(TG_RATE_CHANNEL_POSTS_PER_MIN / 60.0, 3)
+_TG_CHATS: dict = {}  # chat_id (str) -> _TokenBucket
+_TG_HOLD: dict = {}   # chat_id (str) | None -> monotonic time until which sends are frozen (429)
+_TG_LOCK = threading.Lock()
+_TG_LOCAL = threading.local()
+_TG_STATS = Counter()
+
+def tg_set_background(flag: bool = True):
+    """Mark every Telegram call from the current thread as background (lower priority)."""
+    _TG_LOCAL.background = bool(flag)
+
+def tg_is_background() -> bool:
+    return getattr(_TG_LOCAL, "background", False)
+
+@contextmanager
+def tg_background():
+    prev = tg_is_background()
+    _TG_LOCAL.background = True
+    try:
+        yield
+    finally:
+        _TG_LOCAL.background = prev
+
+def _tg_chat_bucket(chat: str) -> _TokenBucket:
+    with _TG_LOCK:
+        b = _TG_CHATS.get(chat)
+        if b is None:
+            if chat.isdigit():  # צ'אט פרטי (מזהה חיובי)
+                b = _TokenBucket(TG_RATE_PRIVATE_PER_SEC, 3)
+            else:               # קבוצה / ערוץ (-100… או @name)
+                b = _TokenBucket(TG_RATE_GROUP_PER_MIN / 60.0, 5)
+            _TG_CHATS[chat] = b
+        return b
+
+def _tg_wait_hold(chat: str | None):
+    while True:
+        with _TG_LOCK:
+            until = max(_TG_HOLD.get(None, 0.0), _TG_HOLD.get(chat, 0.0) if chat else 0.0)
+        wait = until - time.monotonic()
+        if wait <= 0:
+            return
+        time.sleep(min(wait, 5.0))
+
+def _tg_throttle(method_name: str, chat: str | None):
+    bg = tg_is_background()
+
+    def reserve(b):
+        return b.capacity * TG_BACKGROUND_RESERVE if bg else 0.0
+
+    t0 = time.monotonic()
+    _tg_wait_hold(chat)
+    if chat and method_name.startswith(_TG_LIMITED_PREFIXES):
+        if not chat.isdigit() and method_name.startswith(_TG_POST_PREFIXES):
+            _TG_CHANNEL_POSTS.acquire()
+        b = _tg_chat_bucket(chat)
+        b.acquire(reserve=reserve(b))
+    _TG_GLOBAL.acquire(reserve=reserve(_TG_GLOBAL))
+    waited = time.monotonic() - t0
+    if waited >= 0.05:
+        _TG_STATS["throttled"] += 1
+        _TG_STATS["throttled_ms"] += int(waited * 1000)
+
+def _tg_retry_after(resp) -> float:
+    try:
+        v = (resp.json().get("parameters") or {}).get("retry_after")
+        if v is not None:
+            return max(0.0, float(v))
+    except Exception:
+        pass
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After") or 1))
+    except Exception:
+        return 1.0
+
+def _tg_rewind(files) -> bool:
+    """Rewind uploaded files so the request can be sent again. False if any of them can't be."""
+    for v in (files or {}).values():
+        f = v[1] if isinstance(v, tuple) and len(v) > 1 else v
+        if isinstance(f, (bytes, str)):
+            continue
+        try:
+            f.seek(0)
+        except Exception:
+            return False
+    return True
+
+def _tg_request_sender(method, url, params=None, files=None, timeout=None, proxies=None, **kwargs):
+    """apihelper.CUSTOM_REQUEST_SENDER: pace the call, and on 429 wait exactly retry_after and resend."""
+    method_name = url.rsplit("/", 1)[-1]
+    chat = params.get("chat_id") if isinstance(params, dict) else None
+    chat = str(chat).strip() if chat not in (None, "") else None
+    session = apihelper.SESSION or requests
+    for attempt in range(TG_429_MAX_RETRIES + 1):
+        if method_name != "getUpdates":
+            _tg_throttle(method_name, chat)
+        resp = session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        if resp.status_code != 429:
+            return resp
+        _TG_STATS["429"] += 1
+        retry_after = _tg_retry_after(resp)
+        with _TG_LOCK:
+            _TG_HOLD[chat] = max(_TG_HOLD.get(chat, 0.0), time.monotonic() + retry_after)
+        log_warn(f"[TG] 429 on {method_name} chat={chat or '-'}: retry_after={retry_after:g}s (attempt {attempt + 1})")
+        if attempt >= TG_429_MAX_RETRIES or not _tg_rewind(files):
+            break
+    return resp
+
+def tg_limiter_stats() -> dict:
+    with _TG_LOCK:
+        now = time.monotonic()
+        held = {str(k or "*"): round(v - now, 1) for k, v in _TG_HOLD.items() if v > now}
+    return {"throttled": _TG_STATS["throttled"], "throttled_ms": _TG_STATS["throttled_ms"],
+            "rate_limited_429": _TG_STATS["429"], "held": held, "chats": len(_TG_CHATS)}
+
 # ========= INIT =========
 if not BOT_TOKEN:
     print("[WARN] BOT_TOKEN חסר – הבוט ירוץ אבל לא יתחבר לטלגרם עד שתגדיר ENV.", flush=True)
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# במצב webhook ה-handlers רצים בתוך ה-workers של WEBHOOK DISPATCH (סדר לפי צ'אט), לא ב-pool של telebot.
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=not USE_WEBHOOK)
 # ---- Telegram HTTP hardening (Railway/network hiccups) ----
 def _configure_telegram_http():
     try:
@@ -749,7 +1332,7 @@ def _configure_telegram_http():
             read=8,
             status=8,
             backoff_factor=0.8,
-            status_forcelist=[429, 500, 502, 503, 504],
+            status_forcelist=[500, 502, 503, 504],  # 429 מטופל ב-_tg_request_sender לפי retry_after
             allowed_methods=["GET", "POST"],
             raise_on_status=False,
         )
@@ -758,6 +1341,7 @@ def _configure_telegram_http():
         tg_session.mount("http://", adapter)
         tg_session.headers.update({"User-Agent": "TelegramPostBot/1.0"})
         apihelper.SESSION = tg_session
+        apihelper.CUSTOM_REQUEST_SENDER = _tg_request_sender
 
         # Best-effort timeouts (depends on pyTelegramBotAPI version)
         if hasattr(apihelper, "CONNECT_TIMEOUT"):
@@ -767,7 +1351,7 @@ def _configure_telegram_http():
         if hasattr(apihelper, "RETRY_ON_ERROR"):
             apihelper.RETRY_ON_ERROR = True
 
-        print("[CFG] Telegram HTTP session configured (retries/backoff/timeout).", flush=True)
+        print("[CFG] Telegram HTTP session configured (retries/backoff/timeout, rate limiter).", flush=True)
     except Exception as e:
         print(f"[WARN] Telegram HTTP session config failed: {e}", flush=True)
 
@@ -818,6 +1402,273 @@ def force_webhook():
     ok = _set_webhook()
     return ("ok" if ok else "failed"), (200 if ok else 500)
 
+# ========= WEBHOOK DISPATCH =========
+# ה-webhook רק מכניס את ה-update לתור ומחזיר 200 מיד; handlers ארוכים (refill / AI / חיפוש) לא
+# חוסמים את worker ה-gunicorn ולא גורמים לטלגרם לשלוח שוב. כל צ'אט ממופה ל-worker קבוע => סדר נשמר.
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "4") or 4))
+WEBHOOK_QUEUE_MAX = max(1, int(os.getenv("WEBHOOK_QUEUE_MAX", "500") or 500))
+WEBHOOK_DEDUP_SIZE = 2048
+
+_WH_LOCK = threading.Lock()
+_WH_QUEUES: list = []
+_WH_SEEN: "OrderedDict[int, None]" = OrderedDict()
+_WH_METRICS = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "errors": 0,
+               "busy": 0, "max_depth": 0, "handler_ms_total": 0.0, "handler_ms_max": 0.0}
+
+def _update_chat_id(update) -> int:
+    """Chat the update belongs to (used for worker sharding); 0 when unknown."""
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        m = getattr(update, attr, None)
+        if m is not None and getattr(m, "chat", None) is not None:
+            return int(m.chat.id)
+    cq = getattr(update, "callback_query", None)
+    if cq is not None:
+        if getattr(cq, "message", None) is not None and getattr(cq.message, "chat", None) is not None:
+            return int(cq.message.chat.id)
+        return int(cq.from_user.id)
+    for attr in ("inline_query", "chosen_inline_result", "my_chat_member", "chat_member", "chat_join_request"):
+        obj = getattr(update, attr, None)
+        u = getattr(obj, "from_user", None) if obj is not None else None
+        if u is not None:
+            return int(u.id)
+    return 0
+
+def _webhook_worker(idx: int, q: Queue):
+    while True:
+        update = q.get()
+        t0 = time.monotonic()
+        with _WH_LOCK:
+            _WH_METRICS["busy"] += 1
+        try:
+            bot.process_new_updates([update])
+            ok = True
+        except Exception as e:
+            ok = False
+            log_exc(f"[WEBHOOK] worker {idx} failed on update {getattr(update, 'update_id', '?')}: {e}")
+        finally:
+            ms = (time.monotonic() - t0) * 1000.0
+            with _WH_LOCK:
+                _WH_METRICS["busy"] -= 1
+                _WH_METRICS["processed" if ok else "errors"] += 1
+                _WH_METRICS["handler_ms_total"] += ms
+                _WH_METRICS["handler_ms_max"] = max(_WH_METRICS["handler_ms_max"], ms)
+            if ms > 10000:
+                log_info(f"[WEBHOOK] slow handler: update {getattr(update, 'update_id', '?')} took {ms / 1000:.1f}s (worker {idx})")
+            q.task_done()
+
+def _webhook_ensure_workers():
+    # lazy: threads נוצרים בתהליך שמגיש בפועל (בטוח גם עם gunicorn --preload)
+    with _WH_LOCK:
+        if _WH_QUEUES:
+            return _WH_QUEUES
+        per_worker = max(1, WEBHOOK_QUEUE_MAX // WEBHOOK_WORKERS)
+        for i in range(WEBHOOK_WORKERS):
+            q = Queue(maxsize=per_worker)
+            threading.Thread(target=_webhook_worker, args=(i, q), daemon=True, name=f"webhook-{i}").start()
+            _WH_QUEUES.append(q)
+        log_info(f"[WEBHOOK] dispatch started: workers={WEBHOOK_WORKERS} queue_max={WEBHOOK_QUEUE_MAX}")
+        return _WH_QUEUES
+
+def webhook_enqueue(update) -> str:
+    """Queue an update for its chat's worker. Returns 'queued' | 'duplicate' | 'full'."""
+    queues = _webhook_ensure_workers()
+    uid = getattr(update, "update_id", None)
+    with _WH_LOCK:
+        _WH_METRICS["received"] += 1
+        if uid is not None:
+            if uid in _WH_SEEN:
+                _WH_METRICS["duplicates"] += 1
+                return "duplicate"
+            _WH_SEEN[uid] = None
+            while len(_WH_SEEN) > WEBHOOK_DEDUP_SIZE:
+                _WH_SEEN.popitem(last=False)
+    q = queues[_update_chat_id(update) % len(queues)]
+    try:
+        q.put_nowait(update)
+    except Full:
+        with _WH_LOCK:
+            _WH_METRICS["rejected"] += 1
+            # לא נכנס לתור => לשכוח את ה-id כדי שהשליחה החוזרת של טלגרם תתקבל
+            _WH_SEEN.pop(uid, None)
+        log_warn(f"[WEBHOOK] queue full, rejecting update {uid} (Telegram will redeliver)")
+        return "full"
+    with _WH_LOCK:
+        depth = sum(x.qsize() for x in queues)
+        _WH_METRICS["max_depth"] = max(_WH_METRICS["max_depth"], depth)
+    return "queued"
+
+def webhook_metrics() -> dict:
+    with _WH_LOCK:
+        m = dict(_WH_METRICS)
+        depths = [q.qsize() for q in _WH_QUEUES]
+    done = m["processed"] + m["errors"]
+    m["avg_handler_ms"] = round(m.pop("handler_ms_total") / done, 1) if done else 0.0
+    m["handler_ms_max"] = round(m["handler_ms_max"], 1)
+    m["depth"] = sum(depths)
+    m["depth_per_worker"] = depths
+    m["workers"] = WEBHOOK_WORKERS
+    m["queue_max"] = WEBHOOK_QUEUE_MAX
+    return m
+
+def _webhook_summary() -> str:
+    m = webhook_metrics()
+    return (f"depth={m['depth']}/{m['queue_max']} busy={m['busy']}/{m['workers']} "
+            f"done={m['processed']} err={m['errors']} dup={m['duplicates']} rej={m['rejected']} "
+            f"avg={m['avg_handler_ms']}ms")
+
+@app.get("/metrics")
+def metrics():
+    secret = os.getenv("FORCE_WEBHOOK_SECRET", "").strip()
+    if secret and request.headers.get("X-Secret", "") != secret:
+        return "forbidden", 403
+    return {**webhook_metrics(), "telegram": tg_limiter_stats()}, 200
+
+# ========= JOBS =========
+# פעולות ארוכות (מילוי, AI, מיזוג, העלאת CSV) רצות כמשימות רקע: הודעת סטטוס אחת מתעדכנת עם התקדמות,
+# כפתור ביטול, והיסטוריה קצרה ב-/jobs. ה-handler חוזר מיד.
+JOBS_WORKERS = max(1, int(os.getenv("JOBS_WORKERS", "2") or 2))
+JOBS_HISTORY_MAX = 20
+JOB_PROGRESS_MIN_INTERVAL = 2.0  # שניות בין עריכות הודעת הסטטוס (מגבלות טלגרם)
+
+class JobCancelled(Exception):
+    """Raised inside a job after the admin pressed cancel."""
+
+class _Job:
+    def __init__(self, job_id: int, name: str, title: str, chat_id):
+        self.id = job_id
+        self.name = name
+        self.title = title
+        self.chat_id = chat_id
+        self.msg_id = None
+        self.state = "queued"  # queued | running | done | failed | cancelled
+        self.progress_text = ""
+        self.result_text = ""
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self._last_edit = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, text: str, force: bool = False):
+        """Update the status message (throttled to JOB_PROGRESS_MIN_INTERVAL)."""
+        self.progress_text = text
+        now = time.monotonic()
+        if not force and now - self._last_edit < JOB_PROGRESS_MIN_INTERVAL:
+            return
+        self._last_edit = now
+        _job_edit(self, f"⏳ {self.title} (#{self.id})\n{text}", with_cancel=True)
+
+    def summary_line(self) -> str:
+        icon = {"queued": "🕓", "running": "⏳", "done": "✅", "failed": "❌", "cancelled": "🛑"}.get(self.state, "•")
+        end = self.finished or time.time()
+        dur = int(end - (self.started or end))
+        detail = self.progress_text if self.state in ("queued", "running") else self.result_text
+        detail = (detail or "").splitlines()[0] if detail else ""
+        return f"{icon} #{self.id} {self.title} • {self.state} • {dur}s" + (f"\n   {detail}" if detail else "")
+
+_JOBS_LOCK = threading.Lock()
+_JOBS: dict[int, _Job] = {}
+_JOBS_HISTORY: deque = deque(maxlen=JOBS_HISTORY_MAX)
+_JOBS_SEQ = 0
+_JOBS_POOL = ThreadPoolExecutor(max_workers=JOBS_WORKERS, thread_name_prefix="job")
+
+def _job_kb(job: _Job):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🛑 בטל", callback_data=f"job_cancel_{job.id}"))
+    return kb
+
+def _job_edit(job: _Job, text: str, with_cancel: bool):
+    if not job.msg_id:
+        return
+    try:
+        bot.edit_message_text(html.escape(text), chat_id=job.chat_id, message_id=job.msg_id,
+                              reply_markup=_job_kb(job) if with_cancel else None)
+    except Exception as e:
+        if "message is not modified" not in str(e):
+            log_warn(f"[JOBS] status edit failed (#{job.id}): {e}")
+
+def _job_run(job: _Job, fn):
+    tg_set_background(True)
+    job.state = "running"
+    job.started = time.time()
+    try:
+        job.check()
+        job.progress("מתחיל…", force=True)
+        job.result_text = fn(job) or "הסתיים."
+        job.state = "cancelled" if job.cancelled else "done"
+    except JobCancelled:
+        job.state = "cancelled"
+        job.result_text = "בוטל לפני סיום."
+    except Exception as e:
+        job.state = "failed"
+        job.result_text = f"שגיאה: {e}"
+        log_exc(f"[JOBS] #{job.id} {job.name} failed: {e}")
+    finally:
+        job.finished = time.time()
+        with _JOBS_LOCK:
+            _JOBS.pop(job.id, None)
+            _JOBS_HISTORY.appendleft(job)
+        icon = {"done": "✅", "failed": "❌", "cancelled": "🛑"}.get(job.state, "•")
+        _job_edit(job, f"{icon} {job.title} (#{job.id}) • {int(job.finished - job.started)}s\n{job.result_text}", with_cancel=False)
+        log_info(f"[JOBS] #{job.id} {job.name} -> {job.state} in {job.finished - job.started:.1f}s")
+
+def job_submit(chat_id, name: str, title: str, fn, cb_id=None) -> _Job:
+    """Run fn(job) -> result text on the job pool, reporting into one status message.
+
+    Only one job per name runs at a time; a second submit returns the running job.
+    """
+    global _JOBS_SEQ
+    with _JOBS_LOCK:
+        running = next((j for j in _JOBS.values() if j.name == name), None)
+        if running is None:
+            _JOBS_SEQ += 1
+            job = _Job(_JOBS_SEQ, name, title, chat_id)
+            _JOBS[job.id] = job
+    if running is not None:
+        note = f"⏳ כבר רצה משימה #{running.id} ({running.title})"
+        if cb_id:
+            bot.answer_callback_query(cb_id, note)
+        else:
+            bot.send_message(chat_id, note)
+        return running
+
+    if cb_id:
+        bot.answer_callback_query(cb_id, f"🚀 משימה #{job.id} הופעלה")
+    try:
+        m = bot.send_message(chat_id, html.escape(f"🕓 {title} (#{job.id}) ממתין…"), reply_markup=_job_kb(job))
+        job.msg_id = m.message_id
+    except Exception as e:
+        log_warn(f"[JOBS] status message failed (#{job.id}): {e}")
+    _JOBS_POOL.submit(_job_run, job, fn)
+    return job
+
+def job_cancel(job_id: int) -> _Job | None:
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+    if job is not None:
+        job.cancel_event.set()
+    return job
+
+def jobs_status_text() -> str:
+    with _JOBS_LOCK:
+        active = sorted(_JOBS.values(), key=lambda j: j.id)
+        history = list(_JOBS_HISTORY)[:10]
+    lines = ["🧵 משימות רקע"]
+    lines.append("\nפעילות:" if active else "\nאין משימות פעילות.")
+    lines += [j.summary_line() for j in active]
+    if history:
+        lines.append("\nאחרונות:")
+        lines += [j.summary_line() for j in history]
+    return "\n".join(lines)
+
 @app.post("/webhook/<path:token>")
 def telegram_webhook(token: str):
     if token != BOT_TOKEN:
@@ -826,7 +1677,8 @@ def telegram_webhook(token: str):
         update_json = request.get_data(as_text=True)
         if update_json:
             update = telebot.types.Update.de_json(update_json)
-            bot.process_new_updates([update])
+            if webhook_enqueue(update) == "full":
+                return "busy", 503
         return "ok", 200
     except Exception as e:
         print(f"[ERR] webhook processing failed: {e}", flush=True)
@@ -837,10 +1689,12 @@ SESSION.headers.update({"User-Agent": "TelegramPostBot/1.0"})
 IL_TZ = ZoneInfo("Asia/Jerusalem")
 
 CURRENT_TARGET = CHANNEL_ID
-DELAY_EVENT = threading.Event()
+DELAY_EVENT = threading.Event()   # מעיר את מתזמן השידור: שידור הופעל/כובה, מרווח/מצב שונה, פריט מוכן נכנס לתור
+_FLAG_CACHE: dict = {}            # path -> value; קבצי הדגלים נקראים מהדיסק פעם אחת ומתעדכנים רק דרך ה-writers
 EXPECTING_TARGET = {}      # dict[user_id] = "public"|"private"
 EXPECTING_UPLOAD = set()   # user_ids שמצפים ל-CSV
 FILE_LOCK = threading.Lock()
+SEND_LOCK = threading.Lock()
 
 # ========= SINGLE INSTANCE LOCK =========
 def acquire_single_instance_lock(lock_path: str):
@@ -917,7 +1771,8 @@ def notify_admin(text: str):
     if not chat_id:
         return
     try:
-        bot.send_message(chat_id, text)
+        with tg_background():
+            bot.send_message(chat_id, text)
     except Exception as e:
         print(f"[WARN] notify_admin failed: {e}", flush=True)
 
@@ -1192,6 +2047,66 @@ def _price_in_buckets(price_ils: float, buckets) -> bool:
                 return True
     return False
 
+# ---- numeric row fields + compiled filters ----
+# מחרוזות המחיר/דירוג/הזמנות/עמלה מפוענחות פעם אחת לשדות פנימיים (_sale_num וכו'), שלא נשמרים לתור/CSV.
+# _num_src שומר את מחרוזות המקור: אם SalePrice השתנה (המרה ל-ILS, רענון) הערכים מחושבים מחדש.
+_NUM_SRC_FIELDS = ("SalePrice", "OriginalPrice", "Rating", "Orders", "CommissionRate")
+
+def row_numbers(row: dict) -> dict:
+    """Make sure `row` carries _sale_num/_orig_num/_rating_num/_orders_num/_commission_num for its current strings."""
+    src = tuple(row.get(k) for k in _NUM_SRC_FIELDS)
+    if row.get("_num_src") != src:
+        sale, orig, rating, orders, comm = src
+        row["_sale_num"] = _extract_float(sale or "")
+        row["_orig_num"] = _extract_float(orig or "")
+        row["_rating_num"] = _extract_float(rating or "")
+        row["_orders_num"] = safe_int(orders or "0", 0)
+        row["_commission_num"] = _commission_percent(comm or "")
+        row["_num_src"] = src
+    return row
+
+_ROW_FILTERS: OrderedDict = OrderedDict()
+_ROW_FILTERS_LOCK = threading.Lock()
+
+def _compile_row_filter(buckets: tuple, min_orders: int, min_rating: float, min_commission: float, min_sale: float | None):
+    """Build fn(row) -> (kind, reason) from the active filters only; kind == "" means the row passes."""
+    checks = []
+    if buckets:
+        checks.append((lambda r: _price_in_buckets(r["_sale_num"], buckets), "price", "מחוץ לסינון מחיר"))
+    if min_orders:
+        checks.append((lambda r: r["_orders_num"] >= min_orders, "orders", f"פחות מ-{min_orders} הזמנות"))
+    if min_rating:
+        checks.append((lambda r: r["_rating_num"] is not None and r["_rating_num"] >= min_rating, "rating", f"דירוג נמוך מ-{min_rating}%"))
+    if min_commission:
+        checks.append((lambda r: (r["_commission_num"] or 0.0) >= min_commission, "commission", f"עמלה נמוכה מ-{min_commission:g}%"))
+    if min_sale is not None:
+        # in this bot logic: treat "free ship" threshold as min sale price
+        checks.append((lambda r: r["_sale_num"] is not None and r["_sale_num"] >= min_sale, "ship", "מתחת לסף משלוח חינם"))
+    checks.append((lambda r: bool(str(r.get("BuyLink") or "").strip()), "link", "אין קישור רכישה"))
+    checks = tuple(checks)
+
+    def _run(row: dict) -> tuple[str, str]:
+        row_numbers(row)
+        for ok, kind, reason in checks:
+            if not ok(row):
+                return kind, reason
+        return "", ""
+    return _run
+
+def row_filter(free_ship: bool = False):
+    """The compiled predicate for the current MIN_* / AE_PRICE_BUCKETS (free_ship adds the refill-only threshold)."""
+    sig = (tuple(AE_PRICE_BUCKETS or ()), int(MIN_ORDERS or 0), float(MIN_RATING or 0.0), float(MIN_COMMISSION or 0.0),
+           float(AE_FREE_SHIP_THRESHOLD_ILS) if free_ship else None)
+    with _ROW_FILTERS_LOCK:
+        fn = _ROW_FILTERS.get(sig)
+        if fn is None:
+            fn = _ROW_FILTERS[sig] = _compile_row_filter(*sig)
+            while len(_ROW_FILTERS) > 16:
+                _ROW_FILTERS.popitem(last=False)
+        else:
+            _ROW_FILTERS.move_to_end(sig)
+    return fn
+
 
 def normalize_row_keys(row):
     out = dict(row)
@@ -1245,7 +2160,7 @@ def normalize_row_keys(row):
             st = "raw"
     out["AIState"] = st
 
-    return out
+    return row_numbers(out)
 
 # =================== AI helpers ===================
 
@@ -1329,8 +2244,147 @@ def _needs_ai(row: dict) -> bool:
     # אם לא דורסים – משלימים רק אם חסר משהו
     return not (str(row.get("Opening","")).strip() and str(row.get("Title","")).strip() and str(row.get("Strengths","")).strip())
 
-def ai_enrich_rows(rows: list[dict], reason: str = "") -> tuple[int, str | None]:
-    """ממלא Opening/Title/Strengths בעברית שיווקית. עובד בבאצ'ים של GPT_BATCH_SIZE.
+def _ai_error_status(e: Exception) -> int | None:
+    st = getattr(e, "status_code", None)
+    if st is None:
+        st = getattr(getattr(e, "response", None), "status_code", None)
+    try:
+        return int(st) if st is not None else None
+    except Exception:
+        return None
+
+def _ai_retry_after(e: Exception) -> float | None:
+    try:
+        v = getattr(getattr(e, "response", None), "headers", {}).get("retry-after")
+        return float(v) if v else None
+    except Exception:
+        return None
+
+def _ai_call_batch(client, prompt: str, n_items: int) -> dict:
+    """One rate-limited structured call, retried with backoff on 429/5xx/timeouts."""
+    est_tokens = len(prompt) // 2 + 150 * max(1, n_items)
+    attempt = 0
+    while True:
+        _AI_REQ_BUCKET.acquire()
+        _AI_TOK_BUCKET.acquire(est_tokens)
+        try:
+            return _openai_structured_items(client, prompt)
+        except Exception as e:
+            st = _ai_error_status(e)
+            transient = st == 429 or (st is not None and st >= 500) or type(e).__name__ in ("APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError")
+            if not transient or attempt >= GPT_MAX_RETRIES:
+                raise
+            attempt += 1
+            wait = _ai_retry_after(e) or min(30.0, 1.5 * (2 ** attempt)) + random.random()
+            logging.warning(f"[AI] transient error (status={st}) retry {attempt}/{GPT_MAX_RETRIES} in {wait:.1f}s: {e}")
+            time.sleep(wait)
+
+# ---- AI copy cache ----
+_AI_CACHE_STATS = {"hits": 0, "misses": 0, "puts": 0}
+_AI_CACHE_SCHEMA_OK = False
+
+def _ai_cache_conn():
+    global _AI_CACHE_SCHEMA_OK
+    with _DB_LOCK:
+        conn = _db()
+        if not _AI_CACHE_SCHEMA_OK:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS ai_copy_cache (
+                    key       TEXT PRIMARY KEY,
+                    item_id   TEXT,
+                    opening   TEXT NOT NULL,
+                    title     TEXT NOT NULL,
+                    strengths TEXT NOT NULL,
+                    created   REAL NOT NULL,
+                    used      REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ai_copy_cache_used ON ai_copy_cache(used);
+            """)
+            _AI_CACHE_SCHEMA_OK = True
+        return conn
+
+def _ai_raw_title(r: dict) -> str:
+    return str(r.get("Title","") or r.get("product_title","") or "").strip()
+
+def _ai_cache_key(r: dict) -> str:
+    item_id = str(r.get("ItemId","") or "").strip()
+    # הכותרת המקורית: בשורה שכבר עברה AI, Title הוא הטקסט שה-AI כתב ולא יתאים למפתח הקודם
+    norm = _normalize_title_for_dedup(str(r.get("OrigTitle") or "").strip() or _ai_raw_title(r))
+    base = f"{item_id}|{norm}|{AI_PROMPT_VERSION}|{OPENAI_MODEL_EFFECTIVE}"
+    return hashlib.sha1(base.encode("utf-8", errors="ignore")).hexdigest()
+
+def _ai_cache_apply(rows: list[dict], reason: str = "") -> tuple[list[dict], int]:
+    """Fill rows from the cache. Returns (misses, hits)."""
+    if not AI_CACHE_ENABLED or not rows:
+        return rows, 0
+    now = time.time()
+    min_created = now - AI_CACHE_TTL_DAYS * 86400
+    misses = []
+    hits = 0
+    try:
+        with _DB_LOCK:
+            conn = _ai_cache_conn()
+            for r in rows:
+                key = _ai_cache_key(r)
+                rec = conn.execute("SELECT opening, title, strengths, created FROM ai_copy_cache WHERE key=?", (key,)).fetchone()
+                if not rec or float(rec["created"]) < min_created:
+                    misses.append(r)
+                    continue
+                conn.execute("UPDATE ai_copy_cache SET used=? WHERE key=?", (now, key))
+                raw_title = _ai_raw_title(r)
+                if raw_title and not str(r.get("OrigTitle","")).strip():
+                    r["OrigTitle"] = raw_title
+                r["Opening"] = rec["opening"]
+                r["Title"] = rec["title"]
+                r["Strengths"] = rec["strengths"]
+                r["AIState"] = "done"
+                maybe_convert_prices_after_ai(r, reason=f"ai_cache:{reason}")
+                hits += 1
+    except Exception as e:
+        logging.warning(f"[AI] cache lookup failed: {e}")
+        return rows, 0
+    _AI_CACHE_STATS["hits"] += hits
+    _AI_CACHE_STATS["misses"] += len(misses)
+    return misses, hits
+
+def _ai_cache_put(entries: list[tuple[str, dict]]):
+    """Store (cache_key, enriched_row) pairs, then enforce TTL and the LRU size bound."""
+    if not AI_CACHE_ENABLED or not entries:
+        return
+    now = time.time()
+    try:
+        with _DB_LOCK:
+            conn = _ai_cache_conn()
+            with _db_tx(conn):
+                for key, r in entries:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO ai_copy_cache(key, item_id, opening, title, strengths, created, used) VALUES (?,?,?,?,?,?,?)",
+                        (key, str(r.get("ItemId","") or "").strip(), r.get("Opening",""), r.get("Title",""), r.get("Strengths",""), now, now),
+                    )
+                conn.execute("DELETE FROM ai_copy_cache WHERE created < ?", (now - AI_CACHE_TTL_DAYS * 86400,))
+                extra = int(conn.execute("SELECT COUNT(*) FROM ai_copy_cache").fetchone()[0]) - max(1, AI_CACHE_MAX_ENTRIES)
+                if extra > 0:
+                    conn.execute("DELETE FROM ai_copy_cache WHERE key IN (SELECT key FROM ai_copy_cache ORDER BY used ASC LIMIT ?)", (extra,))
+        _AI_CACHE_STATS["puts"] += len(entries)
+    except Exception as e:
+        logging.warning(f"[AI] cache store failed: {e}")
+
+def ai_cache_status_text() -> str:
+    h, m = _AI_CACHE_STATS["hits"], _AI_CACHE_STATS["misses"]
+    rate = (100.0 * h / (h + m)) if (h + m) else 0.0
+    try:
+        with _DB_LOCK:
+            n = int(_ai_cache_conn().execute("SELECT COUNT(*) FROM ai_copy_cache").fetchone()[0])
+    except Exception:
+        n = -1
+    state = "ON" if AI_CACHE_ENABLED else "OFF"
+    return f"AI_CACHE={state} | entries={n}/{AI_CACHE_MAX_ENTRIES} | hits={h} misses={m} ({rate:.0f}%) | TTL={AI_CACHE_TTL_DAYS}d | prompt={AI_PROMPT_VERSION}"
+
+def ai_enrich_rows(rows: list[dict], reason: str = "", progress=None, cancel=None) -> tuple[int, str | None]:
+    """ממלא Opening/Title/Strengths בעברית שיווקית. עובד בבאצ'ים של GPT_BATCH_SIZE,
+    עד GPT_CONCURRENCY באצ'ים במקביל (עם מגבלת קצב GPT_RPM/GPT_TPM).
+    progress(done_batches, total_batches, updated) נקרא אחרי כל באצ' שהסתיים.
+    cancel (Event): באצ'ים שעוד לא התחילו מבוטלים; תוצאות שכבר חזרו נשמרות.
     מחזיר (כמה עודכנו, שגיאה אחרונה או None).
     """
     if not rows:
@@ -1352,7 +2406,17 @@ def ai_enrich_rows(rows: list[dict], reason: str = "") -> tuple[int, str | None]
     if not todo:
         return 0, None
 
-    # Batch
+    # מטמון: רק החטאות אמיתיות נשלחות ל-API
+    todo, cache_hits = _ai_cache_apply(todo, reason)
+    updated += cache_hits
+    if cache_hits:
+        logging.info(f"[AI] cache hits={cache_hits} misses={len(todo)} ({reason})")
+    if not todo:
+        return updated, None
+    cache_keys = {id(r): _ai_cache_key(r) for r in todo}
+
+    # Batch (prompts are built here; only the API calls run on the pool)
+    jobs = []
     for i in range(0, len(todo), max(1, GPT_BATCH_SIZE)):
         batch = todo[i:i+max(1, GPT_BATCH_SIZE)]
         payload_items = []
@@ -1379,44 +2443,90 @@ def ai_enrich_rows(rows: list[dict], reason: str = "") -> tuple[int, str | None]
             f"סיבה: {reason}\n"
             f"items: {json.dumps(payload_items, ensure_ascii=False)}"
         )
+        jobs.append((batch, prompt))
+
+    done_batches = 0
+    workers = max(1, min(GPT_CONCURRENCY, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai") as ex:
+        futs = {ex.submit(_ai_call_batch, client, prompt, len(batch)): batch for batch, prompt in jobs}
+        for f in as_completed(futs):
+            batch = futs[f]
+            done_batches += 1
+            if cancel is not None and cancel.is_set():
+                for ff in futs:
+                    ff.cancel()
+                last_err = "בוטל"
+            if f.cancelled():
+                continue
+            try:
+                data = f.result()
+                items = data.get("items", []) if isinstance(data, dict) else []
+                by_id = {str(it.get("item_id","")).strip(): it for it in items if isinstance(it, dict)}
+
+                # partial results are fine: merge whatever came back, by item_id
+                fresh = []
+                for r in batch:
+                    iid = str(r.get("ItemId","") or "").strip()
+                    it = by_id.get(iid)
+                    if not it:
+                        continue
+                    opening = str(it.get("opening","")).strip()
+                    title = str(it.get("title","")).strip()
+                    strengths = it.get("strengths", [])
+                    if not (opening and title and isinstance(strengths, list) and len(strengths)==3):
+                        continue
+                    r["Opening"] = opening
+                    r["Title"] = title
+                    r["Strengths"] = "\n".join([str(s).strip() for s in strengths])
+                    updated += 1
+                    r["AIState"] = "done"
+                    maybe_convert_prices_after_ai(r, reason=f"ai_enrich:{reason}")
+                    fresh.append((cache_keys[id(r)], r))
+                _ai_cache_put(fresh)
 
-        try:
-            # Prefer Responses API, fallback to Chat Completions automatically
-            data = _openai_structured_items(client, prompt)
-            items = data.get("items", []) if isinstance(data, dict) else []
-            by_id = {str(it.get("item_id","")).strip(): it for it in items if isinstance(it, dict)}
-
-            for r in batch:
-                iid = str(r.get("ItemId","") or "").strip()
-                it = by_id.get(iid)
-                if not it:
-                    continue
-                opening = str(it.get("opening","")).strip()
-                title = str(it.get("title","")).strip()
-                strengths = it.get("strengths", [])
-                if not (opening and title and isinstance(strengths, list) and len(strengths)==3):
-                    continue
-                r["Opening"] = opening
-                r["Title"] = title
-                r["Strengths"] = "\n".join([str(s).strip() for s in strengths])
-                updated += 1
-                r["AIState"] = "done"
-                maybe_convert_prices_after_ai(r, reason=f"ai_enrich:{reason}")
+            except Exception as e:
+                last_err = str(e)
 
-        except Exception as e:
-            last_err = str(e)
+            if progress:
+                try:
+                    progress(done_batches, len(jobs), updated)
+                except Exception:
+                    pass
 
     return updated, last_err
 
 
+# parsed CSV cache: path -> ((mtime_ns, size, inode), rows). נטען מחדש רק כשהקובץ השתנה בדיסק.
+_CSV_CACHE: dict[str, tuple] = {}
+_CSV_CACHE_LOCK = threading.Lock()
+
+def _file_sig(path: str):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except Exception:
+        return None
+
 def read_products(path):
-    if not os.path.exists(path):
+    sig = _file_sig(path)
+    if sig is None:
         return []
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        return [normalize_row_keys(r) for r in reader]
+    with _CSV_CACHE_LOCK:
+        hit = _CSV_CACHE.get(path)
+    if hit and hit[0] == sig:
+        rows = hit[1]
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            rows = [normalize_row_keys(r) for r in reader]
+        with _CSV_CACHE_LOCK:
+            _CSV_CACHE[path] = (sig, rows)
+    # callers mutate rows -> hand out copies
+    return [dict(r) for r in rows]
 
 def write_products(path, rows):
+    with _CSV_CACHE_LOCK:
+        _CSV_CACHE.pop(path, None)
     base_headers = [
         "ItemId","ImageURL","Title","OriginalPrice","SalePrice","Discount",
         "Rating","Orders","BuyLink","CouponCode","Opening","Video Url","Strengths","AIState"
@@ -1426,36 +2536,652 @@ def write_products(path, rows):
             w = csv.DictWriter(f, fieldnames=base_headers)
             w.writeheader()
         return
-    headers = list(dict.fromkeys(base_headers + [k for r in rows for k in r.keys()]))
+    # internal keys (e.g. _qkey) are never exported
+    headers = list(dict.fromkeys(base_headers + [k for r in rows for k in r.keys() if not str(k).startswith("_")]))
     with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=headers)
+        w = csv.DictWriter(f, fieldnames=headers, extrasaction="ignore")
         w.writeheader()
         for r in rows:
             w.writerow(r)
 
 def init_pending():
-    if not os.path.exists(PENDING_CSV):
-        src = read_products(DATA_CSV)
-        write_products(PENDING_CSV, src)
-
+    # התור יושב ב-SQLite; pending.csv (או workfile.csv) מיובא פעם אחת בלבד
+    _queue_conn()
+
+
+def _ai_state_bucket(st) -> str:
+    """Map an AIState value to one of: raw / approved / done / rejected / other."""
+    st = str(st or "raw").strip().lower()
+    if st in ("raw", "new", "pending"):
+        return "raw"
+    if st in ("approved", "approve", "to_ai"):
+        return "approved"
+    if st in ("done", "ready", "ai_done"):
+        return "done"
+    if st in ("rejected", "reject"):
+        return "rejected"
+    return "other"
 
 def _count_ai_states(rows: list[dict]) -> dict:
     """Count AI workflow states inside pending queue rows."""
     counts = {"raw": 0, "approved": 0, "done": 0, "rejected": 0, "other": 0}
     for r in rows or []:
-        st = str((r or {}).get("AIState") or "raw").strip().lower()
-        if st in ("raw", "new", "pending"):
-            counts["raw"] += 1
-        elif st in ("approved", "approve", "to_ai"):
-            counts["approved"] += 1
-        elif st in ("done", "ready", "ai_done"):
-            counts["done"] += 1
-        elif st in ("rejected", "reject"):
-            counts["rejected"] += 1
-        else:
-            counts["other"] += 1
+        counts[_ai_state_bucket((r or {}).get("AIState"))] += 1
     return counts
 
+def _row_is_ready(r: dict) -> bool:
+    """✅ SAFETY: only items that passed AI may be broadcast."""
+    st = str((r or {}).get("AIState", "") or "").strip().lower()
+    if st == "done":
+        return True
+    # fallback: if AI filled the fields but AIState wasn't written
+    if str((r or {}).get("Opening", "")).strip() and str((r or {}).get("Title", "")).strip() and str((r or {}).get("Strengths", "")).strip():
+        return True
+    return False
+
+# ========= QUEUE STORE (SQLite) =========
+# התור נשמר בטבלת queue: שורה לכל מוצר, מפתח ייחודי לפי _key_of_row, סדר לפי seq.
+# שליפת "הבא המוכן" היא חיפוש באינדקס (ready, seq) ועדכון/מחיקה נוגעים בשורה אחת בלבד —
+# בלי לקרוא ולכתוב מחדש את כל pending.csv. pending.csv נשאר כקובץ ייצוא למנהלים (/export_queue).
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    seq     INTEGER PRIMARY KEY AUTOINCREMENT,
+    qkey    TEXT NOT NULL UNIQUE,
+    state   TEXT NOT NULL DEFAULT 'raw',
+    ready   INTEGER NOT NULL DEFAULT 0,
+    row     TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queue_ready_seq ON queue(ready, seq);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+"""
+_QUEUE_SCHEMA_OK = False
+
+def _queue_key(r: dict) -> str:
+    return _key_of_row(r)[0]
+
+def _queue_row_json(r: dict) -> str:
+    return json.dumps({k: v for k, v in (r or {}).items() if not str(k).startswith("_")}, ensure_ascii=False)
+
+def _queue_row_from_db(rec) -> dict:
+    try:
+        r = json.loads(rec["row"]) or {}
+    except Exception:
+        r = {}
+    r["_qkey"] = rec["qkey"]
+    return r
+
+def _queue_insert(conn, r: dict) -> bool:
+    k = _queue_key(r)
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO queue(qkey, state, ready, row, updated) VALUES (?,?,?,?,?)",
+        (k, _ai_state_bucket(r.get("AIState")), 1 if _row_is_ready(r) else 0, _queue_row_json(r), time.time()),
+    )
+    if cur.rowcount:
+        r["_qkey"] = k
+        return True
+    return False
+
+def _queue_import_once(conn):
+    """One-time import of the legacy pending.csv (or workfile.csv when there is no queue file yet)."""
+    if conn.execute("SELECT v FROM meta WHERE k='queue_imported'").fetchone():
+        return
+    src = PENDING_CSV if os.path.exists(PENDING_CSV) else DATA_CSV
+    try:
+        rows = read_products(src)
+    except Exception as e:
+        log_warn(f"[QUEUE] import from {src} failed: {e}")
+        rows = []
+    with _db_tx(conn):
+        n = sum(1 for r in rows if _queue_insert(conn, r))
+        conn.execute("INSERT OR REPLACE INTO meta(k, v) VALUES ('queue_imported', ?)", (f"{int(time.time())}:{os.path.basename(src)}:{n}",))
+    log_info(f"[QUEUE] imported {n}/{len(rows)} rows from {os.path.basename(src)} into {os.path.basename(BOT_DB_PATH)}")
+
+def _queue_conn():
+    """Shared DB connection with the queue schema in place."""
+    global _QUEUE_SCHEMA_OK
+    with _DB_LOCK:
+        conn = _db()
+        if not _QUEUE_SCHEMA_OK:
+            conn.executescript(_QUEUE_SCHEMA)
+            _queue_import_once(conn)
+            _QUEUE_SCHEMA_OK = True
+        return conn
+
+# ---- queue read cache ----
+# השורות המפוענחות של התור נשמרות בזיכרון. כתיבות מהתהליך הזה מעדכנות את המטמון ישירות (write-through),
+# ושינוי ממקור חיצוני (חיבור/תהליך אחר) מזוהה דרך PRAGMA data_version וגורם לטעינה מחדש.
+# כך הלולאות (auto_post_loop / refill_daemon / מסכי סטטוס) לא מפענחות את כל התור בכל סבב.
+_QCACHE: dict = {"rows": None, "by_key": {}, "data_version": None, "counts": None, "gen": 0}
+
+def _qcache_touch():
+    """Mark cached rows as changed: drops the counts and bumps 'gen' for derived indexes."""
+    _QCACHE["counts"] = None
+    _QCACHE["gen"] += 1
+
+def _qcache_rows() -> list[dict]:
+    """Cached queue rows (shared objects — copy before mutating). Caller must hold _DB_LOCK."""
+    conn = _queue_conn()
+    dv = conn.execute("PRAGMA data_version").fetchone()[0]
+    if _QCACHE["rows"] is None or dv != _QCACHE["data_version"]:
+        recs = conn.execute("SELECT qkey, row FROM queue ORDER BY seq").fetchall()
+        rows = [_queue_row_from_db(rec) for rec in recs]
+        _QCACHE.update(rows=rows, by_key={r["_qkey"]: r for r in rows}, data_version=dv)
+        _qcache_touch()
+        _qcols_invalidate()
+    return _QCACHE["rows"]
+
+def _qcache_reset():
+    _QCACHE.update(rows=None, by_key={}, data_version=None)
+    _qcache_touch()
+    _qcols_invalidate()
+
+def queue_len() -> int:
+    with _DB_LOCK:
+        return len(_qcache_rows())
+
+def queue_rows() -> list[dict]:
+    """All queued rows in queue order (each carries its store key in '_qkey')."""
+    with _DB_LOCK:
+        return [dict(r) for r in _qcache_rows()]
+
+def queue_keys() -> set:
+    """Keys of queued rows, in the same shape as _key_of_row()."""
+    with _DB_LOCK:
+        _qcache_rows()
+        return {(k,) for k in _QCACHE["by_key"]}
+
+def queue_state_counts() -> dict:
+    with _DB_LOCK:
+        rows = _qcache_rows()
+        if _QCACHE["counts"] is None:
+            _QCACHE["counts"] = _count_ai_states(rows)
+        return dict(_QCACHE["counts"])
+
+def queue_next_ready() -> dict | None:
+    """First AI-ready row in queue order."""
+    rows = queue_peek_ready(1)
+    return rows[0] if rows else None
+
+def queue_peek_ready(n: int, where=None) -> list[dict]:
+    """First n AI-ready rows in queue order (copies), optionally only those matching where(row).
+
+    The ready keys come from the (ready, seq) index in windows; rows are taken from the read cache.
+    """
+    out = []
+    if n <= 0:
+        return out
+    window = n if where is None else max(n, 32)
+    with _DB_LOCK:
+        conn = _queue_conn()
+        _qcache_rows()
+        by_key = _QCACHE["by_key"]
+        offset = 0
+        while len(out) < n:
+            keys = [rec[0] for rec in conn.execute(
+                "SELECT qkey FROM queue WHERE ready=1 ORDER BY seq LIMIT ? OFFSET ?", (window, offset))]
+            for k in keys:
+                r = by_key.get(k)
+                if r is not None and (where is None or where(r)):
+                    out.append(dict(r))
+                    if len(out) >= n:
+                        break
+            if len(keys) < window:
+                break
+            offset += window
+    return out
+
+def queue_add_rows(rows: list[dict]) -> tuple[int, int, int]:
+    """Append rows that are not queued yet. Returns (added, dups, total_after)."""
+    added = 0
+    dups = 0
+    with _DB_LOCK:
+        conn = _queue_conn()
+        cached = _qcache_rows()
+        if rows:
+            inserted = []
+            try:
+                with _db_tx(conn):
+                    for r in rows:
+                        if _queue_insert(conn, r):
+                            inserted.append(r)
+                        else:
+                            dups += 1
+            except Exception:
+                _qcache_reset()
+                raise
+            added = len(inserted)
+            for r in inserted:
+                rr = {k: v for k, v in r.items() if not str(k).startswith("_")}
+                rr["_qkey"] = r["_qkey"]
+                cached.append(rr)
+                _QCACHE["by_key"][rr["_qkey"]] = rr
+                _qcols_put(rr)
+                catalog_note(rr)
+            if inserted:
+                _qcache_touch()
+                links_prefetch_async(inserted)
+                if any(_row_is_ready(r) for r in inserted):
+                    DELAY_EVENT.set()
+        total = len(cached)
+    return added, dups, total
+
+def queue_update_rows(rows: list[dict]) -> int:
+    """Write back changed rows in place (by '_qkey', else by _key_of_row). Missing keys are ignored."""
+    n = 0
+    with _DB_LOCK:
+        conn = _queue_conn()
+        _qcache_rows()
+        by_key = _QCACHE["by_key"]
+        try:
+            with _db_tx(conn):
+                for r in rows or []:
+                    k = r.get("_qkey") or _queue_key(r)
+                    cur = conn.execute(
+                        "UPDATE queue SET state=?, ready=?, row=?, updated=? WHERE qkey=?",
+                        (_ai_state_bucket(r.get("AIState")), 1 if _row_is_ready(r) else 0, _queue_row_json(r), time.time(), k),
+                    )
+                    if cur.rowcount:
+                        n += cur.rowcount
+                        if _row_is_ready(r):
+                            DELAY_EVENT.set()
+                        cached = by_key.get(k)
+                        if cached is not None:
+                            cached.clear()
+                            cached.update({kk: v for kk, v in r.items() if not str(kk).startswith("_")})
+                            cached["_qkey"] = k
+                            _qcols_put(cached)
+                        catalog_note(r)
+        except Exception:
+            _qcache_reset()
+            raise
+        if n:
+            _qcache_touch()
+    return n
+
+def queue_remove_keys(keys) -> int:
+    keys = {k for k in (keys or []) if k}
+    if not keys:
+        return 0
+    with _DB_LOCK:
+        conn = _queue_conn()
+        cached = _qcache_rows()
+        try:
+            with _db_tx(conn):
+                n = sum(conn.execute("DELETE FROM queue WHERE qkey=?", (k,)).rowcount for k in keys)
+        except Exception:
+            _qcache_reset()
+            raise
+        if n:
+            cached[:] = [r for r in cached if r["_qkey"] not in keys]
+            for k in keys:
+                _QCACHE["by_key"].pop(k, None)
+                _qcols_drop(k)
+            _qcache_touch()
+        return n
+
+def queue_remove(qkey: str) -> bool:
+    return queue_remove_keys([qkey]) > 0
+
+def queue_replace_all(rows: list[dict]) -> int:
+    """Reset the queue to exactly these rows (dups dropped). Returns the new length."""
+    with _DB_LOCK:
+        conn = _queue_conn()
+        try:
+            with _db_tx(conn):
+                conn.execute("DELETE FROM queue")
+                for r in rows or []:
+                    _queue_insert(conn, r)
+        finally:
+            _qcache_reset()
+        return len(_qcache_rows())
+
+def queue_export_csv(path: str = PENDING_CSV) -> int:
+    """Dump the queue (in order) to a CSV file for admins. Returns row count."""
+    rows = queue_rows()
+    write_products(path, rows)
+    return len(rows)
+
+# ========= QUEUE COLUMNS =========
+# תמונת מצב עמודתית של התור לסטטיסטיקות מנהל: עמודה (array) לכל שדה מספרי + קודי מצב/קטגוריה,
+# סלוט לכל שורה לפי _qkey. הוספה/עדכון/מחיקה בתור נוגעים רק בסלוט של השורה (מאותן נקודות write-through
+# של _QCACHE); טעינה מחדש של המטמון בונה את העמודות מחדש בעצלתיים. עם numpy החישובים וקטוריים,
+# ובלעדיו — מעבר יחיד על המערכים, עדיין בלי לפענח מחרוזות.
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+_QCOL_STATES = ("raw", "approved", "done", "rejected", "other")
+_QCOL_STATE_CODE = {s: i for i, s in enumerate(_QCOL_STATES)}
+_QCOL_DEAD = -1
+QUEUE_DASH_PRICE_BUCKETS = os.getenv("QUEUE_DASH_PRICE_BUCKETS", "0-10,10-25,25-50,50-100,100+")
+QUEUE_DASH_TOP_CATEGORIES = max(1, _env_int("QUEUE_DASH_TOP_CATEGORIES", 8))
+
+def _qcols_empty() -> dict:
+    return {
+        "valid": False,
+        "slot": {},  # qkey -> index
+        "free": [],
+        "sale": array("d"), "orders": array("q"), "rating": array("d"), "comm": array("d"),
+        "state": array("b"), "ready": array("b"), "cat": array("i"),
+        "cat_names": [], "cat_code": {},
+    }
+
+_QCOLS: dict = _qcols_empty()
+
+def _qcols_invalidate():
+    _QCOLS["valid"] = False
+
+def _qcols_put(r: dict):
+    """Write one queue row into its slot (new rows take a free slot or append). Caller holds _DB_LOCK."""
+    c = _QCOLS
+    if not c["valid"]:
+        return
+    row_numbers(r)
+    cat = str(r.get("CategoryName") or r.get("CategoryId") or "").strip()
+    code = c["cat_code"].get(cat)
+    if code is None:
+        code = c["cat_code"][cat] = len(c["cat_names"])
+        c["cat_names"].append(cat)
+    nan = float("nan")
+    vals = (
+        ("sale", nan if r["_sale_num"] is None else float(r["_sale_num"])),
+        ("orders", int(r["_orders_num"] or 0)),
+        ("rating", nan if r["_rating_num"] is None else float(r["_rating_num"])),
+        ("comm", nan if r["_commission_num"] is None else float(r["_commission_num"])),
+        ("state", _QCOL_STATE_CODE[_ai_state_bucket(r.get("AIState"))]),
+        ("ready", 1 if _row_is_ready(r) else 0),
+        ("cat", code),
+    )
+    i = c["slot"].get(r["_qkey"])
+    if i is None and c["free"]:
+        i = c["slot"][r["_qkey"]] = c["free"].pop()
+    if i is None:
+        c["slot"][r["_qkey"]] = len(c["state"])
+        for name, v in vals:
+            c[name].append(v)
+    else:
+        for name, v in vals:
+            c[name][i] = v
+
+def _qcols_drop(qkey: str):
+    c = _QCOLS
+    if not c["valid"]:
+        return
+    i = c["slot"].pop(qkey, None)
+    if i is not None:
+        c["state"][i] = _QCOL_DEAD
+        c["free"].append(i)
+
+def _qcols() -> dict:
+    """Up-to-date columns (rebuilt after a cache reload). Caller holds _DB_LOCK."""
+    rows = _qcache_rows()
+    if not _QCOLS["valid"]:
+        _QCOLS.clear()
+        _QCOLS.update(_qcols_empty())
+        _QCOLS["valid"] = True
+        for r in rows:
+            _qcols_put(r)
+    return _QCOLS
+
+def queue_analytics(price_buckets=None) -> dict:
+    """Aggregates over the queue columns: states, ready count, per-category mix and price buckets."""
+    buckets = list(price_buckets if price_buckets is not None else _parse_price_buckets(QUEUE_DASH_PRICE_BUCKETS))
+    with _DB_LOCK:
+        c = _qcols()
+        cols = {k: array(c[k].typecode, c[k]) for k in ("sale", "orders", "rating", "comm", "state", "ready", "cat")}
+        names = list(c["cat_names"])
+    ncat = len(names)
+    out = {"states": dict.fromkeys(_QCOL_STATES, 0), "buckets": [], "cats": []}
+
+    if np is not None:
+        a = {k: np.frombuffer(v, dtype=v.typecode) for k, v in cols.items()}
+        live = a["state"] >= 0
+        ready = live & (a["ready"] == 1)
+        sale, comm, rating = a["sale"], a["comm"], a["rating"]
+        for s, n in zip(_QCOL_STATES, np.bincount(a["state"][live], minlength=len(_QCOL_STATES))):
+            out["states"][s] = int(n)
+        has_comm = live & ~np.isnan(comm)
+        cat_total = np.bincount(a["cat"][live], minlength=ncat)
+        cat_ready = np.bincount(a["cat"][ready], minlength=ncat)
+        cat_comm_n = np.bincount(a["cat"][has_comm], minlength=ncat)
+        cat_comm_sum = np.bincount(a["cat"][has_comm], weights=comm[has_comm], minlength=ncat)
+        for mn, mx in buckets:
+            m = ready & (sale >= mn) & ((sale < mx) if mx is not None else True)
+            out["buckets"].append((mn, mx, int(m.sum())))
+        total, n_ready = int(live.sum()), int(ready.sum())
+        avg = lambda col, m: float(col[m].mean()) if m.any() else None
+        out["avg_comm"] = avg(comm, has_comm)
+        out["avg_comm_ready"] = avg(comm, ready & ~np.isnan(comm))
+        out["avg_sale_ready"] = avg(sale, ready & ~np.isnan(sale))
+        out["avg_rating"] = avg(rating, live & ~np.isnan(rating))
+        out["avg_orders"] = avg(a["orders"], live)
+        cats = zip(cat_total.tolist(), cat_ready.tolist(), cat_comm_sum.tolist(), cat_comm_n.tolist())
+    else:
+        cat_total, cat_ready, cat_comm_sum, cat_comm_n = [0] * ncat, [0] * ncat, [0.0] * ncat, [0] * ncat
+        bucket_n = [0] * len(buckets)
+        acc = {k: [0.0, 0] for k in ("avg_comm", "avg_comm_ready", "avg_sale_ready", "avg_rating", "avg_orders")}
+        total = n_ready = 0
+        for sale, orders, rating, comm, st, rd, cat in zip(*(cols[k] for k in ("sale", "orders", "rating", "comm", "state", "ready", "cat"))):
+            if st < 0:
+                continue
+            total += 1
+            out["states"][_QCOL_STATES[st]] += 1
+            cat_total[cat] += 1
+            acc["avg_orders"][0] += orders; acc["avg_orders"][1] += 1
+            if rating == rating:
+                acc["avg_rating"][0] += rating; acc["avg_rating"][1] += 1
+            if comm == comm:  # NaN != NaN
+                cat_comm_sum[cat] += comm
+                cat_comm_n[cat] += 1
+                acc["avg_comm"][0] += comm; acc["avg_comm"][1] += 1
+            if rd:
+                n_ready += 1
+                cat_ready[cat] += 1
+                if comm == comm:
+                    acc["avg_comm_ready"][0] += comm; acc["avg_comm_ready"][1] += 1
+                if sale == sale:
+                    acc["avg_sale_ready"][0] += sale; acc["avg_sale_ready"][1] += 1
+                    for j, (mn, mx) in enumerate(buckets):
+                        if sale >= mn and (mx is None or sale < mx):
+                            bucket_n[j] += 1
+        for k, (s, n) in acc.items():
+            out[k] = s / n if n else None
+        out["buckets"] = [(mn, mx, n) for (mn, mx), n in zip(buckets, bucket_n)]
+        cats = zip(cat_total, cat_ready, cat_comm_sum, cat_comm_n)
+
+    out["total"], out["ready"] = total, n_ready
+    out["cats"] = sorted(
+        ({"name": names[i], "total": int(t), "ready": int(rd), "avg_comm": (cs / cn) if cn else None}
+         for i, (t, rd, cs, cn) in enumerate(cats) if t),
+        key=lambda x: (-x["ready"], -x["total"], x["name"]),
+    )
+    return out
+
+def queue_dashboard_text() -> str:
+    """HTML block for /queue: ready mix per category and price bucket, queue averages."""
+    a = queue_analytics()
+    if not a["total"]:
+        return ""
+    fmt = lambda v, suffix="": "—" if v is None else f"{v:.1f}{suffix}"
+    lines = [
+        f"📊 <b>ניתוח התור</b> (מוכנים {a['ready']}/{a['total']})",
+        f"💰 עמלה ממוצעת: {fmt(a['avg_comm'], '%')} · במוכנים: {fmt(a['avg_comm_ready'], '%')}",
+        f"🏷️ מחיר ממוצע (מוכנים): {fmt(a['avg_sale_ready'])} · ⭐ דירוג ממוצע: {fmt(a['avg_rating'], '%')} · 📦 הזמנות ממוצע: {fmt(a['avg_orders'])}",
+    ]
+    if a["buckets"]:
+        parts = [f"{mn:g}{'+' if mx is None else f'-{mx:g}'}: {n}" for mn, mx, n in a["buckets"]]
+        lines.append("💵 מוכנים לפי טווח מחיר: " + " · ".join(parts))
+    lines.append("🗂️ לפי קטגוריה (מוכנים/סה״כ · עמלה):")
+    for x in a["cats"][:QUEUE_DASH_TOP_CATEGORIES]:
+        lines.append(f"• {html.escape(x['name'] or 'ללא קטגוריה')}: {x['ready']}/{x['total']} · {fmt(x['avg_comm'], '%')}")
+    rest = a["cats"][QUEUE_DASH_TOP_CATEGORIES:]
+    if rest:
+        lines.append(f"• ועוד {len(rest)} קטגוריות ({sum(x['total'] for x in rest)} פריטים)")
+    return "\n".join(lines)
+
+# ========= LOCAL CATALOG =========
+# כל מוצר שהבוט ראה (מילוי, חיפוש ידני, העלאת CSV, העשרת AI) נשמר בטבלת catalog ב-bot.db עם אינדקס
+# FTS5 על הכותרת, הכותרת המקורית, שם הקטגוריה והטקסט העברי של ה-AI (LIKE כשאין FTS5 ב-sqlite).
+# הכתיבה מצטברת בזיכרון ונכתבת בטרנזקציה אחת ברקע; חיפוש ידני מציג קודם תוצאות מקומיות.
+AE_CATALOG_ENABLED = env_bool("AE_CATALOG_ENABLED", True)
+AE_CATALOG_MAX_ROWS = max(1000, _env_int("AE_CATALOG_MAX_ROWS", 50000))
+MS_LOCAL_RESULTS = max(0, _env_int("MS_LOCAL_RESULTS", 10))
+CATALOG_FLUSH_SECONDS = 5.0
+CATALOG_FLUSH_ROWS = 200
+
+_CATALOG_SCHEMA_OK = False
+_CATALOG_FTS = False
+_CATALOG_BUF: dict = {}  # item_id -> row (האחרון מנצח)
+_CATALOG_BUF_LOCK = threading.Lock()
+_CATALOG_LAST_FLUSH = 0.0
+_CATALOG_FLUSH_PENDING = False
+_CATALOG_WRITES = 0
+_CATALOG_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog")
+
+def _catalog_conn():
+    global _CATALOG_SCHEMA_OK, _CATALOG_FTS
+    with _DB_LOCK:
+        conn = _db()
+        if not _CATALOG_SCHEMA_OK:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS catalog (
+                    id         INTEGER PRIMARY KEY,
+                    item_id    TEXT NOT NULL UNIQUE,
+                    title      TEXT NOT NULL DEFAULT '',
+                    orig_title TEXT NOT NULL DEFAULT '',
+                    cat        TEXT NOT NULL DEFAULT '',
+                    ai_text    TEXT NOT NULL DEFAULT '',
+                    row        TEXT NOT NULL,
+                    ts         REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS catalog_ts ON catalog(ts)")
+            try:
+                conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5("
+                    "title, orig_title, cat, ai_text, tokenize='unicode61 remove_diacritics 2')"  # rowid = catalog.id
+                )
+                _CATALOG_FTS = True
+            except sqlite3.OperationalError as e:
+                log_warn(f"[CATALOG] FTS5 unavailable ({e}); using LIKE search")
+            _CATALOG_SCHEMA_OK = True
+        return conn
+
+def _catalog_fields(row: dict) -> tuple[str, str, str, str]:
+    orig = str(row.get("OrigTitle") or "").strip()
+    title = str(row.get("Title") or "").strip()
+    cat = str(row.get("CategoryName") or "").strip()
+    ai_text = " ".join(str(row.get(k) or "").strip() for k in ("Opening", "Strengths") if str(row.get(k) or "").strip())
+    return title, orig, cat, ai_text
+
+def catalog_note(row: dict):
+    """Remember a product row for local search (buffered; flushed in the background)."""
+    if not AE_CATALOG_ENABLED or not row:
+        return
+    item_id = str(row.get("ItemId") or "").strip() or _extract_item_id_from_url(row.get("BuyLink") or "")
+    if not item_id:
+        return
+    global _CATALOG_FLUSH_PENDING
+    with _CATALOG_BUF_LOCK:
+        _CATALOG_BUF[item_id] = {k: v for k, v in row.items() if not str(k).startswith("_")}
+        due = not _CATALOG_FLUSH_PENDING and (
+            len(_CATALOG_BUF) >= CATALOG_FLUSH_ROWS or time.time() - _CATALOG_LAST_FLUSH >= CATALOG_FLUSH_SECONDS)
+        if due:
+            _CATALOG_FLUSH_PENDING = True
+    if due:
+        _CATALOG_POOL.submit(_catalog_flush)
+
+def _catalog_flush():
+    global _CATALOG_LAST_FLUSH, _CATALOG_FLUSH_PENDING, _CATALOG_WRITES
+    with _CATALOG_BUF_LOCK:
+        buf = dict(_CATALOG_BUF)
+        _CATALOG_BUF.clear()
+        _CATALOG_LAST_FLUSH = time.time()
+        _CATALOG_FLUSH_PENDING = False
+    if not buf:
+        return
+    now = time.time()
+    try:
+        with _db_tx(_catalog_conn()) as conn:
+            for item_id, row in buf.items():
+                title, orig, cat, ai_text = _catalog_fields(row)
+                conn.execute(
+                    "INSERT INTO catalog(item_id, title, orig_title, cat, ai_text, row, ts) VALUES (?,?,?,?,?,?,?) "
+                    "ON CONFLICT(item_id) DO UPDATE SET title=excluded.title, "
+                    "orig_title=CASE WHEN excluded.orig_title!='' THEN excluded.orig_title ELSE catalog.orig_title END, "
+                    "cat=CASE WHEN excluded.cat!='' THEN excluded.cat ELSE catalog.cat END, "
+                    "ai_text=CASE WHEN excluded.ai_text!='' THEN excluded.ai_text ELSE catalog.ai_text END, "
+                    "row=excluded.row, ts=excluded.ts",
+                    (item_id, title, orig, cat, ai_text, json.dumps(row, ensure_ascii=False), now),
+                )
+                if _CATALOG_FTS:
+                    rec = conn.execute("SELECT id, title, orig_title, cat, ai_text FROM catalog WHERE item_id=?", (item_id,)).fetchone()
+                    conn.execute("DELETE FROM catalog_fts WHERE rowid=?", (rec["id"],))
+                    conn.execute("INSERT INTO catalog_fts(rowid, title, orig_title, cat, ai_text) VALUES (?,?,?,?,?)",
+                                 (rec["id"], rec["title"], rec["orig_title"], rec["cat"], rec["ai_text"]))
+            _CATALOG_WRITES += len(buf)
+            if _CATALOG_WRITES >= 1000:
+                _CATALOG_WRITES = 0
+                _catalog_prune(conn)
+    except Exception as e:
+        log_warn(f"[CATALOG] flush of {len(buf)} rows failed: {e}")
+
+def _catalog_prune(conn):
+    """Drop the oldest rows above AE_CATALOG_MAX_ROWS. Caller holds the transaction."""
+    extra = conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0] - AE_CATALOG_MAX_ROWS
+    if extra <= 0:
+        return
+    old = [(r[0],) for r in conn.execute("SELECT id FROM catalog ORDER BY ts LIMIT ?", (extra,))]
+    conn.executemany("DELETE FROM catalog WHERE id=?", old)
+    if _CATALOG_FTS:
+        conn.executemany("DELETE FROM catalog_fts WHERE rowid=?", old)
+    log_info(f"[CATALOG] pruned {len(old)} old rows")
+
+def catalog_search(queries, limit: int = 30) -> list[dict]:
+    """Catalog rows matching any query variant (all of its meaningful tokens, prefix match)."""
+    if not AE_CATALOG_ENABLED:
+        return []
+    if isinstance(queries, str):
+        queries = [queries]
+    groups = []
+    for q in queries or []:
+        toks = [_ms_norm_tok(x) for x in re.split(r"[^0-9a-zA-Zא-ת]+", str(q or "").lower()) if x]
+        toks = list(dict.fromkeys(t for t in toks if len(t) >= 2 and t not in _MS_STOP))
+        if toks and toks not in groups:
+            groups.append(toks)
+    if not groups:
+        return []
+    _catalog_flush()  # מה שנראה הרגע (למשל בעמוד הקודם) כבר בר-חיפוש
+    with _DB_LOCK:
+        conn = _catalog_conn()
+        if _CATALOG_FTS:
+            match = " OR ".join("(" + " AND ".join(f'"{t}"*' for t in toks) + ")" for toks in groups)
+            recs = conn.execute(
+                "SELECT c.row FROM catalog_fts JOIN catalog c ON c.id=catalog_fts.rowid "
+                "WHERE catalog_fts MATCH ? ORDER BY bm25(catalog_fts) LIMIT ?", (match, int(limit)),
+            ).fetchall()
+        else:
+            doc = "(c.title || ' ' || c.orig_title || ' ' || c.cat || ' ' || c.ai_text)"
+            where = " OR ".join("(" + " AND ".join(f"{doc} LIKE ?" for _ in toks) + ")" for toks in groups)
+            args = [f"%{t}%" for toks in groups for t in toks]
+            recs = conn.execute(f"SELECT c.row FROM catalog c WHERE {where} ORDER BY c.ts DESC LIMIT ?", (*args, int(limit))).fetchall()
+    out = []
+    for rec in recs:
+        try:
+            out.append(json.loads(rec[0]) or {})
+        except Exception:
+            continue
+    return out
+
+def catalog_stats() -> dict:
+    with _DB_LOCK:
+        n = _catalog_conn().execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+    return {"rows": n, "fts": _CATALOG_FTS, "buffered": len(_CATALOG_BUF)}
+
+atexit.register(_catalog_flush)
+
 # ---- PRESET HELPERS ----
 def _save_preset(path: str, value):
     try:
@@ -1524,23 +3250,31 @@ def check_and_probe_target(target):
         return False, f"❌ יעד לא תקין: {e}"
 
 # ========= BROADCAST WINDOW =========
+# חלונות השידור במצב מתוזמן, לפי יום בשבוע (Mon=0 ... Sun=6): (התחלה, סוף) כולל.
+# should_broadcast והמתזמן (_target_next_time) נגזרים שניהם מהטבלה הזו.
+BROADCAST_WINDOWS = {
+    6: (dtime(6, 0), dtime(23, 59)),
+    0: (dtime(6, 0), dtime(23, 59)),
+    1: (dtime(6, 0), dtime(23, 59)),
+    2: (dtime(6, 0), dtime(23, 59)),
+    3: (dtime(6, 0), dtime(23, 59)),
+    4: (dtime(6, 0), dtime(17, 59)),   # שישי — עד כניסת שבת
+    5: (dtime(20, 15), dtime(23, 59)),  # מוצאי שבת
+}
+
 def should_broadcast(now: datetime | None = None) -> bool:
     if now is None:
         now = _now_il()
     else:
         now = now.astimezone(IL_TZ)
-    wd = now.weekday()  # Mon=0 ... Sun=6
-    t = now.time()
-    if wd in (6, 0, 1, 2, 3):
-        return dtime(6, 0) <= t <= dtime(23, 59)
-    if wd == 4:
-        return dtime(6, 0) <= t <= dtime(17, 59)
-    if wd == 5:
-        return dtime(20, 15) <= t <= dtime(23, 59)
-    return False
+    window = BROADCAST_WINDOWS.get(now.weekday())
+    return bool(window) and window[0] <= now.time() <= window[1]
 
 def is_schedule_enforced() -> bool:
-    return os.path.exists(SCHEDULE_FLAG_FILE)
+    v = _FLAG_CACHE.get(SCHEDULE_FLAG_FILE)
+    if v is None:
+        v = _FLAG_CACHE[SCHEDULE_FLAG_FILE] = os.path.exists(SCHEDULE_FLAG_FILE)
+    return v
 
 def set_schedule_enforced(enabled: bool) -> None:
     try:
@@ -1552,10 +3286,212 @@ def set_schedule_enforced(enabled: bool) -> None:
                 os.remove(SCHEDULE_FLAG_FILE)
     except Exception as e:
         print(f"[WARN] Failed to set schedule mode: {e}", flush=True)
+    _FLAG_CACHE.pop(SCHEDULE_FLAG_FILE, None)
+    DELAY_EVENT.set()
 
 def is_quiet_now(now: datetime | None = None) -> bool:
     return not should_broadcast(now) if is_schedule_enforced() else False
 
+# ========= BROADCAST TARGETS =========
+# תהליך אחד משדר לכמה יעדים מאותו תור משותף: לכל יעד מרווח, חלון שקט ותמהיל קטגוריות משלו,
+# והיסטוריית שליחה פרטית (target_sent) שמונעת חזרה על מוצר באותו יעד. מוצר יוצא מהתור רק אחרי
+# שכל היעדים שהתמהיל שלהם מקבל אותו שידרו אותו.
+# BROADCAST_TARGETS (env, או /targets set) — רשימת JSON, למשל:
+#   [{"id":"main"}, {"id":"deals","chat":"@deals","delay":900,"quiet":"23:00-07:00","categories":{"Electronics":3,"*":1}}]
+# יעד בלי "chat" משדר ל-CURRENT_TARGET; יעד בלי "delay" עוקב אחרי המרווח הגלובלי / AUTO_SCHEDULE.
+# בלי הגדרה — יעד יחיד "main", בדיוק כמו קודם.
+BROADCAST_MIN_GAP_SECONDS = max(0, _env_int("BROADCAST_MIN_GAP_SECONDS", 3))  # רווח מינימלי בין שליחות ליעדים שונים
+TARGET_SENT_KEEP_DAYS = max(1, _env_int("TARGET_SENT_KEEP_DAYS", 180))
+TARGET_PICK_WINDOW = 30   # כמה פריטים מוכנים ראשונים (שהיעד עוד לא שידר) נשקלים לתמהיל
+TARGET_MIX_RECENT = 50    # כמה שליחות אחרונות ביעד מייצגות את התמהיל בפועל
+
+class _Target:
+    """One broadcast destination with its own pacing and category mix."""
+
+    __slots__ = ("tid", "chat", "delay", "quiet", "weights")
+
+    def __init__(self, tid: str, chat=None, delay: int | None = None, quiet=None, weights: dict | None = None):
+        self.tid = tid
+        self.chat = chat
+        self.delay = delay
+        self.quiet = quiet        # (start, end) dtime; may wrap midnight
+        self.weights = weights or {}
+
+    @property
+    def state_key(self) -> str:
+        # היעד הראשי ממשיך להשתמש במפתח הישן כדי שהמרווח לא יתאפס בעדכון
+        return "last_post_ts" if self.tid == "main" else f"last_post_ts:{self.tid}"
+
+    def resolve_chat(self):
+        return resolve_target(self.chat if self.chat not in (None, "") else CURRENT_TARGET)
+
+    def weight(self, row: dict) -> float:
+        if not self.weights:
+            return 1.0
+        for k in (str(row.get("CategoryId") or "").strip(), str(row.get("CategoryName") or "").strip()):
+            if k and k in self.weights:
+                return self.weights[k]
+        return self.weights.get("*", 0.0)
+
+    def accepts(self, row: dict) -> bool:
+        return self.weight(row) > 0
+
+    def is_quiet(self, when: datetime) -> bool:
+        if not self.quiet:
+            return False
+        t = when.astimezone(IL_TZ).time()
+        start, end = self.quiet
+        return (start <= t < end) if start <= end else (t >= start or t < end)
+
+    def describe(self) -> str:
+        delay = f"{self.delay // 60} דק׳" if self.delay else "גלובלי"
+        quiet = f"{self.quiet[0]:%H:%M}-{self.quiet[1]:%H:%M}" if self.quiet else "—"
+        cats = ", ".join(f"{k}:{v:g}" for k, v in self.weights.items()) if self.weights else "הכל"
+        return f"{self.tid} → {self.resolve_chat()} | מרווח: {delay} | שקט: {quiet} | קטגוריות: {cats}"
+
+def _parse_hhmm_range(s: str):
+    m = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*", s or "")
+    if not m:
+        raise ValueError(f"quiet must look like 23:00-07:00, got {s!r}")
+    h1, m1, h2, m2 = (int(x) for x in m.groups())
+    return dtime(h1, m1), dtime(h2, m2)
+
+def _parse_targets(raw: str) -> list[_Target]:
+    """Parse the BROADCAST_TARGETS JSON list. Raises ValueError on a bad spec."""
+    raw = (raw or "").strip()
+    if not raw:
+        return [_Target("main")]
+    try:
+        spec = json.loads(raw)
+    except Exception as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("expected a non-empty JSON list of targets")
+    out, seen = [], set()
+    for i, d in enumerate(spec):
+        if not isinstance(d, dict):
+            raise ValueError(f"target #{i + 1} is not an object")
+        tid = str(d.get("id") or ("main" if i == 0 else f"t{i + 1}")).strip()
+        if tid in seen:
+            raise ValueError(f"duplicate target id {tid!r}")
+        seen.add(tid)
+        delay = d.get("delay")
+        delay = int(delay) if delay not in (None, "", 0) else None
+        if delay is not None and delay < 60:
+            raise ValueError(f"{tid}: delay must be >= 60 seconds")
+        quiet = _parse_hhmm_range(d["quiet"]) if d.get("quiet") else None
+        weights = {str(k).strip(): float(v) for k, v in (d.get("categories") or {}).items()}
+        if weights and not any(v > 0 for v in weights.values()):
+            raise ValueError(f"{tid}: categories has no positive weight")
+        out.append(_Target(tid, chat=d.get("chat") or None, delay=delay, quiet=quiet, weights=weights))
+    return out
+
+_TARGETS: list[_Target] = []
+
+def _targets_reload():
+    global _TARGETS
+    raw = _get_state_str("broadcast_targets", "") or os.getenv("BROADCAST_TARGETS", "")
+    try:
+        _TARGETS = _parse_targets(raw)
+    except ValueError as e:
+        log_warn(f"[TARGETS] bad config ({e}); falling back to a single target")
+        _TARGETS = [_Target("main")]
+
+def targets_all() -> list[_Target]:
+    if not _TARGETS:
+        _targets_reload()
+    return list(_TARGETS)
+
+def targets_set(raw: str) -> list[_Target]:
+    """Validate and store a new targets spec ('' = back to the env default)."""
+    if (raw or "").strip():
+        _parse_targets(raw)
+    _set_state_str("broadcast_targets", raw or "")
+    _targets_reload()
+    DELAY_EVENT.set()
+    return targets_all()
+
+# ---- per-target sent history ----
+# הזיכרון (סט מפתחות + קטגוריות אחרונות לכל יעד) נטען פעם אחת מ-target_sent ומתעדכן write-through.
+# כל הגישה תחת _DB_LOCK (RLock), כך שאפשר לבדוק אותו גם מתוך סינון שורות התור.
+_TARGET_SENT: dict = {}    # tid -> set(qkey)
+_TARGET_RECENT: dict = {}  # tid -> deque(cat)
+_TARGET_SENT_LOADED = False
+
+def _target_sent_load():
+    global _TARGET_SENT_LOADED
+    with _DB_LOCK:
+        if _TARGET_SENT_LOADED:
+            return
+        conn = _db()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS target_sent (
+                target TEXT NOT NULL,
+                qkey   TEXT NOT NULL,
+                cat    TEXT NOT NULL DEFAULT '',
+                ts     REAL NOT NULL,
+                PRIMARY KEY (target, qkey)
+            )
+        """)
+        conn.execute("DELETE FROM target_sent WHERE ts<?", (time.time() - TARGET_SENT_KEEP_DAYS * 86400,))
+        for rec in conn.execute("SELECT target, qkey, cat FROM target_sent ORDER BY ts"):
+            _TARGET_SENT.setdefault(rec["target"], set()).add(rec["qkey"])
+            _TARGET_RECENT.setdefault(rec["target"], deque(maxlen=TARGET_MIX_RECENT)).append(rec["cat"])
+        _TARGET_SENT_LOADED = True
+
+def target_has_sent(tid: str, qkey: str) -> bool:
+    with _DB_LOCK:
+        _target_sent_load()
+        return qkey in _TARGET_SENT.get(tid, ())
+
+def target_sent_count(tid: str) -> int:
+    with _DB_LOCK:
+        _target_sent_load()
+        return len(_TARGET_SENT.get(tid, ()))
+
+def target_mark_sent(t: _Target, row: dict):
+    qkey = row.get("_qkey") or _queue_key(row)
+    cat = str(row.get("CategoryId") or row.get("CategoryName") or "").strip()
+    with _DB_LOCK:
+        _target_sent_load()
+        with _db_tx() as conn:
+            conn.execute("INSERT OR REPLACE INTO target_sent(target, qkey, cat, ts) VALUES (?,?,?,?)", (t.tid, qkey, cat, time.time()))
+        _TARGET_SENT.setdefault(t.tid, set()).add(qkey)
+        _TARGET_RECENT.setdefault(t.tid, deque(maxlen=TARGET_MIX_RECENT)).append(cat)
+
+def target_accepts(t: _Target, row: dict, targets: list[_Target] | None = None) -> bool:
+    """t.accepts(row), except that rows no target's mix accepts go to the primary target (else they'd never leave the queue)."""
+    if t.accepts(row):
+        return True
+    targets = targets or targets_all()
+    return t is targets[0] and not any(x.accepts(row) for x in targets)
+
+def target_done_with(row: dict, targets: list[_Target] | None = None) -> bool:
+    """True when every target that accepts this row (see target_accepts) has already sent it."""
+    qkey = row.get("_qkey") or _queue_key(row)
+    targets = targets or targets_all()
+    return all(target_has_sent(t.tid, qkey) for t in targets if target_accepts(t, row, targets))
+
+def target_pick(t: _Target) -> dict | None:
+    """Next ready row for this target: not sent there yet, and closest to its category mix."""
+    with _DB_LOCK:
+        _target_sent_load()
+        sent = _TARGET_SENT.get(t.tid, set())
+        targets = targets_all()
+        cands = queue_peek_ready(TARGET_PICK_WINDOW, where=lambda r: r["_qkey"] not in sent and target_accepts(t, r, targets))
+        if len(cands) <= 1 or not t.weights:
+            return cands[0] if cands else None
+        recent = Counter(_TARGET_RECENT.get(t.tid, ()))
+
+    def score(r):
+        cat = str(r.get("CategoryId") or r.get("CategoryName") or "").strip()
+        return (t.weight(r) or 1.0) / (1 + recent[cat])  # 0 = שורה שנותבה ליעד הראשי (אף יעד לא מקבל אותה)
+
+    # max() מחזיר את הראשון מבין השווים — כלומר לפי סדר התור
+    return max(cands, key=score)
+
+_targets_reload()
+
 # ========= SAFE EDIT =========
 def safe_edit_message(bot, *, chat_id: int, message, new_text: str, reply_markup=None, parse_mode=None, cb_id=None, cb_info=None):
     """Safely edit an existing message and (optionally) answer callback queries.
@@ -1609,7 +3545,7 @@ def safe_edit_message(bot, *, chat_id: int, message, new_text: str, reply_markup
             except Exception:
                 pass
 
-def format_post(product):
+def format_post(product, buy_link_short: str | None = None):
     item_id = product.get('ItemId', 'ללא מספר')
     image_url = product.get('ImageURL', '')
     title = product.get('Title', '')
@@ -1620,11 +3556,11 @@ def format_post(product):
     orders = product.get('Orders', '')
     buy_link = product.get('BuyLink', '')
     # Use a shortened buy link for HTML anchors to avoid huge URLs in captions
-    buy_link_short = ''
-    try:
-        buy_link_short = _maybe_shorten_buy_link(item_id, buy_link) if buy_link else ''
-    except Exception:
-        buy_link_short = buy_link
+    if buy_link_short is None:
+        try:
+            buy_link_short = _maybe_shorten_buy_link(item_id, buy_link) if buy_link else ''
+        except Exception:
+            buy_link_short = buy_link
     coupon = product.get('CouponCode', '')
 
     opening = (product.get('Opening') or '').strip()
@@ -1776,37 +3712,158 @@ def _find_first_url(obj):
                 return got
     return None
 
+# ---- affiliate short-link cache ----
+# קישורי link.generate נשמרים ב-bot.db לפי (item_id, tracking_id) עם TTL, כך שפוסט/תצוגה/שליחה חוזרת
+# לא מבצעים קריאת TOP. כששורות נכנסות לתור, הקישורים החסרים נפתרים ברקע בבקשה אחת לכל 50 פריטים.
+AE_LINK_CACHE_TTL_DAYS = max(1, _env_int("AE_LINK_CACHE_TTL_DAYS", 14))
+AE_LINK_BULK_SIZE = 50
+_LINK_CACHE_SCHEMA_OK = False
+_LINK_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="links")
+
+def _link_cache_conn():
+    global _LINK_CACHE_SCHEMA_OK
+    with _DB_LOCK:
+        conn = _db()
+        if not _LINK_CACHE_SCHEMA_OK:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS link_cache (
+                    item_id     TEXT NOT NULL,
+                    tracking_id TEXT NOT NULL,
+                    link        TEXT NOT NULL,
+                    ts          REAL NOT NULL,
+                    PRIMARY KEY (item_id, tracking_id)
+                )
+            """)
+            _LINK_CACHE_SCHEMA_OK = True
+        return conn
+
+def _link_cache_get(item_id: str) -> str | None:
+    try:
+        with _DB_LOCK:
+            rec = _link_cache_conn().execute(
+                "SELECT link FROM link_cache WHERE item_id=? AND tracking_id=? AND ts>=?",
+                (item_id, AE_TRACKING_ID, time.time() - AE_LINK_CACHE_TTL_DAYS * 86400),
+            ).fetchone()
+        return rec[0] if rec else None
+    except Exception:
+        return None
+
+def _link_cache_put(links: dict):
+    """links: item_id -> short link."""
+    if not links:
+        return
+    try:
+        now = time.time()
+        with _db_tx(_link_cache_conn()) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO link_cache(item_id, tracking_id, link, ts) VALUES (?,?,?,?)",
+                [(iid, AE_TRACKING_ID, link, now) for iid, link in links.items()],
+            )
+            conn.execute("DELETE FROM link_cache WHERE ts<?", (now - AE_LINK_CACHE_TTL_DAYS * 86400,))
+    except Exception as e:
+        log_warn(f"[LINKS] cache write failed: {e}")
+
+def _link_needs_shortening(buy_link: str) -> bool:
+    buy_link = (buy_link or "").strip()
+    return not (buy_link and len(buy_link) <= 512 and "/s/" not in buy_link)
+
+def _link_generate_many(source_values: list[str]) -> dict:
+    """One link.generate call for many URLs (comma-separated source_values). Returns item_id -> link.
+
+    Keyed by the item id in the URL: the API may echo source_value normalized (scheme, query, trailing slash).
+    For a single source the only returned link is taken whatever it is keyed by.
+    """
+    payload = _top_call("aliexpress.affiliate.link.generate", {
+        "tracking_id": AE_TRACKING_ID,
+        "promotion_link_type": "0",
+        "source_values": ",".join(source_values),
+    })
+    rr = _extract_resp_result(payload)
+    res = rr.get("result") if isinstance(rr.get("result"), dict) else rr
+    links = ((res.get("promotion_links") or {}).get("promotion_link")) if isinstance(res, dict) else None
+    if isinstance(links, dict):
+        links = [links]
+    out = {}
+    for it in links or []:
+        if not isinstance(it, dict):
+            continue
+        src = str(it.get("source_value") or "").strip()
+        link = str(it.get("promotion_link") or "").strip()
+        if src and link and len(link) <= 512:
+            out[_extract_item_id_from_url(src) or src] = link
+    if len(source_values) == 1:
+        short = next(iter(out.values()), None) or _find_first_url(rr)
+        want = _extract_item_id_from_url(source_values[0]) or source_values[0]
+        return {want: short} if short and len(short) <= 512 else {}
+    return out
+
+def links_prefetch(rows: list[dict]) -> int:
+    """Resolve and cache short links for rows that will need one (bulk). Returns how many were cached."""
+    if not AE_APP_KEY or not AE_APP_SECRET or not AE_TRACKING_ID:
+        return 0
+    by_src = {}
+    for r in rows or []:
+        item_id = str(r.get("ItemId") or "").strip()
+        if not item_id.isdigit() or not _link_needs_shortening(str(r.get("BuyLink") or "")):
+            continue
+        if _link_cache_get(item_id):
+            continue
+        by_src[_canonical_item_url(item_id)] = item_id
+    srcs = list(by_src)
+    wanted = set(by_src.values())
+    cached = 0
+    for i in range(0, len(srcs), AE_LINK_BULK_SIZE):
+        chunk = srcs[i:i + AE_LINK_BULK_SIZE]
+        try:
+            got = _link_generate_many(chunk)
+        except Exception as e:
+            logging.warning("[LINKS] bulk link.generate failed: %s", e)
+            continue
+        got = {item_id: link for item_id, link in got.items() if item_id in wanted}
+        _link_cache_put(got)
+        cached += len(got)
+    if srcs:
+        logging.info(f"[LINKS] bulk resolved {cached}/{len(srcs)} short links")
+    return cached
+
+def links_prefetch_async(rows: list[dict]):
+    if rows:
+        _LINK_POOL.submit(links_prefetch, [dict(r) for r in rows])
+
 def _maybe_shorten_buy_link(item_id: str, buy_link: str) -> str:
-    """If link is very long, regenerate a clean affiliate link via link.generate.
+    """If link is very long, regenerate a clean affiliate link via link.generate (cached per item).
     Fallback to canonical item URL.
     """
     buy_link = (buy_link or "").strip()
-    if buy_link and len(buy_link) <= 512 and "/s/" not in buy_link:
+    if not _link_needs_shortening(buy_link):
         return buy_link
 
     canonical = _canonical_item_url(item_id)
     fallback = canonical or (buy_link[:512] if buy_link else "")
+    item_key = str(item_id or "").strip()
+    if item_key.isdigit():
+        hit = _link_cache_get(item_key)
+        if hit:
+            return hit
 
     try:
         if not AE_APP_KEY or not AE_APP_SECRET or not AE_TRACKING_ID:
             return fallback
-        payload = _top_call("aliexpress.affiliate.link.generate", {
-            "tracking_id": AE_TRACKING_ID,
-            "promotion_link_type": "0",
-            "source_values": canonical or buy_link,
-        })
-        rr = _extract_resp_result(payload)
-        short = _find_first_url(rr)
-        if short and len(short) <= 512:
+        src = canonical or buy_link
+        short = next(iter(_link_generate_many([src]).values()), None)
+        if short:
+            if item_key.isdigit():
+                _link_cache_put({item_key: short})
             return short
     except Exception as e:
         logging.warning("link.generate failed (fallback to canonical): %s", e)
 
     return fallback
 
-def _build_post_buttons(item_id: str, buy_link: str):
+def _build_post_buttons(item_id: str, buy_link: str, url_buy: str | None = None):
     try:
-        url_buy = _maybe_shorten_buy_link(item_id, buy_link)
+        if url_buy is None:
+            url_buy = _maybe_shorten_buy_link(item_id, buy_link)
         url_join = (JOIN_URL or "").strip()
         mk = types.InlineKeyboardMarkup(row_width=1)
         if url_buy:
@@ -1818,64 +3875,332 @@ def _build_post_buttons(item_id: str, buy_link: str):
         logging.warning("failed to build buttons: %s", e)
         return None
 
-def post_to_channel(product) -> bool:
+# ========= MEDIA RELAY =========
+# שליחת מדיה בלי להחזיק את כל הקובץ בזיכרון:
+# 1) מסלול מהיר — מעבירים לטלגרם את ה-URL עצמו (טלגרם מוריד בעצמו; עד ~5MB לתמונה / ~20MB לקובץ).
+# 2) אחרת — הורדה בזרימה ל-SpooledTemporaryFile (בזיכרון עד MEDIA_SPOOL_MEM_MB, מעבר לזה לדיסק) עם תקרת גודל.
+# לוידאו נעשית בדיקת HEAD מראש, כך שוידאו גדול מדי נפסל בלי להוריד אותו.
+MEDIA_URL_FAST_PATH = env_bool("MEDIA_URL_FAST_PATH", True)
+MEDIA_MAX_VIDEO_MB = _env_int("MEDIA_MAX_VIDEO_MB", 50)   # Bot API upload limit
+MEDIA_MAX_PHOTO_MB = _env_int("MEDIA_MAX_PHOTO_MB", 10)
+MEDIA_SPOOL_MEM_MB = _env_int("MEDIA_SPOOL_MEM_MB", 4)
+_MEDIA_URL_LIMIT_MB = {"photo": 5, "video": 20}           # what Telegram will fetch by URL
+
+def _media_head_size(url: str) -> int | None:
+    """Content-Length via HEAD (None when unknown or HEAD is not supported)."""
+    try:
+        r = SESSION.head(url, timeout=10, allow_redirects=True)
+        if r.status_code >= 400:
+            return None
+        cl = r.headers.get("Content-Length")
+        return int(cl) if cl and str(cl).isdigit() else None
+    except Exception:
+        return None
+
+def _media_download_spooled(url: str, max_bytes: int):
+    """Stream a URL into a spooled temp file; raises if it exceeds max_bytes. Caller closes the file."""
+    f = tempfile.SpooledTemporaryFile(max_size=max(1, MEDIA_SPOOL_MEM_MB) * 1024 * 1024)
+    try:
+        with SESSION.get(url, stream=True, timeout=(10, 60)) as resp:
+            resp.raise_for_status()
+            total = 0
+            for chunk in resp.iter_content(chunk_size=256 * 1024):
+                if not chunk:
+                    continue
+                total += len(chunk)
+                if total > max_bytes:
+                    raise ValueError(f"media larger than {max_bytes // (1024 * 1024)}MB")
+                f.write(chunk)
+        f.seek(0)
+        return f
+    except Exception:
+        f.close()
+        raise
+
+# ---- Telegram file_id cache ----
+# אחרי העלאה ראשונה טלגרם מחזיר file_id; שליחות חוזרות של אותה מדיה (פרסום חוזר, תצוגה למנהל,
+# ערוץ ציבורי+פרטי) משתמשות בו — בלי הורדה ובלי העלאה. file_id תקף לכל הצ'אטים של אותו בוט.
+_MEDIA_FID_SCHEMA_OK = False
+
+def _media_fid_conn():
+    global _MEDIA_FID_SCHEMA_OK
+    with _DB_LOCK:
+        conn = _db()
+        if not _MEDIA_FID_SCHEMA_OK:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media_file_ids (
+                    url     TEXT NOT NULL,
+                    kind    TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    ts      REAL NOT NULL,
+                    PRIMARY KEY (url, kind)
+                )
+            """)
+            _MEDIA_FID_SCHEMA_OK = True
+        return conn
+
+def media_file_id_get(url: str, kind: str) -> str | None:
+    try:
+        with _DB_LOCK:
+            rec = _media_fid_conn().execute("SELECT file_id FROM media_file_ids WHERE url=? AND kind=?", (url, kind)).fetchone()
+        return rec[0] if rec else None
+    except Exception:
+        return None
+
+def media_file_id_put(url: str, kind: str, file_id: str | None):
+    try:
+        with _DB_LOCK:
+            conn = _media_fid_conn()
+            if file_id:
+                conn.execute("INSERT OR REPLACE INTO media_file_ids(url, kind, file_id, ts) VALUES (?,?,?,?)", (url, kind, file_id, time.time()))
+            else:
+                conn.execute("DELETE FROM media_file_ids WHERE url=? AND kind=?", (url, kind))
+    except Exception as e:
+        log_warn(f"[MEDIA] file_id cache write failed: {e}")
+
+def _message_file_id(msg, kind: str) -> str | None:
+    """file_id of the media Telegram stored for a sent message."""
+    try:
+        if kind == "photo" and getattr(msg, "photo", None):
+            return msg.photo[-1].file_id
+        for attr in ("video", "animation", "document"):
+            obj = getattr(msg, attr, None)
+            if obj is not None and getattr(obj, "file_id", None):
+                return obj.file_id
+    except Exception:
+        pass
+    return None
+
+_FILE_ID_ERRORS = ("wrong file identifier", "file reference expired", "wrong remote file")
+
+def _is_file_id_error(e: Exception) -> bool:
+    msg = str(getattr(e, "description", "") or e).lower()
+    return any(m in msg for m in _FILE_ID_ERRORS)
+
+def _send_media(chat_id, kind: str, url: str, prefetched=None, **kwargs):
+    """Send a photo/video by URL: cached file_id, HEAD size check (video), URL fast path, then spooled upload.
+
+    `prefetched` is an already-downloaded file for `url` (from the post look-ahead); it is uploaded and closed.
+    """
+    send = bot.send_video if kind == "video" else bot.send_photo
+
+    fid = media_file_id_get(url, kind)
+    if fid:
+        try:
+            return send(chat_id, fid, **kwargs)
+        except Exception as e:
+            # רק file_id פסול מצדיק מחיקה ושליחה מה-URL; 429 / timeout / שגיאת caption עולים למעלה כרגיל
+            if not _is_file_id_error(e):
+                if prefetched is not None:
+                    prefetched.close()
+                raise
+            log_info(f"[MEDIA] cached file_id rejected ({kind}), re-sending from URL: {e}")
+            media_file_id_put(url, kind, None)
+
+    if prefetched is not None:
+        try:
+            prefetched.seek(0)
+            msg = send(chat_id, prefetched, **kwargs)
+        finally:
+            prefetched.close()
+    else:
+        msg = _send_media_from_url(send, chat_id, kind, url, **kwargs)
+    media_file_id_put(url, kind, _message_file_id(msg, kind))
+    return msg
+
+def _send_media_from_url(send, chat_id, kind: str, url: str, **kwargs):
+    max_mb = MEDIA_MAX_VIDEO_MB if kind == "video" else MEDIA_MAX_PHOTO_MB
+    max_bytes = max_mb * 1024 * 1024
+
+    size = _media_head_size(url) if kind == "video" else None
+    if size is not None and size > max_bytes:
+        raise ValueError(f"{kind} too large ({size // (1024 * 1024)}MB > {max_mb}MB), skipped without download")
+
+    if MEDIA_URL_FAST_PATH and (size is None or size <= _MEDIA_URL_LIMIT_MB[kind] * 1024 * 1024):
+        try:
+            return send(chat_id, url, **kwargs)
+        except Exception as e:
+            log_info(f"[MEDIA] {kind} by URL failed, uploading instead: {e}")
+
+    f = _media_download_spooled(url, max_bytes)
+    try:
+        return send(chat_id, f, **kwargs)
+    finally:
+        f.close()
+
+def _render_post(product) -> dict:
+    """Caption (trimmed to Telegram limits), media URLs and the resolved short buy link for one row."""
+    item_id = product.get('ItemId', 'ללא מספר')
+    buy_link = product.get('BuyLink', '')
+    try:
+        short = _maybe_shorten_buy_link(item_id, buy_link) if buy_link else ''
+    except Exception:
+        short = buy_link
+    post_text, image_url = format_post(product, buy_link_short=short)
+    video_url = (product.get('Video Url') or product.get('VideoURL') or product.get('VideoURL'.lower()) or "").strip()
+
+    # Caption safety: Telegram captions are 0-1024 characters AFTER entities parsing
+    # We'll estimate using visible text (strip HTML tags).
+    raw_lines = (post_text or "").splitlines()
+
+    # Drop the bottom CTA block if needed (it is repetitive and tends to be long)
+    trimmed_lines = []
+    for ln in raw_lines:
+        if ln.strip().startswith("👇🛍"):
+            break
+        trimmed_lines.append(ln)
+
+    # Build caption without exceeding ~1000 visible chars
+    caption_lines = []
+    visible_total = 0
+    for ln in trimmed_lines:
+        vis = len(_strip_html(ln))
+        if visible_total + vis + 1 > 1000:
+            break
+        caption_lines.append(ln)
+        visible_total += vis + 1
+
+    caption = "\n".join(caption_lines).strip()
+    # Telegram caption hard limit is 1024 chars (raw, including hidden URLs in HTML).
+    # If the caption is still too long, truncate safely by dropping lines from the bottom.
+    while len(caption) > 1024 and len(caption_lines) > 1:
+        caption_lines.pop()
+        caption = "\n".join(caption_lines)
+    if len(caption) > 1024:
+        caption = caption[:1020] + "…"
+
+    return {"caption": caption, "image": image_url, "video": video_url if video_url.startswith("http") else "", "short": short}
+
+# ========= POST LOOK-AHEAD =========
+# thread רקע מכין מראש את POST_PREFETCH_AHEAD הפריטים המוכנים הבאים בתור: כיתוב מרונדר וקצוץ, קישור קצר
+# (link.generate), ובדיקת מדיה (HEAD; הורדה מראש כשהשליחה תצטרך העלאה). בזמן השליחה נשאר רק קריאה אחת
+# לטלגרם, ותקלות (תמונה שבורה / וידאו גדול מדי) מתגלות בלוג לפני שמגיע הסלוט.
+POST_PREFETCH_AHEAD = max(0, _env_int("POST_PREFETCH_AHEAD", 3))
+POST_PREFETCH_INTERVAL_SECONDS = max(5, _env_int("POST_PREFETCH_INTERVAL_SECONDS", 60))
+POST_PREFETCH_TTL_SECONDS = 6 * 3600
+_PREPARED: dict = {}  # qkey -> {"sig", "ts", "caption", "image", "video", "short", "file", "file_kind", "error"}
+_PREPARED_LOCK = threading.Lock()
+_PREFETCH_EVENT = threading.Event()
+
+def _prepared_sig(row: dict) -> str:
+    base = _queue_row_json(row) + "|" + _display_currency_code() + "|" + str(JOIN_URL or "")
+    return hashlib.sha1(base.encode("utf-8", errors="ignore")).hexdigest()
+
+def _prepared_drop(entry: dict | None):
+    f = (entry or {}).get("file")
+    if f is not None:
+        try:
+            f.close()
+        except Exception:
+            pass
+
+def _prepare_post(row: dict) -> dict:
+    entry = _render_post(row)
+    entry.update(sig=_prepared_sig(row), ts=time.time(), file=None, file_kind="", error="")
+    kind = "video" if entry["video"] else "photo"
+    url = entry["video"] or entry["image"]
+    if not url:
+        entry["error"] = "no media url"
+        return entry
+    if media_file_id_get(url, kind):
+        return entry  # file_id ידוע: השליחה לא תוריד ולא תעלה כלום
+
+    max_bytes = (MEDIA_MAX_VIDEO_MB if kind == "video" else MEDIA_MAX_PHOTO_MB) * 1024 * 1024
+    size = _media_head_size(url)
+    if kind == "video" and size is not None and size > max_bytes:
+        # ידוע מראש שהוידאו ייפסל — הפוסט יישלח כתמונה
+        entry["error"] = f"video too large ({size // (1024 * 1024)}MB)"
+        entry["video"] = ""
+        kind, url = "photo", entry["image"]
+        size = _media_head_size(url) if url else None
+    if url and (not MEDIA_URL_FAST_PATH or (size is not None and size > _MEDIA_URL_LIMIT_MB[kind] * 1024 * 1024)):
+        entry["file"] = _media_download_spooled(url, max_bytes)
+        entry["file_kind"] = kind
+    return entry
+
+def _prepared_take(row: dict) -> dict | None:
+    """Pop the prepared render for this row if it is still current."""
+    with _PREPARED_LOCK:
+        entry = _PREPARED.pop(row.get("_qkey") or "", None)
+    if entry is None:
+        return None
+    if entry["sig"] != _prepared_sig(row) or time.time() - entry["ts"] > POST_PREFETCH_TTL_SECONDS:
+        _prepared_drop(entry)
+        return None
+    return entry
+
+def _prefetch_tick():
+    try:
+        refresh_upcoming()  # מחיר/קישור עדכניים לפני הרינדור; פריט שירד מהמכירה יוצא מהתור כאן
+    except Exception as e:
+        log_warn(f"[REFRESH] upcoming refresh failed: {e}")
+    upcoming = queue_peek_ready(POST_PREFETCH_AHEAD)
+    keep = {r["_qkey"] for r in upcoming}
+    with _PREPARED_LOCK:
+        for k in [k for k in _PREPARED if k not in keep]:
+            _prepared_drop(_PREPARED.pop(k))
+    for r in upcoming:
+        k = r["_qkey"]
+        with _PREPARED_LOCK:
+            cur = _PREPARED.get(k)
+        if cur is not None and cur["sig"] == _prepared_sig(r) and time.time() - cur["ts"] <= POST_PREFETCH_TTL_SECONDS:
+            continue
+        try:
+            entry = _prepare_post(r)
+        except Exception as e:
+            log_warn(f"[PREFETCH] ItemId={r.get('ItemId','')} not prepared: {e}")
+            continue
+        if entry["error"]:
+            log_warn(f"[PREFETCH] ItemId={r.get('ItemId','')}: {entry['error']}")
+        with _PREPARED_LOCK:
+            _prepared_drop(_PREPARED.pop(k, None))
+            _PREPARED[k] = entry
+
+def prefetch_wake():
+    _PREFETCH_EVENT.set()
+
+def prefetch_loop():
+    while True:
+        _PREFETCH_EVENT.wait(timeout=POST_PREFETCH_INTERVAL_SECONDS)
+        _PREFETCH_EVENT.clear()
+        try:
+            _prefetch_tick()
+        except Exception as e:
+            log_warn(f"[PREFETCH] tick failed: {e}")
+
+def post_to_channel(product, chat=None) -> bool:
     """Send a single media message (photo/video) with HTML caption when possible.
     Returns True on success, False on failure (so queue won't advance on failures).
+    Uses the look-ahead render for this row when there is a current one.
+    chat defaults to CURRENT_TARGET.
     """
+    prepared = None
     try:
-        post_text, image_url = format_post(product)
-        video_url = (product.get('Video Url') or product.get('VideoURL') or product.get('VideoURL'.lower()) or "").strip()
-        target = resolve_target(CURRENT_TARGET)
+        prepared = _prepared_take(product)
+        post = prepared or _render_post(product)
+        caption = post["caption"]
+        image_url = post["image"]
+        video_url = post["video"]
+        prefetched = post.get("file") if prepared else None
+        target = resolve_target(CURRENT_TARGET if chat is None else chat)
 
         item_id = str(product.get("ProductId") or product.get("ItemId") or product.get("item_id") or "")
         buy_link_btn = str(product.get("BuyLink") or "")
-        buttons = _build_post_buttons(item_id, buy_link_btn)
+        buttons = _build_post_buttons(item_id, buy_link_btn, url_buy=post["short"])
 
-        # Caption safety: Telegram captions are 0-1024 characters AFTER entities parsing
-        # We'll estimate using visible text (strip HTML tags).
-        raw_lines = (post_text or "").splitlines()
+        log_info(f"POST start item={product.get('ItemId','')} media={'video' if video_url else 'photo'} raw_len={len(caption)} vis_len={len(_strip_html(caption))} buttons={_count_buttons(buttons)} target={target} prepared={'yes' if prepared else 'no'}")
 
-        # Drop the bottom CTA block if needed (it is repetitive and tends to be long)
-        trimmed_lines = []
-        for ln in raw_lines:
-            if ln.strip().startswith("👇🛍"):
-                break
-            trimmed_lines.append(ln)
-
-        # Build caption without exceeding ~1000 visible chars
-        caption_lines = []
-        visible_total = 0
-        for ln in trimmed_lines:
-            vis = len(_strip_html(ln))
-            if visible_total + vis + 1 > 1000:
-                break
-            caption_lines.append(ln)
-            visible_total += vis + 1
-
-        caption = "\n".join(caption_lines).strip()
-        # Telegram caption hard limit is 1024 chars (raw, including hidden URLs in HTML).
-        # If the caption is still too long, truncate safely by dropping lines from the bottom.
-        while len(caption) > 1024 and len(caption_lines) > 1:
-            caption_lines.pop()
-            caption = "\n".join(caption_lines)
-        if len(caption) > 1024:
-            caption = caption[:1020] + "…"
-
-        log_info(f"POST start item={product.get('ItemId','')} media={'video' if video_url.startswith('http') else 'photo'} raw_len={len(caption)} vis_len={len(_strip_html(caption))} buttons={_count_buttons(buttons)} target={target}")
-
-        if video_url.startswith("http"):
+        if video_url:
             try:
-                resp = SESSION.get(video_url, timeout=30)
-                resp.raise_for_status()
-                bot.send_video(target, resp.content, caption=caption, parse_mode="HTML")
+                _send_media(target, "video", video_url, caption=caption, parse_mode="HTML",
+                            prefetched=prefetched if post.get("file_kind") == "video" else None)
                 log_info(f"POST ok item={product.get('ItemId','')} (video)")
                 return True
             except Exception as ve:
                 log_info(f"Video fetch/send failed, fallback to photo. item={product.get('ItemId','')} err={ve}")
 
-        resp = SESSION.get(image_url, timeout=30)
-        resp.raise_for_status()
-        bot.send_photo(target, resp.content, caption=caption, parse_mode="HTML")
+        _send_media(target, "photo", image_url, caption=caption, parse_mode="HTML",
+                    prefetched=prefetched if post.get("file_kind") == "photo" else None)
 
         log_info(f"POST ok item={product.get('ItemId','')}")
         return True
@@ -1883,66 +4208,77 @@ def post_to_channel(product) -> bool:
     except Exception as e:
         log_exc(f"POST failed item={product.get('ItemId','')} err={e}")
         return False
+    finally:
+        _prepared_drop(prepared)
 
 # ========= ATOMIC SEND =========
-# ========= ATOMIC SEND =========
-def send_next_locked(source: str = "loop") -> bool:
+_TARGET_RETRY_AT: dict = {}  # tid -> ts; יעד ששליחה אליו נכשלה לא חוסם את האחרים
+_LAST_ANY_SEND = 0.0
+
+def send_next_locked(source: str = "loop", target: _Target | None = None) -> bool:
+    """Send the next suitable item to one target (default: the first/primary one)."""
+    global _LAST_ANY_SEND
     if not is_broadcast_enabled():
         log_info(f"{source}: broadcast disabled (no send)")
         return False
 
-    with FILE_LOCK:
-        pending = read_products(PENDING_CSV)
-        if not pending:
-            log_info(f"{source}: no pending")
-            return False
-
-        # ✅ SAFETY: never broadcast items that haven't passed AI.
-        def _is_done(r: dict) -> bool:
-            st = str((r or {}).get("AIState", "") or "").strip().lower()
-            if st == "done":
-                return True
-            # fallback: if AI filled the fields but AIState wasn't written
-            if str((r or {}).get("Opening", "")).strip() and str((r or {}).get("Title", "")).strip() and str((r or {}).get("Strengths", "")).strip():
-                return True
-            return False
-
-        idx = next((i for i, r in enumerate(pending) if _is_done(r)), None)
-        if idx is None:
-            counts = _count_ai_states(pending)
-            log_info(f"{source}: no AI-ready items (done=0, raw={counts.get('raw',0)}, approved={counts.get('approved',0)})")
+    # SEND_LOCK מונע שליחה כפולה (לולאה + "פרסם עכשיו") בלי לחסום את שאר פעולות התור
+    with SEND_LOCK:
+        targets = targets_all()
+        t = target or targets[0]
+        item = target_pick(t)
+        if item is None:
+            counts = queue_state_counts()
+            if not sum(counts.values()):
+                log_info(f"{source}: no pending")
+            elif counts.get("done", 0):
+                log_info(f"{source}: nothing left for target={t.tid} (sent or outside its categories)")
+            else:
+                log_info(f"{source}: no AI-ready items (done=0, raw={counts.get('raw',0)}, approved={counts.get('approved',0)})")
             return False
 
-        item = pending[idx]
         item_id = (item.get("ItemId") or "").strip()
         title = (item.get("Title") or "").strip()[:120]
-        log_info(f"{source}: sending ItemId={item_id} | Title={title}")
+        if not t.accepts(item):
+            log_info(f"{source}: ItemId={item_id} matches no target's categories -> routed to primary target={t.tid}")
+        log_info(f"{source}: sending ItemId={item_id} target={t.tid} | Title={title}")
 
-        ok = post_to_channel(item)
+        ok = post_to_channel(item, chat=t.resolve_chat())
+        _LAST_ANY_SEND = time.time()
         if not ok:
             # IMPORTANT: do NOT advance queue on failures
-            log_info(f"{source}: send FAILED, queue NOT advanced (ItemId={item_id})")
+            _TARGET_RETRY_AT[t.tid] = time.time() + SCHED_RETRY_SECONDS
+            log_info(f"{source}: send FAILED, queue NOT advanced (ItemId={item_id}, target={t.tid})")
             return False
+        _TARGET_RETRY_AT.pop(t.tid, None)
 
+        first_send = not any(target_has_sent(x.tid, item["_qkey"]) for x in targets)
         try:
-            new_pending = pending[:idx] + pending[idx+1:]
-            write_products(PENDING_CSV, new_pending)
+            target_mark_sent(t, item)
         except Exception as e:
-            log_info(f"{source}: write FAILED, retry once: {e}")
-            time.sleep(0.2)
+            log_warn(f"{source}: target history write failed (target={t.tid}): {e}")
+
+        if target_done_with(item, targets):
             try:
-                new_pending = pending[:idx] + pending[idx+1:]
-                write_products(PENDING_CSV, new_pending)
-            except Exception as e2:
-                log_exc(f"{source}: write FAILED permanently: {e2}")
-                return False
+                queue_remove(item["_qkey"])
+            except Exception as e:
+                log_info(f"{source}: dequeue FAILED, retry once: {e}")
+                time.sleep(0.2)
+                try:
+                    queue_remove(item["_qkey"])
+                except Exception as e2:
+                    log_exc(f"{source}: dequeue FAILED permanently: {e2}")
+                    return False
 
-        try:
-            dedup_mark_seen(item, source="sent")
-        except Exception:
-            pass
+        if first_send:
+            try:
+                dedup_mark_seen(item, source="sent")
+            except Exception:
+                pass
 
-        log_info(f"{source}: sent & advanced queue (ItemId={item_id})")
+        _set_state_str(t.state_key, f"{time.time():.0f}")
+        log_info(f"{source}: sent & advanced queue (ItemId={item_id}, target={t.tid})")
+        prefetch_wake()
         return True
 
 
@@ -1954,28 +4290,35 @@ AUTO_SCHEDULE = [
     (dtime(22, 0), dtime(23, 59),1500),
 ]
 
+def _read_flag(path: str, default: str) -> str:
+    v = _FLAG_CACHE.get(path)
+    if v is None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                v = (f.read() or "").strip() or default
+        except Exception:
+            v = default
+        _FLAG_CACHE[path] = v
+    return v
+
+def _write_flag(path: str, value: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(value)
+    _FLAG_CACHE[path] = value.strip()
+    DELAY_EVENT.set()
+
 def read_auto_flag():
-    try:
-        with open(AUTO_FLAG_FILE, "r", encoding="utf-8") as f:
-            return f.read().strip() or "on"
-    except Exception:
-        return "on"
+    return _read_flag(AUTO_FLAG_FILE, "on")
 
 def write_auto_flag(value):
-    with open(AUTO_FLAG_FILE, "w", encoding="utf-8") as f:
-        f.write(value)
+    _write_flag(AUTO_FLAG_FILE, value)
 
 
 def read_broadcast_flag():
-    try:
-        with open(BROADCAST_FLAG_FILE, "r", encoding="utf-8") as f:
-            return (f.read() or "").strip() or "off"
-    except Exception:
-        return "off"
+    return _read_flag(BROADCAST_FLAG_FILE, "off")
 
 def write_broadcast_flag(value: str):
-    with open(BROADCAST_FLAG_FILE, "w", encoding="utf-8") as f:
-        f.write(str(value or "off").strip())
+    _write_flag(BROADCAST_FLAG_FILE, str(value or "off").strip())
 
 def is_broadcast_enabled() -> bool:
     return (read_broadcast_flag().strip().lower() in ("1", "true", "yes", "on"))
@@ -1983,13 +4326,16 @@ def is_broadcast_enabled() -> bool:
 def set_broadcast_enabled(flag: bool):
     write_broadcast_flag("on" if flag else "off")
 
-def get_auto_delay():
-    now = _now_il().time()
+def _auto_delay_at(when: datetime):
+    t = when.astimezone(IL_TZ).time()
     for start, end, delay in AUTO_SCHEDULE:
-        if start <= now <= end:
+        if start <= t <= end:
             return delay
     return None
 
+def get_auto_delay():
+    return _auto_delay_at(_now_il())
+
 def load_delay_seconds(default_seconds: int = 1500) -> int:
     try:
         if os.path.exists(DELAY_FILE):
@@ -2068,7 +4414,9 @@ def cmd_ai(msg):
         f"OPENAI_API_KEY={'OK' if key_ok else 'MISSING'}\n"
         f"GPT_ON_REFILL={GPT_ON_REFILL} | GPT_ON_UPLOAD={GPT_ON_UPLOAD} | GPT_ON_SEND_FALLBACK={GPT_ON_SEND_FALLBACK}\n"
 
-        f"GPT_BATCH_SIZE={GPT_BATCH_SIZE} | GPT_TIMEOUT_SECONDS={GPT_TIMEOUT_SECONDS} | GPT_MAX_RETRIES={GPT_MAX_RETRIES}"
+        f"GPT_BATCH_SIZE={GPT_BATCH_SIZE} | GPT_TIMEOUT_SECONDS={GPT_TIMEOUT_SECONDS} | GPT_MAX_RETRIES={GPT_MAX_RETRIES}\n"
+        f"GPT_CONCURRENCY={GPT_CONCURRENCY} | GPT_RPM={GPT_RPM:g} | GPT_TPM={GPT_TPM:g}\n"
+        f"{ai_cache_status_text()}"
     )
 
 @bot.message_handler(commands=["ai_test"])
@@ -2120,6 +4468,75 @@ def _extract_item_id_from_url(url: str) -> str:
     m = re.search(r"\b(\d{9,})\b", u)
     return m.group(1) if m else ""
 
+# ---- near-duplicate titles (SimHash) ----
+# _title_fingerprint תופס רק כותרות זהות אחרי נרמול. כאן: SimHash של 64 ביט על אוסף המילים של הכותרת
+# (בלי מספרים/דגמים, כך שסדר מילים ומספרי דגם לא משנים), ואינדקס פסים: hash שבמרחק ≤d ביטים חולק בהכרח
+# פס אחד מתוך d+1 (_SimIndex, מוגדר ליד היסטוריית ה-dedup) — בדיקה היא כמה חיפושי dict + השוואות XOR.
+def _near_title(r: dict) -> str:
+    # הכותרת המקורית (לפני שכתוב AI), כדי שפריטים בתור/שנשלחו יושוו למועמדים גולמיים
+    return str(r.get("OrigTitle") or r.get("Title") or r.get("product_title") or "").strip()
+
+def _title_simhash(title: str) -> int:
+    """64-bit SimHash over the distinct words of the normalized title (0 = too short to compare)."""
+    words = {w for w in _normalize_title_for_dedup(title).split() if len(w) > 1 and not any(ch.isdigit() for ch in w)}
+    if len(words) < AE_NEAR_DUP_MIN_WORDS:
+        return 0
+    v = [0] * 64
+    for w in words:
+        h = int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest(), "little")
+        for i in range(64):
+            v[i] += 1 if (h >> i) & 1 else -1
+    out = 0
+    for i in range(64):
+        if v[i] > 0:
+            out |= 1 << i
+    return out or 1
+
+_NEAR_QUEUE: dict = {"gen": None, "index": None}  # נגזר מהמטמון של התור, נבנה מחדש כשהתור משתנה
+
+def _near_queue_index() -> _SimIndex:
+    with _DB_LOCK:
+        rows = _qcache_rows()
+        if _NEAR_QUEUE["gen"] != _QCACHE["gen"]:
+            idx = _SimIndex()
+            for r in rows:
+                idx.add(r["_qkey"], _title_simhash(_near_title(r)))
+            _NEAR_QUEUE.update(gen=_QCACHE["gen"], index=idx)
+        return _NEAR_QUEUE["index"]
+
+def near_dup_of(row: dict, extra: _SimIndex | None = None, h: int | None = None) -> str | None:
+    """'queued' / 'sent' / 'batch' when a near-identical title exists there, else None."""
+    if not AE_NEAR_DUP_ENABLED:
+        return None
+    h = _title_simhash(_near_title(row)) if h is None else h
+    if not h:
+        return None
+    if extra is not None and extra.find(h) is not None:
+        return "batch"
+    with _DEDUP_LOCK:
+        if _NEAR_SENT.find(h) is not None:
+            return "sent"
+    if _near_queue_index().find(h) is not None:
+        return "queued"
+    return None
+
+def near_dup_filter(rows: list[dict]) -> tuple[list[dict], int]:
+    """Drop rows whose title is a near-duplicate of the queue, recent sends, or an earlier row. Returns (kept, dropped)."""
+    if not AE_NEAR_DUP_ENABLED:
+        return list(rows or []), 0
+    batch = _SimIndex()
+    kept = []
+    for i, r in enumerate(rows or []):
+        h = _title_simhash(_near_title(r))
+        if near_dup_of(r, extra=batch, h=h):
+            continue
+        batch.add(i, h)
+        kept.append(r)
+    dropped = len(rows or []) - len(kept)
+    if dropped:
+        logging.info(f"[DEDUP] near-duplicate titles dropped: {dropped}/{len(rows)}")
+    return kept, dropped
+
 # ========= MERGE =========
 def _key_of_row(r: dict):
     """Stable key for dedup.
@@ -2139,17 +4556,17 @@ def _key_of_row(r: dict):
     return ("t:" + (fp or "unknown"),)
 
 def merge_from_data_into_pending():
-    """Merge rows from DATA_CSV into PENDING_CSV.
+    """Merge rows from DATA_CSV into the pending queue.
 
     Returns: (added, already, total_after)
     """
     with FILE_LOCK:
         data_rows = read_products(DATA_CSV)
-        pending_rows = read_products(PENDING_CSV)
-        existing_keys = {_key_of_row(r) for r in pending_rows}
+    existing_keys = queue_keys()
 
     # Only new candidates (so we don't waste AI calls)
     new_candidates = [r for r in data_rows if _key_of_row(r) not in existing_keys]
+    new_candidates, _ = near_dup_filter(new_candidates)
 
     # AI enrichment (optional) — run only on new candidates
     if ai_auto_mode() and GPT_ON_UPLOAD and new_candidates:
@@ -2162,21 +4579,8 @@ def merge_from_data_into_pending():
         except Exception as _e:
             logging.warning(f"[AI] enrich failed: {_e}")
 
-    added = 0
-    already = 0
-    for r in data_rows:
-        k = _key_of_row(r)
-        if k in existing_keys:
-            already += 1
-            continue
-        pending_rows.append(r)
-        existing_keys.add(k)
-        added += 1
-
-    with FILE_LOCK:
-        write_products(PENDING_CSV, pending_rows)
-        total_after = len(pending_rows)
-
+    added, already, total_after = queue_add_rows(new_candidates)
+    already += (len(data_rows) - len(new_candidates))
     return added, already, total_after
 
 def delete_source_csv_file():
@@ -2187,20 +4591,11 @@ def delete_source_csv_file():
 def delete_source_rows_from_pending():
     with FILE_LOCK:
         src_rows = read_products(DATA_CSV)
-        if not src_rows:
-            return 0, 0
+    if not src_rows:
+        return 0, 0
 
-        src_keys = {_key_of_row(r) for r in src_rows}
-        pending_rows = read_products(PENDING_CSV)
-        if not pending_rows:
-            write_products(PENDING_CSV, [])
-            return 0, 0
-
-        before = len(pending_rows)
-        filtered = [r for r in pending_rows if _key_of_row(r) not in src_keys]
-        removed = before - len(filtered)
-        write_products(PENDING_CSV, filtered)
-        return removed, len(filtered)
+    removed = queue_remove_keys({_queue_key(r) for r in src_rows})
+    return removed, queue_len()
 
 # ========= USD→ILS HELPERS (CSV upload option) =========
 def _decode_csv_bytes(b: bytes) -> str:
@@ -2245,6 +4640,80 @@ def _top_timestamp_gmt8() -> str:
     ts = datetime.now(timezone.utc) + timedelta(hours=8)
     return ts.strftime("%Y-%m-%d %H:%M:%S")
 
+_TOP_RATE_LIMITERS: dict[str, _TokenBucket] = {}
+_TOP_RATE_LOCK = threading.Lock()
+
+def _top_rate_wait(top_url: str):
+    """Per-gateway pacing so concurrent refill/search queries don't burst one gateway."""
+    with _TOP_RATE_LOCK:
+        tb = _TOP_RATE_LIMITERS.get(top_url)
+        if tb is None:
+            tb = _TOP_RATE_LIMITERS[top_url] = _TokenBucket(AE_TOP_RATE_PER_SEC, AE_TOP_RATE_BURST)
+    tb.acquire()
+
+# ========= TOP GATEWAY ROUTER =========
+# שער "דביק": קודם השער האחרון שעבד (AE_TOP_URL), אחריו השאר לפי EWMA של זמן תגובה/שגיאות.
+# שער שהחזיר appkey-not-exists או נפל ברשת נכנס להשהיה (cool-down) ולא נוסה עד שהיא נגמרת.
+AE_TOP_COOLDOWN_APPKEY_SECONDS = _env_int("AE_TOP_COOLDOWN_APPKEY_SECONDS", 6 * 3600)
+AE_TOP_COOLDOWN_NET_SECONDS = _env_int("AE_TOP_COOLDOWN_NET_SECONDS", 120)
+_TOP_GW_EWMA_ALPHA = 0.3
+_TOP_GW_STATS: dict[str, dict] = {}   # url -> {"lat": sec, "err": 0..1, "cool_until": ts, "ok": n, "fail": n}
+_TOP_GW_LOCK = threading.Lock()
+
+def _top_gateway_order() -> list[str]:
+    """Candidates to try, best first: sticky gateway, then healthy ones by score, cooling ones last."""
+    now = time.time()
+    with _TOP_GW_LOCK:
+        stats = {u: dict(_TOP_GW_STATS.get(u) or {}) for u in AE_TOP_URL_CANDIDATES}
+    ready = [u for u in AE_TOP_URL_CANDIDATES if stats[u].get("cool_until", 0) <= now]
+    cooling = sorted((u for u in AE_TOP_URL_CANDIDATES if u not in ready), key=lambda u: stats[u].get("cool_until", 0))
+
+    def _score(u: str) -> float:
+        st = stats[u]
+        return float(st.get("lat", 3.0)) * (1.0 + 3.0 * float(st.get("err", 0.0)))
+
+    ready.sort(key=lambda u: (u != AE_TOP_URL, _score(u), AE_TOP_URL_CANDIDATES.index(u)))
+    return ready + cooling
+
+def _top_gateway_record(top_url: str, ok: bool, latency: float, cooldown: int = 0):
+    global AE_TOP_URL
+    a = _TOP_GW_EWMA_ALPHA
+    with _TOP_GW_LOCK:
+        st = _TOP_GW_STATS.setdefault(top_url, {"lat": float(latency), "err": 0.0, "cool_until": 0.0, "ok": 0, "fail": 0})
+        st["lat"] = (1 - a) * float(st.get("lat", latency)) + a * float(latency)
+        st["err"] = (1 - a) * float(st.get("err", 0.0)) + a * (0.0 if ok else 1.0)
+        if ok:
+            st["ok"] = int(st.get("ok", 0)) + 1
+            st["cool_until"] = 0.0
+        else:
+            st["fail"] = int(st.get("fail", 0)) + 1
+            if cooldown:
+                st["cool_until"] = time.time() + cooldown
+        changed = ok and top_url != AE_TOP_URL
+        if changed:
+            AE_TOP_URL = top_url
+    if changed:
+        log_info(f"[AE] TOP gateway -> {top_url}")
+        try:
+            _set_state_str("top_gateway_url", top_url)
+        except Exception:
+            pass
+    elif not ok and cooldown:
+        log_warn(f"[AE] TOP gateway {top_url} cooling down for {cooldown}s")
+
+def _top_gateway_summary() -> str:
+    now = time.time()
+    parts = []
+    with _TOP_GW_LOCK:
+        for u in AE_TOP_URL_CANDIDATES:
+            st = _TOP_GW_STATS.get(u)
+            if not st:
+                continue
+            host = re.sub(r"^https?://", "", u).split("/")[0]
+            cool = max(0, int(st.get("cool_until", 0) - now))
+            parts.append(f"{host}: {st.get('lat', 0):.2f}s err={st.get('err', 0):.2f}" + (f" cool={cool}s" if cool else ""))
+    return "; ".join(parts) or "no calls yet"
+
 def _top_call(method_name: str, biz_params: dict) -> dict:
     if not AE_APP_KEY or not AE_APP_SECRET:
         raise RuntimeError("חסרים AE_APP_KEY / AE_APP_SECRET ב-ENV")
@@ -2262,8 +4731,12 @@ def _top_call(method_name: str, biz_params: dict) -> dict:
 
     last_err = None
 
-    for top_url in AE_TOP_URL_CANDIDATES:
+    for top_url in _top_gateway_order():
+        answered = False
+        t0 = time.monotonic()
         try:
+            _top_rate_wait(top_url)
+            t0 = time.monotonic()
             if "/sync" in (top_url or "").lower().rstrip("/"):
                 r = SESSION.get(top_url, params=params, timeout=30)
                 if r.status_code in (405, 414):
@@ -2272,6 +4745,7 @@ def _top_call(method_name: str, biz_params: dict) -> dict:
                 r = SESSION.post(top_url, data=params, timeout=30)
             r.raise_for_status()
             payload = r.json()
+            answered = True
 
             # אם יש error_response — נחליט האם לנסות URL נוסף או לזרוק חריגה
             if isinstance(payload, dict) and payload.get("error_response"):
@@ -2284,19 +4758,20 @@ def _top_call(method_name: str, biz_params: dict) -> dict:
                 last_err = f"TOP error {code}: {msg} | sub_code={sub_code} | sub_msg={sub_msg} | url={top_url}"
 
                 # appkey-not-exists בדרך כלל אומר שנפלנו על gateway שלא מכיר את ה-AppKey.
-                # ננסה URL נוסף (גם אם הוגדר AE_TOP_URL ב-ENV), כדי לחסוך הסתבכויות בהגדרה.
+                # ננסה URL נוסף (גם אם הוגדר AE_TOP_URL ב-ENV), והשער הזה נכנס להשהיה ארוכה.
                 if sub_code == "isv.appkey-not-exists" or code == 29:
+                    _top_gateway_record(top_url, False, time.monotonic() - t0, cooldown=AE_TOP_COOLDOWN_APPKEY_SECONDS)
                     continue
 
                 raise RuntimeError(last_err)
 
-            # הצלחה: נשמור את ה-URL שעבד (כדי שכל הקריאות הבאות ישתמשו בו)
-            global AE_TOP_URL
-            AE_TOP_URL = top_url
+            # הצלחה: השער הזה הופך לדביק (ונשמר ל-BOT_STATE)
+            _top_gateway_record(top_url, True, time.monotonic() - t0)
             return payload
 
         except Exception as e:
-            # אם זה לא היה error_response אלא בעיית רשת/HTTP — נשמור וננסה URL הבא
+            # שגיאת רשת/HTTP -> השהיה קצרה לשער. error_response רגיל -> השער חי, רק נספר כשגיאה.
+            _top_gateway_record(top_url, False, time.monotonic() - t0, cooldown=0 if answered else AE_TOP_COOLDOWN_NET_SECONDS)
             last_err = f"TOP request failed via {top_url}: {type(e).__name__}: {e}"
             continue
 
@@ -2761,7 +5236,7 @@ def _map_affiliate_product_to_row(p: dict) -> dict:
     if not buy_link:
         buy_link = detail_url
 
-    return normalize_row_keys(
+    row = normalize_row_keys(
         {
             "ItemId": product_id,
             "CategoryId": cat_id,
@@ -2788,12 +5263,48 @@ def _map_affiliate_product_to_row(p: dict) -> dict:
             "Strengths": "",
             "Video Url": (p.get("product_video_url") or "").strip(),
             "AIState": "raw",
+            "RefreshedAt": f"{time.time():.0f}",
         }
     )
-def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_selected_categories: bool = False) -> tuple[int, int, int, int, str | None]:
+    catalog_note(row)
+    return row
+
+def _run_concurrent(tasks: list, max_workers: int, name: str = "worker", on_done=None, cancel=None) -> list:
+    """Run zero-arg callables on a bounded thread pool.
+
+    Returns one entry per task, in task order: the return value, or the exception it raised.
+    on_done(done, total) is called after each task; once `cancel` (Event) is set, tasks that
+    have not started are cancelled and come back as CancelledError.
+    """
+    if not tasks:
+        return []
+    out: list = [None] * len(tasks)
+    workers = max(1, min(int(max_workers or 1), len(tasks)))
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) as ex:
+        futs = {ex.submit(fn): i for i, fn in enumerate(tasks)}
+        for f in as_completed(futs):
+            try:
+                out[futs[f]] = f.result()
+            except Exception as e:
+                out[futs[f]] = e
+            done += 1
+            if cancel is not None and cancel.is_set():
+                for ff in futs:
+                    ff.cancel()
+            if on_done:
+                try:
+                    on_done(done, len(tasks))
+                except Exception:
+                    pass
+    return out
+
+def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_selected_categories: bool = False,
+                          on_progress=None, cancel=None) -> tuple[int, int, int, int, str | None]:
     """מילוי תור מהממשק Affiliate.
 
     מחזיר: (added, duplicates, total_after, last_page_checked, last_error)
+    on_progress(text) מקבל עדכוני התקדמות; cancel (Event) עוצר את הריצה בלי להוסיף לתור.
 
     יעדים:
     - גיוון: איסוף ממספר מילות מפתח בסבב (Round-Robin) כדי לא לקבל "כל הזמן אותו הדבר".
@@ -2803,28 +5314,25 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
     if not AE_APP_KEY or not AE_APP_SECRET or not AE_TRACKING_ID:
         return 0, 0, 0, 0, "חסרים AE_APP_KEY/AE_APP_SECRET/AE_TRACKING_ID"
 
-    # snapshot of current filters
+    # snapshot of current filters (compiled once for the whole cycle)
     min_orders = int(MIN_ORDERS or 0)
     min_rating = float(MIN_RATING or 0.0)
-    free_ship_only = bool(FREE_SHIP_ONLY) and (not AE_FORCE_USD_ONLY)
     min_commission = float(MIN_COMMISSION or 0.0)
+    free_ship_only = bool(FREE_SHIP_ONLY) and (not AE_FORCE_USD_ONLY)
+    row_filter_cycle = row_filter(free_ship=free_ship_only)
 
     diversify = str(os.environ.get('AE_REFILL_DIVERSIFY', '1') or '1').strip().lower() not in ('0', 'false', 'no', 'off')
     kw_per_cycle = safe_int(os.environ.get('AE_REFILL_KEYWORDS_PER_CYCLE', '6'), 6)
     pages_per_kw = max(1, safe_int(os.environ.get('AE_REFILL_PAGES_PER_KEYWORD', '1'), 1))
     max_per_bucket = max(1, safe_int(os.environ.get('AE_REFILL_MAX_PER_BUCKET', '4'), 4))
 
-    with FILE_LOCK:
-        pending_rows = read_products(PENDING_CSV)
-        existing_keys = {_key_of_row(r) for r in pending_rows}
-
-    # global dedup history (already sent/queued in the past X days)
-    seen_ids, seen_tfps = _dedup_sets()
-
-    
+    existing_keys = queue_keys()
 
-    # cycle-local title-fingerprint dedup (prevents near duplicates within the same refill batch)
+    # global dedup history (already sent/queued in the past X days): dedup_has_id / dedup_has_tfp
+    # cycle-local id / title-fingerprint dedup (prevents near duplicates within the same refill batch)
+    seen_ids_cycle: set[str] = set()
     seen_tfps_cycle: set[str] = set()
+    near_cycle = _SimIndex()
     added = 0
     dup = 0
     skipped_no_link = 0
@@ -2876,32 +5384,10 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
 
     def _passes_filters(row: dict) -> bool:
         nonlocal skipped_price
-        if AE_PRICE_BUCKETS:
-            sale_num = _extract_float(row.get("SalePrice") or "")
-            if sale_num is None or not _price_in_buckets(float(sale_num), AE_PRICE_BUCKETS):
-                skipped_price += 1
-                return False
-        if min_orders:
-            o = safe_int(row.get("Orders") or "0", 0)
-            if o < min_orders:
-                return False
-        if min_rating:
-            r = _extract_float(row.get("Rating") or "")
-            if r is None or float(r) < min_rating:
-                return False
-        if min_commission:
-            c = _commission_percent(row.get("CommissionRate") or "")
-            c = float(c or 0.0)
-            if c < float(min_commission):
-                return False
-        if free_ship_only:
-            # in this bot logic: treat "free ship" threshold as min sale price
-            sale_num = _extract_float(row.get("SalePrice") or "")
-            if sale_num is None or float(sale_num) < float(AE_FREE_SHIP_THRESHOLD_ILS):
-                return False
-        if not row.get("BuyLink"):
-            return False
-        return True
+        kind, _ = row_filter_cycle(row)
+        if kind == "price":
+            skipped_price += 1
+        return not kind
 
     # -------- categories selected (optional) --------
     selected_cats = [] if ignore_selected_categories else get_selected_category_ids()
@@ -2936,11 +5422,22 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
             dup += 1
             return
 
-        if item_id and item_id in seen_ids:
+        if item_id and (item_id in seen_ids_cycle or dedup_has_id(item_id)):
+            dup += 1
+            return
+
+        if dedup_title_global and tfp and dedup_has_tfp(tfp):
+            dup += 1
+            return
+
+        # long-horizon tier: anything ever sent (beyond DEDUP_KEEP_DAYS / DEDUP_MAX_RECORDS)
+        if dedup_long_has(item_id, tfp if dedup_title_global else ""):
             dup += 1
             return
 
-        if dedup_title_global and tfp and tfp in seen_tfps:
+        # near-identical title (reordered words / model numbers) in the queue, recent sends or this cycle
+        sh = _title_simhash(_near_title(row)) if AE_NEAR_DUP_ENABLED else 0
+        if sh and near_dup_of(row, extra=near_cycle, h=sh):
             dup += 1
             return
 
@@ -2949,24 +5446,24 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
             return
 
         existing_keys.add(k)
+        near_cycle.add(k, sh)
         if item_id:
-            seen_ids.add(item_id)
+            seen_ids_cycle.add(item_id)
         if tfp:
             seen_tfps_cycle.add(tfp)
-            if str(os.environ.get("AE_DEDUP_TITLE_FINGERPRINT", "0")).strip() == "1":
-                seen_tfps.add(tfp)
         candidates.append((row, bucket))
         bucket_after_filters[bucket] = bucket_after_filters.get(bucket, 0) + 1
 
     # Fetching strategy
     kw_list = _choose_keywords_for_cycle()
 
+    per_cat = []
+    max_pages_per_cat = 1
     if selected_cats:
         # distribute max_needed across selected categories, still with keyword variety per category
         n = len(selected_cats)
         base = max_needed // n
         rem = max_needed % n
-        per_cat = []
         for i, cid in enumerate(selected_cats):
             need = base + (1 if i < rem else 0)
             if need > 0:
@@ -2975,15 +5472,59 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
         # pages per category is limited
         max_pages_per_cat = max(1, AE_REFILL_MAX_PAGES // max(1, len(per_cat)))
 
+    # -------- fetch stage (concurrent) --------
+    # כל השאילתות (קטגוריה × מילת מפתח × עמוד) יוצאות במקביל (AE_REFILL_CONCURRENCY, עם קצב לכל gateway).
+    # העיבוד שלמטה עובר על התוצאות באותו סדר כמו בריצה הסדרתית, כך שהבחירה לא תלויה בסדר החזרה.
+    start_pages = {ki: random.randint(1, max(1, safe_int(os.environ.get('AE_REFILL_START_PAGE_MAX', '3'), 3))) for ki in range(len(kw_list))}
+    plan: list[tuple] = []
+    if per_cat:
+        for (cat_id, _need) in per_cat:
+            for ki, kw_used in enumerate(kw_list):
+                for page_no in range(1, max_pages_per_cat + 1):
+                    plan.append(((cat_id, ki, page_no), lambda c=cat_id, k=kw_used, pn=page_no: affiliate_product_query(pn, AE_REFILL_PAGE_SIZE, category_id=str(c), keywords=k)))
+    else:
+        for ki, kw_used in enumerate(kw_list):
+            for page_no in range(start_pages[ki], start_pages[ki] + pages_per_kw):
+                if kw_used:
+                    plan.append(((None, ki, page_no), lambda k=kw_used, pn=page_no: affiliate_product_query(pn, AE_REFILL_PAGE_SIZE, category_id=None, keywords=k)))
+                else:
+                    plan.append(((None, ki, page_no), lambda pn=page_no: affiliate_hotproduct_query(pn, AE_REFILL_PAGE_SIZE)))
+    def _report(text: str):
+        if on_progress:
+            try:
+                on_progress(text)
+            except Exception:
+                pass
+
+    def _cancelled() -> bool:
+        return cancel is not None and cancel.is_set()
+
+    t_fetch = time.time()
+    fetched = dict(zip([key for key, _ in plan], _run_concurrent(
+        [fn for _, fn in plan], AE_REFILL_CONCURRENCY, name="refill",
+        on_done=lambda d, t: _report(f"🔎 שאילתות: {d}/{t}"), cancel=cancel)))
+    logging.info(f"[REFILL] fetched {len(plan)} queries in {time.time() - t_fetch:.1f}s (concurrency={AE_REFILL_CONCURRENCY})")
+    if _cancelled():
+        return 0, dup, queue_len(), last_page, "בוטל"
+
+    def _fetched(key: tuple):
+        res = fetched.get(key)
+        if isinstance(res, Exception):
+            raise res
+        if res is None:
+            raise RuntimeError("query was not fetched")
+        return res
+
+    if per_cat:
         for (cat_id, need_cat) in per_cat:
             got_cat = 0
-            for kw_used in kw_list:
+            for ki, kw_used in enumerate(kw_list):
                 if got_cat >= need_cat or len(candidates) >= (max_needed * 5):
                     break
                 for page_no in range(1, max_pages_per_cat + 1):
                     last_page = page_no
                     try:
-                        products, resp_code, resp_msg = affiliate_product_query(page_no, AE_REFILL_PAGE_SIZE, category_id=str(cat_id), keywords=kw_used)
+                        products, resp_code, resp_msg = _fetched((cat_id, ki, page_no))
                         # treat empty as end-of-results
                         if resp_msg and 'result is empty' in str(resp_msg).lower():
                             products = []
@@ -3026,18 +5567,15 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
         # strategy:
         # - if we have kw_list with real keywords => query product.query per keyword (pages_per_kw)
         # - else => use hotproduct
-        for kw_used in kw_list:
+        for ki, kw_used in enumerate(kw_list):
             if len(candidates) >= (max_needed * 5):
                 break
-            start_page = random.randint(1, max(1, safe_int(os.environ.get('AE_REFILL_START_PAGE_MAX', '3'), 3)))
+            start_page = start_pages[ki]
 
             for page_no in range(start_page, start_page + pages_per_kw):
                 last_page = page_no
                 try:
-                    if kw_used:
-                        products, resp_code, resp_msg = affiliate_product_query(page_no, AE_REFILL_PAGE_SIZE, category_id=None, keywords=kw_used)
-                    else:
-                        products, resp_code, resp_msg = affiliate_hotproduct_query(page_no, AE_REFILL_PAGE_SIZE)
+                    products, resp_code, resp_msg = _fetched((None, ki, page_no))
 
                     if resp_msg and 'result is empty' in str(resp_msg).lower():
                         products = []
@@ -3071,6 +5609,8 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
                         continue
                     _add_candidate(row, b)
 
+    _report(f"🔎 שאילתות: {len(plan)}/{len(plan)} • מועמדים: {len(candidates)} • כפולים: {dup}")
+
     # -------- Diversified selection into queue --------
     # group by bucket
     by_bucket: dict[str, list[dict]] = {}
@@ -3150,7 +5690,9 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
     # AI enrichment (optional) before writing
     if ai_auto_mode() and GPT_ON_REFILL and selected:
         try:
-            upd, err = ai_enrich_rows(selected, reason="refill_from_affiliate")
+            upd, err = ai_enrich_rows(selected, reason="refill_from_affiliate",
+                                      progress=lambda d, t, u: _report(f"🤖 AI: באצ' {d}/{t} • עודכנו {u}/{len(selected)}"),
+                                      cancel=cancel)
             if err:
                 logging.warning(f"[AI] enrich warning: {err}")
             elif upd:
@@ -3158,15 +5700,10 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
         except Exception as _e:
             logging.warning(f"[AI] enrich failed: {_e}")
 
-    if selected:
-        with FILE_LOCK:
-            pending_rows = read_products(PENDING_CSV)
-            pending_rows.extend(selected)
-            write_products(PENDING_CSV, pending_rows)
-        added = len(selected)
+    if _cancelled():
+        return 0, dup, queue_len(), last_page, "בוטל"
 
-    with FILE_LOCK:
-        total_after = len(read_products(PENDING_CSV))
+    added, _, total_after = queue_add_rows(selected)
 
     # If we found nothing, provide a helpful message
     if added == 0 and not last_error:
@@ -3181,6 +5718,152 @@ def refill_from_affiliate(max_needed: int, keywords: str | None = None, ignore_s
         last_error = "לא נמצאו תוצאות שמתאימות לסינונים" + (" (" + ", ".join(msg) + ")" if msg else "")
 
     return added, dup, total_after, last_page, last_error
+
+# ========= QUEUE DETAIL REFRESH =========
+# פריטים יכולים לחכות בתור ימים: מחיר / הנחה / קישור / מכירות מתיישנים. כאן שורות התור נבדקות מחדש
+# ב-aliexpress.affiliate.productdetail.get — הרבה ItemIds בכל קריאה, כמה קריאות במקביל (קצב TOP
+# נאכף ב-_top_call) — ומתעדכנות במקום. מוצר שלא חזר בתשובה (לא זמין) או שמחירו זז מעבר לסף יוצא מהתור.
+# ה-thread של POST LOOK-AHEAD מרענן את הפריטים הבאים לפני שהם מוכנים לשליחה; /refresh_queue מרענן את כל התור.
+AE_REFRESH_ENABLED = env_bool("AE_REFRESH_ENABLED", True)
+AE_REFRESH_BATCH = max(1, min(50, _env_int("AE_REFRESH_BATCH", 20)))
+AE_REFRESH_MAX_AGE_HOURS = max(1, _env_int("AE_REFRESH_MAX_AGE_HOURS", 12))
+AE_REFRESH_AHEAD = max(0, _env_int("AE_REFRESH_AHEAD", 10))
+AE_REFRESH_MAX_PRICE_CHANGE_PCT = float(os.getenv("AE_REFRESH_MAX_PRICE_CHANGE_PCT", "25") or 25)  # 0 = לא מוחקים על שינוי מחיר
+_REFRESH_FIELDS = ("Discount", "Rating", "Orders", "CommissionRate", "PriceIsFrom", "OriginalIsFrom")
+AE_REFRESH_RETRY_SECONDS = max(60, _env_int("AE_REFRESH_RETRY_SECONDS", 900))  # המתנה לפני ניסיון חוזר של ids שהקריאה עליהם נכשלה
+_REFRESH_LOCK = threading.Lock()
+_REFRESH_FAILED: dict[str, float] = {}  # ItemId -> זמן הכישלון האחרון (backoff בזמן תקלת API)
+
+def affiliate_product_detail(item_ids: list[str]) -> dict:
+    """One productdetail.get call for many ids. Returns product_id -> product dict (missing = unavailable)."""
+    payload = _top_call("aliexpress.affiliate.productdetail.get", {
+        "tracking_id": AE_TRACKING_ID,
+        "product_ids": ",".join(item_ids),
+        "target_currency": AE_TARGET_CURRENCY,
+        "target_language": AE_TARGET_LANGUAGE,
+        "country": AE_SHIP_TO_COUNTRY,
+    })
+    resp = _extract_resp_result(payload)
+    resp_code = safe_int(resp.get("resp_code"), 200)
+    resp_msg = str(resp.get("resp_msg") or "")
+    if resp_code != 200 and "empty" not in resp_msg.lower():
+        raise RuntimeError(f"productdetail.get resp_code={resp_code} resp_msg={resp_msg}")
+    result = resp.get("result") or {}
+    products = result.get("products") or result.get("product_list") or []
+    if isinstance(products, dict) and "product" in products:
+        products = products.get("product") or []
+    if not isinstance(products, list):
+        products = [products]
+    return {str(p.get("product_id") or "").strip(): p for p in products if isinstance(p, dict)}
+
+def _row_base_price(row: dict) -> float | None:
+    """Sale price before the post-AI ILS conversion (comparable with a fresh mapping)."""
+    raw = row.get("SalePriceUSD") if str(row.get("PriceConverted") or "") == "1" else row.get("SalePrice")
+    v = _extract_float(clean_price_text(str(raw or row.get("SalePriceUSD") or "")))
+    return float(v) if v else None
+
+def _refresh_row(row: dict, p: dict) -> tuple[dict, float | None]:
+    """Fresh price/discount/link/sales fields for a queued row. Returns (changes, price change %)."""
+    fresh = _map_affiliate_product_to_row(p)
+    old, new = _row_base_price(row), _row_base_price(fresh)
+    moved = abs(new - old) / old * 100.0 if old and new else None
+    changes = {k: fresh.get(k, "") for k in _REFRESH_FIELDS}
+    for k in ("SalePrice", "SalePriceUSD", "OriginalPrice", "OriginalPriceUSD"):
+        if fresh.get(k):
+            changes[k] = fresh[k]
+    if str(fresh.get("BuyLink") or "").strip():
+        changes["BuyLink"] = fresh["BuyLink"]
+    changes["RefreshedAt"] = f"{time.time():.0f}"
+    return changes, moved
+
+def _refresh_merge(row: dict, changes: dict) -> dict:
+    out = dict(row)
+    out.update(changes)
+    if str(row.get("PriceConverted") or "") == "1":
+        # המחיר החדש נשמר כבסיס, וההמרה אחרי AI מחושבת מחדש לפי השער הנוכחי
+        out["PriceConverted"] = ""
+        out["DisplayCurrency"] = "USD"
+        maybe_convert_prices_after_ai(out, reason="refresh")
+    return out
+
+def refresh_queue_details(rows: list[dict] | None = None, force: bool = False, on_progress=None, cancel=None,
+                          blocking: bool = True) -> Counter:
+    """Refresh queued rows (default: the whole queue) that were not refreshed in AE_REFRESH_MAX_AGE_HOURS.
+
+    Ids whose batch failed are skipped for AE_REFRESH_RETRY_SECONDS (unless force). With blocking=False
+    nothing is done while another refresh is running.
+    Returns counts: checked / updated / gone / price / failed.
+    """
+    stats = Counter()
+    if not AE_APP_KEY or not AE_APP_SECRET:
+        return stats
+    if not _REFRESH_LOCK.acquire(blocking=blocking):  # ריצה אחת בכל פעם (רקע + /refresh_queue)
+        return stats
+    try:
+        rows = queue_rows() if rows is None else rows
+        now = time.time()
+        cutoff = now - AE_REFRESH_MAX_AGE_HOURS * 3600
+        todo = [r for r in rows
+                if str(r.get("ItemId") or "").strip().isdigit() and r.get("_qkey")
+                and (force or _extract_float(str(r.get("RefreshedAt") or "")) is None or float(_extract_float(str(r.get("RefreshedAt")))) < cutoff)
+                and (force or now - _REFRESH_FAILED.get(str(r["ItemId"]).strip(), 0.0) >= AE_REFRESH_RETRY_SECONDS)]
+        if not todo:
+            return stats
+        batches = [todo[i:i + AE_REFRESH_BATCH] for i in range(0, len(todo), AE_REFRESH_BATCH)]
+
+        def _done(done, total):
+            if on_progress:
+                on_progress(f"נבדקו {min(done * AE_REFRESH_BATCH, len(todo))}/{len(todo)} פריטים")
+
+        results = _run_concurrent(
+            [lambda b=b: affiliate_product_detail([str(r["ItemId"]).strip() for r in b]) for b in batches],
+            AE_REFILL_CONCURRENCY, name="refresh", on_done=_done, cancel=cancel)
+
+        changes, drop = {}, []
+        for batch, res in zip(batches, results):
+            if isinstance(res, BaseException):
+                stats["failed"] += len(batch)
+                if not cancel or not cancel.is_set():
+                    log_warn(f"[REFRESH] batch of {len(batch)} failed: {res}")
+                    for r in batch:
+                        _REFRESH_FAILED[str(r["ItemId"]).strip()] = time.time()
+                continue
+            for r in batch:
+                _REFRESH_FAILED.pop(str(r["ItemId"]).strip(), None)
+                stats["checked"] += 1
+                p = res.get(str(r["ItemId"]).strip())
+                if p is None:
+                    stats["gone"] += 1
+                    drop.append(r["_qkey"])
+                    log_info(f"[REFRESH] ItemId={r['ItemId']} no longer available -> removed from queue")
+                    continue
+                ch, moved = _refresh_row(r, p)
+                if AE_REFRESH_MAX_PRICE_CHANGE_PCT > 0 and moved is not None and moved > AE_REFRESH_MAX_PRICE_CHANGE_PCT:
+                    stats["price"] += 1
+                    drop.append(r["_qkey"])
+                    log_info(f"[REFRESH] ItemId={r['ItemId']} price moved {moved:.0f}% -> removed from queue")
+                    continue
+                changes[r["_qkey"]] = ch
+
+        # השינויים מוחלים על השורה העדכנית בתור (ייתכן ש-AI עדכן אותה בזמן הקריאות)
+        current = {r["_qkey"]: r for r in queue_rows()}
+        updates = [_refresh_merge(current[k], ch) for k, ch in changes.items() if k in current]
+        stats["updated"] = queue_update_rows(updates) if updates else 0
+        if drop:
+            queue_remove_keys(drop)
+        for item_id in [k for k, ts in _REFRESH_FAILED.items() if now - ts >= AE_REFRESH_RETRY_SECONDS]:
+            _REFRESH_FAILED.pop(item_id, None)
+    finally:
+        _REFRESH_LOCK.release()
+    log_info(f"[REFRESH] checked={stats['checked']} updated={stats['updated']} gone={stats['gone']} price={stats['price']} failed={stats['failed']}")
+    return stats
+
+def refresh_upcoming():
+    """Refresh the next ready rows (stale ones only) before they are prepared and sent.
+    Skipped while /refresh_queue runs, so the look-ahead thread keeps preparing posts."""
+    if AE_REFRESH_ENABLED and AE_REFRESH_AHEAD:
+        refresh_queue_details(queue_peek_ready(AE_REFRESH_AHEAD), blocking=False)
+
 def _active_price_bucket_ids():
     raw = (AE_PRICE_BUCKETS_RAW or "").strip()
     if not raw:
@@ -3602,6 +6285,82 @@ MANUAL_SEARCH_MSG: dict[int, tuple[int,int]] = {}  # uid -> (chat_id, message_id
 MS_AI_RERANK_DEFAULT = env_bool("MS_AI_RERANK", True)
 MS_AI_RERANK = _get_state_bool("ms_ai_rerank", MS_AI_RERANK_DEFAULT)
 
+# --- Manual search response cache ---
+# שני רבדים: תשובות TOP גולמיות לפי (מילות חיפוש, קטגוריה, עמוד, גודל עמוד, מיון, שפה, מטבע), ותוצאות
+# מוערכות (מיפוי + סינון + התאמת מילים + rerank) לפי אותו מפתח + וריאנטי השאילתה וחתימת הסינון.
+# מעבר בין עמודים / "התאמה חלקית" / חיפוש חוזר לא קוראים ל-TOP ול-AI עד שהרשומה פגה.
+MS_CACHE_TTL_SECONDS = max(0, _env_int("MS_CACHE_TTL_SECONDS", 600))
+MS_CACHE_MAX_ENTRIES = max(1, _env_int("MS_CACHE_MAX_ENTRIES", 64))
+
+class _TTLCache:
+    """Small thread-safe LRU with a per-entry TTL (ttl<=0 disables caching)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._d: "OrderedDict[object, tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            ent = self._d.get(key)
+            if ent is None or time.time() - ent[0] > self.ttl:
+                if ent is not None:
+                    del self._d[key]
+                self.misses += 1
+                return None
+            self._d.move_to_end(key)
+            self.hits += 1
+            return ent[1]
+
+    def put(self, key, value, ts: float | None = None):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._d[key] = (time.time() if ts is None else ts, value)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+_MS_TOP_CACHE = _TTLCache(MS_CACHE_MAX_ENTRIES, MS_CACHE_TTL_SECONDS)
+_MS_EVAL_CACHE = _TTLCache(MS_CACHE_MAX_ENTRIES, MS_CACHE_TTL_SECONDS)
+
+def _ms_query_key(q: str, cat_id, page: int, per_page: int) -> tuple:
+    return (str(q or "").strip().lower(), str(cat_id or ""), int(page), int(per_page),
+            AE_REFILL_SORT, AE_TARGET_LANGUAGE, AE_TARGET_CURRENCY, AE_SHIP_TO_COUNTRY)
+
+def _ms_product_query_cached(qkey: tuple, page: int, per_page: int, cat_id, q: str):
+    """affiliate_product_query through the raw-response cache. Returns (products, code, msg, fetched_ts)."""
+    hit = _MS_TOP_CACHE.get(qkey)
+    if hit is not None:
+        return hit
+    products, resp_code, resp_msg = affiliate_product_query(page, per_page, category_id=cat_id, keywords=q)
+    out = (products, resp_code, resp_msg, time.time())
+    if products and safe_int(resp_code, 200) == 200:  # תשובות ריקות/שגיאה לא נשמרות
+        _MS_TOP_CACHE.put(qkey, out, ts=out[3])
+    return out
+
+def _ms_eval_sig() -> tuple:
+    """Everything besides the TOP response that changes how a page is mapped, filtered and ranked."""
+    return (AE_PRICE_BUCKETS_RAW, MIN_ORDERS, MIN_RATING, MIN_COMMISSION, FREE_SHIP_ONLY,
+            AE_PRICE_INPUT_CURRENCY, AE_PRICE_CONVERT_USD_TO_ILS, USD_TO_ILS_RATE,
+            _display_currency_code(), ms_ai_rerank_enabled())
+
+def _ms_sess_copy(sess: dict) -> dict:
+    """Copy a search session deep enough that the UI can mutate rows/results freely."""
+    out = dict(sess)
+    out["results"] = [{**it, "row": dict(it.get("row") or {})} for it in sess.get("results") or []]
+    for k in ("passed_filters_rows", "keyword_rejected_rows"):
+        out[k] = [dict(r) for r in sess.get(k) or []]
+    out["reasons"] = dict(sess.get("reasons") or {})
+    return out
+
 def ms_ai_rerank_enabled() -> bool:
     return bool(MS_AI_RERANK) and _ai_enabled()
 
@@ -3848,6 +6607,154 @@ def _ms_ai_rewrite_query(q_user: str) -> tuple[str, list[str]]:
         return out
 
 
+# --- Manual search keyword matcher ---
+# צד השאילתה מקומפל פעם אחת לכל סט וריאנטים: טוקנים מנורמלים + מילים נרדפות + טוקני ציון החפיפה,
+# כולם ב-regex אחד (lookahead, כדי לתפוס גם התאמות חופפות). כל כותרת נסרקת פעם אחת ומחזירה
+# strict / relaxed / overlap יחד.
+_MS_HEB_RE = re.compile(r"[א-ת]")
+_MS_LAT_RE = re.compile(r"[a-z]")
+
+_MS_STOP = {
+    # English
+    "for","with","and","the","a","an","to","of","in","on","at","from","by","set","kit","pack","pcs","pc",
+    "new","hot","best","top","quality","original","sale","shipping","free","fast",
+    # Query-specific noise
+    "house","home","indoor","outdoor","men","man","women","woman","kids","kid","child","children","unisex",
+    "brand","model","size","color","colour","type",
+}
+
+_MS_SYNONYMS = {
+    # shoes / footwear
+    "shoe": ["shoes", "sneaker", "sneakers", "boots", "boot", "sandals", "slippers", "loafers"],
+    "shoes": ["shoe", "sneaker", "sneakers", "boots", "boot", "sandals", "slippers", "loafers"],
+    "sneaker": ["sneakers", "shoes", "shoe", "trainers"],
+    "sneakers": ["sneaker", "shoes", "shoe", "trainers"],
+    # watch
+    "watch": ["watches", "smartwatch", "smart watch"],
+    "watches": ["watch", "smartwatch", "smart watch"],
+    "smartwatch": ["smart watch", "watch", "watches"],
+    # headphones / earbuds
+    "headphones": ["headset", "earbuds", "ear phones", "earphones"],
+    "earbuds": ["headphones", "earphones"],
+    "earphones": ["earbuds", "headphones"],
+    # phone accessories
+    "phone": ["smartphone", "mobile"],
+    "case": ["cover", "shell"],
+    "charger": ["charging", "adapter", "power"],
+    # generic (avoid too broad)
+}
+
+def _ms_norm_tok(tok: str) -> str:
+    x = (tok or "").strip().lower()
+    x = re.sub(r"[^0-9a-zA-Zא-ת]+", "", x)
+    if len(x) >= 4 and x.endswith("s") and (not _MS_HEB_RE.search(x)):
+        x = x[:-1]
+    return x
+
+def _ms_token_options(tok: str) -> list[str]:
+    tok = _ms_norm_tok(tok)
+    if not tok or tok in _MS_STOP:
+        return []
+    opts = [tok]
+    opts += _MS_SYNONYMS.get(tok, [])
+    # normalize + dedupe
+    clean = []
+    for o in opts:
+        oo = _ms_norm_tok(o)
+        if oo and oo not in _MS_STOP:
+            clean.append(oo)
+    return list(dict.fromkeys(clean))
+
+class _MsMatcher:
+    """Query variants compiled for repeated title scans (see _ms_matcher)."""
+
+    def __init__(self, queries):
+        if isinstance(queries, str):
+            queries = [queries]
+        self.empty = not [q for q in (queries or []) if q]
+        # per variant: (is_hebrew, [option-group, ...]) — each group is a frozenset of options
+        self.variants: list[tuple[bool, list[frozenset]]] = []
+        # per variant: raw \w tokens for the overlap score (duplicates kept, like the original score)
+        self.overlap_toks: list[list[str]] = []
+        words = set()
+        for q in (queries or []):
+            qq = (q or "").lower().strip()
+            if not qq:
+                continue
+            toks = [tok for tok in re.split(r"[^\w]+", qq) if len(tok) > 1]
+            if toks:
+                self.overlap_toks.append(toks)
+                words.update(toks)
+            norm = [nx for nx in (_ms_norm_tok(x) for x in re.split(r"[^0-9a-zA-Zא-ת]+", qq) if x)
+                    if nx and len(nx) >= 2 and nx not in _MS_STOP]
+            if not norm:
+                # fallback to whole query (normalized)
+                nq = _ms_norm_tok(qq)
+                norm = [nq] if nq else []
+            groups = [frozenset(opts) for opts in (_ms_token_options(tok) for tok in norm) if opts]
+            for g in groups:
+                words.update(g)
+            self.variants.append((bool(_MS_HEB_RE.search(qq)), groups))
+        # ארוכים קודם: ב-lookahead נתפס רק החלופה הראשונה בכל מיקום, ומה שמוכל בה מושלם דרך implied
+        ordered = sorted(words, key=len, reverse=True)
+        self._re = re.compile("(?=(" + "|".join(re.escape(w) for w in ordered) + "))") if ordered else None
+        self._implied = {w: frozenset(o for o in ordered if o in w) for w in ordered}
+
+    def _found(self, t: str) -> set:
+        found = set()
+        if self._re is not None:
+            for m in set(self._re.findall(t)):
+                found |= self._implied[m]
+        return found
+
+    def scan(self, title: str) -> tuple[bool, bool, float]:
+        """(strict match, relaxed match, overlap score 0..1) for one title in a single pass."""
+        t = (title or "").lower()
+        if not t:
+            return False, False, 0.0
+        if self.empty:
+            return True, True, 0.0
+        found = self._found(t)
+        overlap = max((sum(1 for tok in toks if tok in found) / len(toks) for toks in self.overlap_toks), default=0.0)
+
+        variants = self.variants
+        # If title is not Hebrew, ignore Hebrew-only query variants (prevents accidental strict failures)
+        if _MS_LAT_RE.search(t) and not _MS_HEB_RE.search(t):
+            variants = [v for v in variants if not v[0]] or variants
+        strict = relaxed = False
+        for _, groups in variants:
+            if not groups:
+                continue
+            hits = sum(1 for g in groups if not g.isdisjoint(found))
+            if hits == len(groups):
+                strict = relaxed = True
+                break
+            if hits >= (1 if len(groups) <= 2 else 2):
+                relaxed = True
+        return strict, relaxed, overlap
+
+    def match(self, title: str, strict: bool = True) -> bool:
+        s, r, _ = self.scan(title)
+        return s if strict else r
+
+_MS_MATCHERS: "OrderedDict[tuple, _MsMatcher]" = OrderedDict()
+_MS_MATCHERS_LOCK = threading.Lock()
+
+def _ms_matcher(queries) -> _MsMatcher:
+    """Compiled matcher for these query variants (small LRU, shared across pages of a search)."""
+    key = (queries,) if isinstance(queries, str) else tuple(q for q in (queries or []) if q)
+    with _MS_MATCHERS_LOCK:
+        m = _MS_MATCHERS.get(key)
+        if m is not None:
+            _MS_MATCHERS.move_to_end(key)
+            return m
+    m = _MsMatcher(list(key))
+    with _MS_MATCHERS_LOCK:
+        _MS_MATCHERS[key] = m
+        while len(_MS_MATCHERS) > 32:
+            _MS_MATCHERS.popitem(last=False)
+    return m
+
 def _ms_keyword_match(title: str, queries, strict: bool = True) -> bool:
     """Keyword match for manual search.
 
@@ -3859,152 +6766,18 @@ def _ms_keyword_match(title: str, queries, strict: bool = True) -> bool:
     Notes:
     - If the product title is Latin and a query variant is Hebrew, we ignore that Hebrew variant.
     - We drop common stopwords ("for", "with", "house", etc.) so queries like "house slippers" don't fail.
+    - The query side is compiled once per variant set (_ms_matcher); use .scan() for strict+relaxed+overlap at once.
     """
     try:
-        t = (title or "").lower()
-        if not t:
-            return False
-
-        # Normalize inputs: allow string or list of strings
-        if isinstance(queries, str):
-            q_list = [queries]
-        else:
-            q_list = [q for q in (queries or []) if q]
-
-        if not q_list:
-            return True
-
-        heb_re = re.compile(r"[א-ת]")
-        lat_re = re.compile(r"[a-z]")
-        title_has_hebrew = bool(heb_re.search(t))
-        title_has_latin = bool(lat_re.search(t))
-
-        STOP = {
-            # English
-            "for","with","and","the","a","an","to","of","in","on","at","from","by","set","kit","pack","pcs","pc",
-            "new","hot","best","top","quality","original","sale","shipping","free","fast",
-            # Query-specific noise
-            "house","home","indoor","outdoor","men","man","women","woman","kids","kid","child","children","unisex",
-            "brand","model","size","color","colour","type",
-        }
-
-        def _norm_tok(tok: str) -> str:
-            x = (tok or "").strip().lower()
-            x = re.sub(r"[^0-9a-zA-Zא-ת]+", "", x)
-            if len(x) >= 4 and x.endswith("s") and (not heb_re.search(x)):
-                x = x[:-1]
-            return x
-
-        synonyms = {
-            # shoes / footwear
-            "shoe": ["shoes", "sneaker", "sneakers", "boots", "boot", "sandals", "slippers", "loafers"],
-            "shoes": ["shoe", "sneaker", "sneakers", "boots", "boot", "sandals", "slippers", "loafers"],
-            "sneaker": ["sneakers", "shoes", "shoe", "trainers"],
-            "sneakers": ["sneaker", "shoes", "shoe", "trainers"],
-            # watch
-            "watch": ["watches", "smartwatch", "smart watch"],
-            "watches": ["watch", "smartwatch", "smart watch"],
-            "smartwatch": ["smart watch", "watch", "watches"],
-            # headphones / earbuds
-            "headphones": ["headset", "earbuds", "ear phones", "earphones"],
-            "earbuds": ["headphones", "earphones"],
-            "earphones": ["earbuds", "headphones"],
-            # phone accessories
-            "phone": ["smartphone", "mobile"],
-            "case": ["cover", "shell"],
-            "charger": ["charging", "adapter", "power"],
-            # generic (avoid too broad)
-        }
-
-        def token_options(tok: str) -> list[str]:
-            tok = _norm_tok(tok)
-            if not tok or tok in STOP:
-                return []
-            opts = [tok]
-            opts += synonyms.get(tok, [])
-            # normalize + dedupe
-            clean = []
-            for o in opts:
-                oo = _norm_tok(o)
-                if oo and oo not in STOP:
-                    clean.append(oo)
-            return list(dict.fromkeys(clean))
-
-        # If title is not Hebrew, ignore Hebrew-only query variants (prevents accidental strict failures)
-        if title_has_latin and (not title_has_hebrew):
-            q_list = [qq for qq in q_list if not heb_re.search(str(qq or ""))] or q_list
-
-        for q in q_list:
-            qq = (q or "").lower().strip()
-            if not qq:
-                continue
-
-            toks_raw = [x for x in re.split(r"[^0-9a-zA-Zא-ת]+", qq) if x]
-            toks = []
-            for x in toks_raw:
-                nx = _norm_tok(x)
-                if nx and len(nx) >= 2 and nx not in STOP:
-                    toks.append(nx)
-            if not toks:
-                # fallback to whole query (normalized)
-                nq = _norm_tok(qq)
-                if nq:
-                    toks = [nq]
-                else:
-                    continue
-
-            # Build per-token options (synonyms)
-            per_tok_opts = [token_options(tok) for tok in toks]
-            per_tok_opts = [opts for opts in per_tok_opts if opts]
-            if not per_tok_opts:
-                continue
-
-            if strict:
-                # All token-groups must match, but each group can match any of its options
-                if all(any(opt in t for opt in opts) for opts in per_tok_opts):
-                    return True
-            else:
-                # Count how many token-groups hit
-                hits = 0
-                for opts in per_tok_opts:
-                    if any(opt in t for opt in opts):
-                        hits += 1
-                need = 1 if len(per_tok_opts) <= 2 else 2
-                if hits >= need:
-                    return True
-
-        return False
+        return _ms_matcher(queries).match(title, strict=strict)
     except Exception:
         return False
 
 def _ms_eval_row_filters(row: dict) -> tuple[bool, str]:
     """Return (ok, reason_if_not_ok). Mirrors refill filters so preview matches what will be queued."""
-    # Price buckets
-    if AE_PRICE_BUCKETS:
-        sale_num = _extract_float(row.get("SalePrice") or "")
-        if sale_num is None or not _price_in_buckets(float(sale_num), AE_PRICE_BUCKETS):
-            return False, "מחוץ לסינון מחיר"
-    # Orders
-    if MIN_ORDERS:
-        o = safe_int(row.get("Orders") or "0", 0)
-        if o < int(MIN_ORDERS):
-            return False, f"פחות מ-{MIN_ORDERS} הזמנות"
-    # Rating
-    if MIN_RATING:
-        r = _extract_float(row.get("Rating") or "")
-        if r is None or float(r) < float(MIN_RATING):
-            return False, f"דירוג נמוך מ-{MIN_RATING}%"
-    # Commission
-    if MIN_COMMISSION:
-        c = _commission_percent(row.get("CommissionRate") or "")
-        c = float(c or 0.0)
-        if c < float(MIN_COMMISSION):
-            return False, f"עמלה נמוכה מ-{MIN_COMMISSION:g}%"
     # FREE_SHIP_ONLY: Affiliate responses don't reliably include shipping cost; skip filtering here.
-    # Buy link
-    if not (row.get("BuyLink") or "").strip():
-        return False, "אין קישור רכישה"
-    return True, ""
+    kind, reason = row_filter()(row)
+    return not kind, reason
 
 
 # --- AI semantic rerank for manual search (optional) ---
@@ -4142,7 +6915,16 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
         cats = get_selected_category_ids()
         cat_id = cats[0] if cats else None  # keep it simple: first selected
 
-    products, resp_code, resp_msg = affiliate_product_query(page, per_page, category_id=cat_id, keywords=q)
+    qkey = _ms_query_key(q, cat_id, page, per_page)
+    eval_key = (qkey, tuple(q_variants), bool(relaxed_match), bool(use_selected_categories), _ms_eval_sig())
+    cached = _MS_EVAL_CACHE.get(eval_key)
+    if cached is not None:
+        sess = _ms_sess_copy(cached)
+        log_info(f"[MS] cache hit q_user='{q_user}' q_sent='{q}' page={page} ok={sess.get('ok_count', 0)}")
+        MANUAL_SEARCH_SESS[uid] = sess
+        return sess
+
+    products, resp_code, resp_msg, fetched_ts = _ms_product_query_cached(qkey, page, per_page, cat_id, q)
 
     # Map and evaluate
     results = []
@@ -4151,6 +6933,12 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
     raw_count = 0
     reasons = {"no_link": 0, "price": 0, "orders": 0, "rating": 0, "commission": 0, "free_ship": 0, "keyword": 0, "other": 0}
 
+    matcher = _ms_matcher(q_variants)
+    # Keyword matching: when AI rerank is enabled and available, don't block on strict tokens.
+    # (AI will score semantic relevance). Otherwise, keep strict matching to reduce noise.
+    ai_on = bool(ms_ai_rerank_enabled() and _ai_enabled())
+    kw_strict = bool((not relaxed_match) and (not ai_on))
+
     for p in (products or []):
         raw_count += 1
         row = _map_affiliate_product_to_row(p)
@@ -4158,11 +6946,9 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
         if ok and len(passed_filters_rows) < 50:
             passed_filters_rows.append(row)
 
-        # Keyword matching: when AI rerank is enabled and available, don't block on strict tokens.
-        # (AI will score semantic relevance). Otherwise, keep strict matching to reduce noise.
-        ai_on = bool(ms_ai_rerank_enabled() and _ai_enabled())
-        kw_strict = bool((not relaxed_match) and (not ai_on))
-        if ok and not _ms_keyword_match(row.get("Title") or "", q_variants, strict=kw_strict):
+        # סריקה אחת של הכותרת: strict + relaxed (גם לשלב ה-fallback) + ציון חפיפה למיון
+        m_strict, m_relaxed, m_overlap = matcher.scan(str(row.get("Title") or ""))
+        if ok and not (m_strict if kw_strict else m_relaxed):
             if ai_on:
                 # keep the item for AI to decide, but mark as partial match
                 reason = "התאמה חלקית למילת החיפוש"
@@ -4190,28 +6976,15 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
             else:
                 reasons["other"] += 1
 
-        results.append({"row": row, "ok": ok, "reason": reason})
+        results.append({"row": row, "ok": ok, "reason": reason, "_ms_score": m_overlap, "_ms_relaxed": m_relaxed})
 
     # Sort results so the preview shows the most relevant items first.
-    # We rank by: pass/fail, keyword overlap score, then orders.
-    def _ms_overlap_score(title: str) -> float:
-        t = (title or "").lower()
-        best = 0.0
-        for qv in (q_variants or []):
-            toks = [tok for tok in re.split(r"[^\w]+", (qv or "").lower()) if len(tok) > 1]
-            if not toks:
-                continue
-            hits = sum(1 for tok in toks if tok in t)
-            best = max(best, hits / max(1, len(toks)))
-        return best
-
+    # We rank by: pass/fail, keyword overlap score (from matcher.scan), then orders.
     for it in results:
         try:
             row = it.get("row") or {}
-            it["_ms_score"] = _ms_overlap_score(str(row.get("Title") or ""))
             it["_ms_orders"] = int(float(str(row.get("Orders") or "0").replace(",", ".") or "0"))
         except Exception:
-            it["_ms_score"] = 0.0
             it["_ms_orders"] = 0
 
     results.sort(
@@ -4269,9 +7042,7 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
                     continue
                 if str(it.get("reason") or "").strip() != "לא תואם מילת החיפוש":
                     continue
-                row = it.get("row") or {}
-                title = str(row.get("Title") or "").strip()
-                if _ms_keyword_match(title, q_variants, strict=False):
+                if it.get("_ms_relaxed"):
                     it["ok"] = True
                     it["reason"] = ""
                     changed += 1
@@ -4300,6 +7071,9 @@ def _ms_fetch_page(uid: int, q: str, page: int, per_page: int = 10, use_selected
         f"display={_display_currency_code()}"
     )
 
+    if raw_count and safe_int(resp_code, 200) == 200:
+        # התוצאה המוערכת פגה יחד עם התשובה הגולמית שממנה נבנתה
+        _MS_EVAL_CACHE.put(eval_key, _ms_sess_copy(sess), ts=fetched_ts)
     MANUAL_SEARCH_SESS[uid] = sess
     return sess
 
@@ -4428,6 +7202,8 @@ def _ms_caption(uid: int) -> tuple[str, str | None]:
     img = str(row.get("ImageURL") or "").strip() or None
 
     status_line = "✅ עומד בסינונים" if ok else f"🚫 נפסל: {html.escape(reason)}"
+    if item.get("_ms_local"):
+        status_line += " · 📚 מהקטלוג המקומי"
     flt = _ms_active_filters_text()
 
     hint = ""
@@ -4502,7 +7278,7 @@ def _ms_show(uid: int, chat_id: int, force_new: bool = True):
 
     try:
         if img:
-            msg = bot.send_photo(chat_id, img, caption=cap, parse_mode="HTML", reply_markup=kb)
+            msg = _send_media(chat_id, "photo", img, caption=cap, parse_mode="HTML", reply_markup=kb)
         else:
             msg = bot.send_message(chat_id, cap, parse_mode="HTML", reply_markup=kb)
         MANUAL_SEARCH_MSG[uid] = (chat_id, msg.message_id)
@@ -4512,28 +7288,15 @@ def _ms_show(uid: int, chat_id: int, force_new: bool = True):
         MANUAL_SEARCH_MSG[uid] = (chat_id, msg.message_id)
 
 def _ms_add_rows_to_queue(rows: list[dict]) -> tuple[int, int, int]:
-    """Add rows to pending queue with dedupe. Returns (added, dups, total_after)."""
-    if not rows:
-        with FILE_LOCK:
-            total = len(read_products(PENDING_CSV))
-        return 0, 0, total
-
-    with FILE_LOCK:
-        pending = read_products(PENDING_CSV)
-        existing = {_key_of_row(r) for r in pending}
-        added = 0
-        dups = 0
-        for r in rows:
-            k = _key_of_row(r)
-            if k in existing:
-                dups += 1
-                continue
-            existing.add(k)
-            pending.append(r)
-            added += 1
-        write_products(PENDING_CSV, pending)
-        total = len(pending)
-    return added, dups, total
+    """Add rows to pending queue with dedupe (queue + ever-sent tier). Returns (added, dups, total_after)."""
+    fresh = []
+    for r in rows:
+        item_id = str(r.get("ItemId") or "").strip() or _extract_item_id_from_url(r.get("BuyLink") or "")
+        if dedup_long_has(item_id):
+            continue
+        fresh.append(r)
+    added, dups, total_after = queue_add_rows(fresh)
+    return added, dups + (len(rows) - len(fresh)), total_after
 
 
 def _ms_start(uid: int, chat_id: int, q: str):
@@ -4572,14 +7335,67 @@ def _ms_start(uid: int, chat_id: int, q: str):
     else:
         bot.send_message(chat_id, f"⏳ מחפש מוצרים עבור: {q}")
 
+    # Local catalog first: shown at once, then merged with the fresh API page below.
+    per_page = int(os.environ.get('AE_MANUAL_SEARCH_PAGE_SIZE','10') or 10)
+    local = []
     try:
-        _ms_fetch_page(uid, q=(q_api or q), page=1,
-                      per_page=int(os.environ.get('AE_MANUAL_SEARCH_PAGE_SIZE','10') or 10),
-                      use_selected_categories=False)
+        local = _ms_local_results([q] + ([q_api] if q_api and q_api != q else []) + list(q_variants_extra or []))
+    except Exception as e:
+        log_warn(f"[CATALOG] local search failed: {e}")
+    if local:
+        sess.update(page=1, per_page=per_page, idx=0, results=local, raw_count=len(local), ok_count=len(local),
+                    reasons={}, note=f"📚 {len(local)} תוצאות מהקטלוג המקומי — ממשיך לחפש ב-AliExpress…")
         _ms_show(uid, chat_id)
+
+    try:
+        _ms_fetch_page(uid, q=(q_api or q), page=1, per_page=per_page, use_selected_categories=False)
+        _ms_merge_local(uid, local)
+        # אם המשתמש כבר דפדף בתוצאות המקומיות — נשארים על הפריט שלו ולא קופצים חזרה לראשון
+        moved = int(sess.get("idx") or 0) if local else 0
+        new_sess = MANUAL_SEARCH_SESS.get(uid)
+        if moved and new_sess is not None and moved < len(local):
+            viewed = str(local[moved]["row"].get("ItemId") or "")
+            ids = [str((it.get("row") or {}).get("ItemId") or "") for it in new_sess.get("results") or []]
+            if viewed in ids:
+                new_sess["idx"] = ids.index(viewed)
+            bot.send_message(chat_id, f"🛰️ נטענו התוצאות מ-AliExpress ({new_sess.get('ok_count', 0)} מתאימות) — ממשיכים בדפדוף.")
+        else:
+            _ms_show(uid, chat_id)
     except Exception as e:
         _logger.exception("[MS] start failed")
-        bot.send_message(chat_id, f"❌ החיפוש נכשל: {e}")
+        bot.send_message(chat_id, f"❌ החיפוש נכשל: {e}" + (" (מוצגות תוצאות מהקטלוג המקומי)" if local else ""))
+
+def _ms_local_results(q_variants: list[str]) -> list[dict]:
+    """Catalog hits for a new search, evaluated like API results (only rows that pass the filters)."""
+    if not MS_LOCAL_RESULTS:
+        return []
+    matcher = _ms_matcher(q_variants)
+    out = []
+    for row in catalog_search(q_variants, limit=MS_LOCAL_RESULTS * 3):
+        ok, _ = _ms_eval_row_filters(row)
+        if not ok:
+            continue
+        m_strict, _, m_overlap = matcher.scan(str(row.get("OrigTitle") or row.get("Title") or ""))
+        out.append({"row": row, "ok": True, "reason": "", "_ms_score": m_overlap, "_ms_strict": m_strict, "_ms_local": True})
+    # sorted() יציב: בתוך אותו ציון נשמר סדר הרלוונטיות של FTS
+    out = sorted(out, key=lambda it: (it["_ms_strict"], it["_ms_score"]), reverse=True)
+    return out[:MS_LOCAL_RESULTS]
+
+def _ms_merge_local(uid: int, local: list[dict]):
+    """Add local catalog hits that the API page did not return: after the API's passing items, before its rejects."""
+    sess = MANUAL_SEARCH_SESS.get(uid)
+    if not sess or not local:
+        return
+    results = sess.get("results") or []
+    seen = {str((it.get("row") or {}).get("ItemId") or "") for it in results}
+    extra = [it for it in local if str(it["row"].get("ItemId") or "") not in seen]
+    if not extra:
+        return
+    ok_items = [it for it in results if it.get("ok")]
+    sess["results"] = ok_items + extra + [it for it in results if not it.get("ok")]
+    sess["ok_count"] = int(sess.get("ok_count") or 0) + len(extra)
+    note = str(sess.get("note") or "").strip()
+    sess["note"] = (note + " " if note else "") + f"📚 +{len(extra)} מהקטלוג המקומי."
 
 
 # Keywords used to shrink the category list in "top" mode (Hebrew+English)
@@ -5009,11 +7825,7 @@ def _ai_review_kb(r: dict) -> types.InlineKeyboardMarkup:
     return kb
 
 def _ai_review_show(chat_id: int, uid: int, prefer_delete: bool = True):
-    with FILE_LOCK:
-        pending_rows = read_products(PENDING_CSV)
-    # ensure AIState exists
-    for rr in pending_rows:
-        _ = normalize_row_keys(rr)
+    pending_rows = queue_rows()
 
     candidates = _ai_candidates(pending_rows)
     if not candidates:
@@ -5042,7 +7854,7 @@ def _ai_review_show(chat_id: int, uid: int, prefer_delete: bool = True):
     img = str(r.get("ImageURL","") or "").strip()
     try:
         if img:
-            m = bot.send_photo(chat_id, photo=img, caption=caption, reply_markup=kb, parse_mode="HTML")
+            m = _send_media(chat_id, "photo", img, caption=caption, reply_markup=kb, parse_mode="HTML")
         else:
             m = bot.send_message(chat_id, caption, reply_markup=kb, parse_mode="HTML")
         AI_REVIEW_CTX[uid] = (chat_id, m.message_id)
@@ -5203,6 +8015,19 @@ def _rate_panel_kb() -> "types.InlineKeyboardMarkup":
     kb.add(types.InlineKeyboardButton("↩️ חזרה", callback_data="rate_back"))
     return kb
 
+def _refill_job(job, ignore_selected_categories: bool = False, max_needed: int = 80) -> str:
+    """Job body for manual refills (menu buttons and /refill_now)."""
+    added, dup, total_after, last_page, last_error = refill_from_affiliate(
+        max_needed=max_needed, ignore_selected_categories=ignore_selected_categories,
+        on_progress=job.progress, cancel=job.cancel_event)
+    return (
+        f"נוספו לתור: {added}\n"
+        f"כפולים: {dup}\n"
+        f"סה\"כ בתור: {total_after}\n"
+        f"דף אחרון שנבדק: {last_page}\n"
+        f"שגיאה/מידע: {last_error or 'ללא'}"
+    )
+
 @bot.callback_query_handler(func=lambda c: True)
 def on_inline_click(c):
     global POST_DELAY_SECONDS, CURRENT_TARGET, AE_PRICE_BUCKETS_RAW, AE_PRICE_BUCKETS, AE_PRICE_INPUT_CURRENCY, AE_PRICE_CONVERT_USD_TO_ILS, AE_FORCE_USD_ONLY
@@ -5216,6 +8041,11 @@ def on_inline_click(c):
     msg_id = c.message.message_id
 
     log_info(f"[IN] cb={data} from uid={getattr(c.from_user,'id',None)} chat={chat_id}")
+    if data.startswith("job_cancel_"):
+        job = job_cancel(safe_int(data[len("job_cancel_"):], 0))
+        bot.answer_callback_query(c.id, "🛑 מבטל…" if job else "המשימה כבר הסתיימה.")
+        return
+
     # Handle filter menus / callbacks
     if handle_filters_callback(c, data, chat_id):
         return
@@ -5631,12 +8461,7 @@ def on_inline_click(c):
 
     if data in ("ai_rev_next", "ai_rev_prev", "ai_rev_toggle", "ai_rev_reject", "ai_rev_approve5"):
         uid = c.from_user.id
-        with FILE_LOCK:
-            pending_rows = read_products(PENDING_CSV)
-
-        # ensure AIState exists
-        for rr in pending_rows:
-            _ = normalize_row_keys(rr)
+        pending_rows = queue_rows()
 
         candidates = _ai_candidates(pending_rows)
         if not candidates:
@@ -5647,9 +8472,8 @@ def on_inline_click(c):
         pos = _ai_get_pos(uid)
         pos = max(0, min(pos, len(candidates)-1))
 
-        def write_back():
-            with FILE_LOCK:
-                write_products(PENDING_CSV, pending_rows)
+        def write_back(rows: list[dict]):
+            queue_update_rows(rows)
 
         if data == "ai_rev_next":
             pos = min(pos + 1, len(candidates)-1)
@@ -5675,7 +8499,7 @@ def on_inline_click(c):
             else:
                 r["AIState"] = "approved"
                 bot.answer_callback_query(c.id, "אושר לשליחה ל-AI.")
-            write_back()
+            write_back([r])
             _ai_review_show(chat_id=chat_id, uid=uid)
             return
 
@@ -5683,7 +8507,7 @@ def on_inline_click(c):
             idx = candidates[pos]
             r = pending_rows[idx]
             r["AIState"] = "rejected"
-            write_back()
+            write_back([r])
             bot.answer_callback_query(c.id, "סומן: לא לשליחה ל-AI.")
             # stay at same pos, but list might shrink; clamp
             _ai_set_pos(uid, min(pos, max(0, len(_ai_candidates(pending_rows))-1)))
@@ -5692,14 +8516,15 @@ def on_inline_click(c):
 
         if data == "ai_rev_approve5":
             # approve current + next 4
-            changed = 0
+            changed_rows = []
             for j in range(pos, min(pos + 5, len(candidates))):
                 idx = candidates[j]
                 r = pending_rows[idx]
                 if str(r.get("AIState","") or "").strip().lower() != "approved":
                     r["AIState"] = "approved"
-                    changed += 1
-            write_back()
+                    changed_rows.append(r)
+            changed = len(changed_rows)
+            write_back(changed_rows)
             bot.answer_callback_query(c.id, f"אושר: {changed} פריטים.")
             # move to next after the block
             new_pos = min(pos + 5, len(candidates)-1)
@@ -5709,37 +8534,47 @@ def on_inline_click(c):
 
     if data == "ai_run_approved":
         uid = c.from_user.id
-        bot.answer_callback_query(c.id)
         if not _ai_enabled():
+            bot.answer_callback_query(c.id)
             bot.send_message(chat_id, "❌ AI כבוי או OPENAI_API_KEY חסר. בדוק GPT_ENABLED ו-OPENAI_API_KEY.")
             return
-        with FILE_LOCK:
-            pending_rows = read_products(PENDING_CSV)
-        for rr in pending_rows:
-            _ = normalize_row_keys(rr)
+        pending_rows = queue_rows()
         approved = [r for r in pending_rows if str(r.get("AIState","") or "").strip().lower() == "approved"]
         if not approved:
+            bot.answer_callback_query(c.id)
             bot.send_message(chat_id, "אין פריטים מאושרים לשליחה ל-AI כרגע ✅")
             return
-        bot.send_message(chat_id, f"⏳ מריץ AI על {len(approved)} פריטים מאושרים…")
-        try:
-            upd, err = ai_enrich_rows(approved, reason="manual_approval")
-            # mark done where filled
-            done_count = 0
+
+        def _run(job):
+            job.progress(f"מריץ AI על {len(approved)} פריטים מאושרים…", force=True)
+            upd, err = ai_enrich_rows(
+                approved, reason="manual_approval", cancel=job.cancel_event,
+                progress=lambda done, total, upd_so_far: job.progress(f"באצ' {done}/{total} • עודכנו {upd_so_far}/{len(approved)}"))
+            # mark done where filled (גם אחרי ביטול — מה שכבר חזר מה-API נשמר).
+            # רק שדות ה-AI מוחלים על השורה העדכנית בתור: עריכות/רענון שקרו בזמן הריצה נשמרים, ופריט שכבר נשלח לא חוזר.
+            current = {r["_qkey"]: r for r in queue_rows()}
+            merged = []
             for r in approved:
-                if str(r.get("Opening","")).strip() and str(r.get("Title","")).strip() and str(r.get("Strengths","")).strip():
-                    r["AIState"] = "done"
-                    done_count += 1
-            with FILE_LOCK:
-                write_products(PENDING_CSV, pending_rows)
+                if not (str(r.get("Opening","")).strip() and str(r.get("Title","")).strip() and str(r.get("Strengths","")).strip()):
+                    continue
+                cur = current.get(r.get("_qkey"))
+                if cur is None:
+                    continue
+                for k in ("Opening", "Title", "Strengths"):
+                    cur[k] = r[k]
+                if r.get("OrigTitle") and not str(cur.get("OrigTitle") or "").strip():
+                    cur["OrigTitle"] = r["OrigTitle"]
+                cur["AIState"] = "done"
+                maybe_convert_prices_after_ai(cur, reason="manual_approval")
+                merged.append(cur)
+            done_count = queue_update_rows(merged) if merged else 0
+            # refresh review view if user is in it
+            _ai_review_show(chat_id=chat_id, uid=uid)
             if err:
-                bot.send_message(chat_id, f"⚠️ AI הסתיים עם אזהרה: {err}\n✅ עודכנו: {upd}\n🟢 סומנו כ'בוצע': {done_count}")
-            else:
-                bot.send_message(chat_id, f"✅ AI הסתיים.\nעודכנו: {upd}\n🟢 סומנו כ'בוצע': {done_count}")
-        except Exception as e:
-            bot.send_message(chat_id, f"❌ שגיאה בהרצת AI: {e}")
-        # refresh review view if user is in it
-        _ai_review_show(chat_id=chat_id, uid=uid)
+                return f"⚠️ AI הסתיים עם אזהרה: {err}\n✅ עודכנו: {upd}\n🟢 סומנו כ'בוצע': {done_count}"
+            return f"עודכנו: {upd}\n🟢 סומנו כ'בוצע': {done_count}"
+
+        job_submit(chat_id, "ai_run_approved", "הרצת AI על מאושרים", _run, cb_id=c.id)
         return
 
     if data == "publish_now":
@@ -5754,10 +8589,8 @@ def on_inline_click(c):
                           new_text="✅ נשלח הפריט הבא בתור.", reply_markup=inline_menu(), cb_id=c.id)
 
     elif data == "pending_status":
-        with FILE_LOCK:
-            pending = read_products(PENDING_CSV)
-        count = len(pending)
-        counts = _count_ai_states(pending)
+        count = queue_len()
+        counts = queue_state_counts()
         now_il = _now_il()
         schedule_line = "🕰️ מצב: מתוזמן (שינה פעיל)" if is_schedule_enforced() else "🟢 מצב: תמיד-פעיל"
         delay_line = f"⏳ מרווח נוכחי: {POST_DELAY_SECONDS//60} דק׳ ({POST_DELAY_SECONDS} שניות)"
@@ -5770,7 +8603,6 @@ def on_inline_click(c):
             total_seconds = (count - 1) * POST_DELAY_SECONDS
             eta = now_il + timedelta(seconds=total_seconds)
             eta_str = eta.strftime("%Y-%m-%d %H:%M:%S %Z")
-            next_eta = now_il.strftime("%Y-%m-%d %H:%M:%S %Z")
             status_line = "🎙️ שידור אפשרי עכשיו" if not is_quiet_now(now_il) else "⏸️ כרגע מחוץ לחלון השידור"
             text = (
                 f"{schedule_line}\n"
@@ -5782,7 +8614,7 @@ def on_inline_click(c):
                 f"🕵️ פריטים לפני אישור: <b>{counts.get('raw',0)}</b>\n"
                 f"✅ מאושרים ל-AI: <b>{counts.get('approved',0)}</b>\n"
                 f"🧠 עברו AI (מוכנים לשידור): <b>{counts.get('done',0)}</b>\n"
-                f"⏱️ השידור הבא (תיאוריה לפי מרווח): <b>{next_eta}</b>\n"
+                f"{html.escape(next_send_line())}\n"
                 f"🕒 שעת השידור המשוערת של האחרון: <b>{eta_str}</b>\n"
                 f"(מרווח בין פוסטים: {POST_DELAY_SECONDS} שניות)"
             )
@@ -5827,10 +8659,12 @@ def on_inline_click(c):
         safe_edit_message(bot, chat_id=chat_id, message=c.message, new_text=txt, reply_markup=_price_filter_menu_kb(), cb_id=None)
 
     elif data == "reload_merge":
-        added, already, total_after = merge_from_data_into_pending()
-        safe_edit_message(bot, chat_id=chat_id, message=c.message,
-                          new_text=f"🔄 מיזוג הושלם.\nנוספו: {added}\nכבר היו בתור: {already}\nסה\"כ בתור כעת: {total_after}",
-                          reply_markup=inline_menu(), cb_id=c.id)
+        def _run(job):
+            job.progress("ממזג מ-workfile.csv אל התור…", force=True)
+            added, already, total_after = merge_from_data_into_pending()
+            return f"נוספו: {added}\nכבר היו בתור: {already}\nסה\"כ בתור כעת: {total_after}"
+
+        job_submit(chat_id, "reload_merge", "מיזוג מהקובץ", _run, cb_id=c.id)
 
     elif data == "upload_source":
         EXPECTING_UPLOAD.add(getattr(c.from_user, "id", None))
@@ -5967,11 +8801,11 @@ def on_inline_click(c):
 
 
     elif data == "reset_from_data":
-        src = read_products(DATA_CSV)
         with FILE_LOCK:
-            write_products(PENDING_CSV, src)
+            src = read_products(DATA_CSV)
+        n = queue_replace_all(src)
         safe_edit_message(bot, chat_id=chat_id, message=c.message,
-                          new_text=f"🔁 התור אופס ומתחיל מחדש ({len(src)} פריטים) מהקובץ הראשי.",
+                          new_text=f"🔁 התור אופס ומתחיל מחדש ({n} פריטים) מהקובץ הראשי.",
                           reply_markup=inline_menu(), cb_id=c.id)
 
     elif data == "delete_source_from_pending":
@@ -5987,31 +8821,10 @@ def on_inline_click(c):
         msg_txt = "🧹 workfile.csv אופס לריק (נשמרו רק כותרות). התור לא שונה." if ok else "שגיאה במחיקת workfile.csv"
         safe_edit_message(bot, chat_id=chat_id, message=c.message,
                           new_text=msg_txt, reply_markup=inline_menu(), cb_id=c.id)
-    elif data == "refill_now":
-        max_needed = 80
-        added, dup, total_after, last_page, last_error = refill_from_affiliate(max_needed=max_needed)
-        text = (
-            "🔥 מילוי מהאפילייט הושלם.\n"
-            f"נוספו לתור: {added}\n"
-            f"כפולים: {dup}\n"
-            f"סה\"כ בתור: {total_after}\n"
-            f"דף אחרון שנבדק: {last_page}\n"
-            f"שגיאה/מידע: {last_error or 'ללא'}"
-        )
-        safe_edit_message(bot, chat_id=chat_id, message=c.message, new_text=text, reply_markup=inline_menu(), cb_id=c.id)
-
-    elif data == "refill_now_all":
-        max_needed = 80
-        added, dup, total_after, last_page, last_error = refill_from_affiliate(max_needed=max_needed, ignore_selected_categories=True)
-        text = (
-            "🔥 מילוי מהאפילייט (כל הקטגוריות) הושלם.\n"
-            f"נוספו לתור: {added}\n"
-            f"כפולים: {dup}\n"
-            f"סה\"כ בתור: {total_after}\n"
-            f"דף אחרון שנבדק: {last_page}\n"
-            f"שגיאה/מידע: {last_error or 'ללא'}"
-        )
-        safe_edit_message(bot, chat_id=chat_id, message=c.message, new_text=text, reply_markup=inline_menu(), cb_id=c.id)
+    elif data in ("refill_now", "refill_now_all"):
+        all_cats = data == "refill_now_all"
+        job_submit(chat_id, "refill", "מילוי מהאפילייט" + (" (כל הקטגוריות)" if all_cats else ""),
+                   lambda job: _refill_job(job, ignore_selected_categories=all_cats), cb_id=c.id)
 
     else:
         bot.answer_callback_query(c.id)
@@ -6266,17 +9079,20 @@ def on_document(msg):
     uid = getattr(msg.from_user, "id", None)
     if uid not in EXPECTING_UPLOAD:
         return
+    EXPECTING_UPLOAD.discard(uid)
 
-    try:
-        doc = msg.document
-        filename = (doc.file_name or "").lower()
-        if not filename.endswith(".csv"):
-            bot.reply_to(msg, "זה לא נראה כמו CSV. נסה/י שוב עם קובץ .csv")
-            return
+    doc = msg.document
+    filename = (doc.file_name or "").lower()
+    if not filename.endswith(".csv"):
+        bot.reply_to(msg, "זה לא נראה כמו CSV. נסה/י שוב עם קובץ .csv")
+        return
 
+    def _run(job):
+        job.progress("מוריד את הקובץ…", force=True)
         file_info = bot.get_file(doc.file_id)
         file_bytes = bot.download_file(file_info.file_path)
         csv_text = _decode_csv_bytes(file_bytes)
+        job.check()
 
         from io import StringIO
         raw_reader = csv.DictReader(StringIO(csv_text))
@@ -6288,38 +9104,24 @@ def on_document(msg):
         except Exception:
             convert_rate = USD_TO_ILS_RATE_DEFAULT
 
+        job.progress(f"ממפה {len(rows_raw)} שורות וממזג אל התור…", force=True)
         rows = _rows_with_optional_usd_to_ils(rows_raw, convert_rate)
+        job.check()
 
         with FILE_LOCK:
             write_products(DATA_CSV, rows)
-
-            pending_rows = read_products(PENDING_CSV)
-            existing_keys = {_key_of_row(r) for r in pending_rows}
-            added = 0
-            already = 0
-            for r in rows:
-                k = _key_of_row(r)
-                if k in existing_keys:
-                    already += 1
-                    continue
-                pending_rows.append(r)
-                existing_keys.add(k)
-                added += 1
-            write_products(PENDING_CSV, pending_rows)
-            total_after = len(pending_rows)
+        fresh, near_dups = near_dup_filter(rows)
+        added, already, total_after = queue_add_rows(fresh)
+        already += near_dups
 
         extra_line = f"\n💱 בוצעה המרה לש\"ח בשער {convert_rate} לכל מחירי הדולר בקובץ זה." if convert_rate else ""
-        bot.reply_to(msg,
-            "✅ הקובץ נקלט בהצלחה.\n"
+        return (
             f"נוספו לתור: {added}\nכבר היו בתור/כפולים: {already}\nסה\"כ בתור כעת: {total_after}"
             + extra_line +
             "\n\nהשידור ממשיך בקצב שנקבע. אפשר לבדוק '📊 סטטוס שידור' בתפריט."
         )
 
-    except Exception as e:
-        bot.reply_to(msg, f"שגיאה בעיבוד הקובץ: {e}")
-    finally:
-        EXPECTING_UPLOAD.discard(uid)
+    job_submit(msg.chat.id, "csv_upload", "קליטת קובץ CSV", _run)
 
 # ========= TEXT COMMANDS =========
 @bot.message_handler(commands=['cancel'])
@@ -6375,10 +9177,8 @@ def cmd_start(msg):
 
 @bot.message_handler(commands=['pending_status','queue'])
 def pending_status_cmd(msg):
-    with FILE_LOCK:
-        pending = read_products(PENDING_CSV)
-    count = len(pending)
-    counts = _count_ai_states(pending)
+    count = queue_len()
+    counts = queue_state_counts()
     now_il = _now_il()
     schedule_line = "🕰️ מצב: מתוזמן (שינה פעיל)" if is_schedule_enforced() else "🟢 מצב: תמיד-פעיל"
     delay_line = f"⏳ מרווח נוכחי: {POST_DELAY_SECONDS//60} דק׳ ({POST_DELAY_SECONDS} שניות)"
@@ -6390,13 +9190,19 @@ def pending_status_cmd(msg):
     eta = now_il + timedelta(seconds=total_seconds)
     eta_str = eta.strftime("%Y-%m-%d %H:%M:%S %Z")
     status_line = "🎙️ שידור אפשרי עכשיו" if not is_quiet_now(now_il) else "⏸️ כרגע מחוץ לחלון השידור"
+    try:
+        dash = queue_dashboard_text()
+    except Exception as e:
+        log_warn(f"[QUEUE] dashboard failed: {e}")
+        dash = ""
     bot.reply_to(msg,
-        f"{schedule_line}\n{status_line}\n{delay_line}\n{target_line}\n"
+        f"{schedule_line}\n{status_line}\n{delay_line}\n{target_line}\n{html.escape(next_send_line())}\n"
         f"📦 סה״כ פריטים בתור: <b>{count}</b>\n"
         f"🕵️ פריטים לפני אישור: <b>{counts.get('raw',0)}</b>\n"
         f"✅ מאושרים ל-AI: <b>{counts.get('approved',0)}</b>\n"
         f"🧠 עברו AI (מוכנים לשידור): <b>{counts.get('done',0)}</b>\n"
-        f"🕒 שעת השידור המשוערת של האחרון: <b>{eta_str}</b>",
+        f"🕒 שעת השידור המשוערת של האחרון: <b>{eta_str}</b>"
+        + (f"\n\n{dash}" if dash else ""),
         parse_mode="HTML"
     )
 
@@ -6405,6 +9211,19 @@ def queue_cmd(msg):
     # Alias for /pending_status
     return pending_status_cmd(msg)
 
+@bot.message_handler(commands=['export_queue'])
+def cmd_export_queue(msg):
+    if not _is_admin(msg):
+        bot.reply_to(msg, "אין הרשאה.")
+        return
+    try:
+        n = queue_export_csv(PENDING_CSV)
+        with open(PENDING_CSV, "rb") as f:
+            bot.send_document(msg.chat.id, f, caption=f"📤 ייצוא התור: {n} פריטים", visible_file_name="pending.csv")
+    except Exception as e:
+        log_exc(f"[QUEUE] export failed: {e}")
+        bot.reply_to(msg, f"שגיאה בייצוא התור: {e}")
+
 
 
 @bot.message_handler(commands=['version'])
@@ -6414,9 +9233,17 @@ def cmd_version(msg):
         return
     commit = os.environ.get("RAILWAY_GIT_COMMIT_SHA") or os.environ.get("RAILWAY_COMMIT_SHA") or os.environ.get("GIT_COMMIT") or "n/a"
     fp = _code_fingerprint()
+    catalog = "off"
+    if AE_CATALOG_ENABLED:
+        try:
+            cs = catalog_stats()
+            catalog = f"{cs['rows']} rows ({'fts5' if cs['fts'] else 'LIKE'}, buffered {cs['buffered']})"
+        except Exception as e:
+            catalog = f"n/a ({e})"
     bot.reply_to(
         msg,
-        f"<b>Version</b>: {CODE_VERSION}\n<b>Fingerprint</b>: {fp}\n<b>Commit</b>: {commit}\n<b>Instance</b>: {socket.gethostname()}\n<b>Target</b>: {CURRENT_TARGET}\n<b>PriceFilter</b>: {AE_PRICE_BUCKETS_RAW or 'none'}",
+        f"<b>Version</b>: {CODE_VERSION}\n<b>Fingerprint</b>: {fp}\n<b>Commit</b>: {commit}\n<b>Instance</b>: {socket.gethostname()}\n<b>Target</b>: {CURRENT_TARGET}\n<b>PriceFilter</b>: {AE_PRICE_BUCKETS_RAW or 'none'}\n<b>TOP</b>: {html.escape(AE_TOP_URL)} ({html.escape(_top_gateway_summary())})\n<b>Webhook</b>: {html.escape(_webhook_summary()) if USE_WEBHOOK else 'polling'}"
+        f"\n<b>Catalog</b>: {html.escape(catalog)}\n<b>Dedup (ever-sent)</b>: {html.escape(dedup_long_stats())}",
         parse_mode="HTML",
     )
 
@@ -6447,64 +9274,178 @@ def cmd_refill_now(msg):
     if not _is_admin(msg):
         bot.reply_to(msg, "אין הרשאה.")
         return
-    max_needed = 80
-    added, dup, total_after, last_page, last_error = refill_from_affiliate(max_needed=max_needed)
-    bot.reply_to(msg,
-        "🔥 מילוי מהאפילייט הושלם.\n"
-        f"נוספו לתור: {added}\n"
-        f"כפולים: {dup}\n"
-        f"סה\"כ בתור: {total_after}\n"
-        f"דף אחרון שנבדק: {last_page}\n"
-        f"שגיאה/מידע: {last_error or 'ללא'}"
-    )
+    job_submit(msg.chat.id, "refill", "מילוי מהאפילייט", _refill_job)
+
+@bot.message_handler(commands=['refresh_queue'])
+def cmd_refresh_queue(msg):
+    """/refresh_queue — re-check stale queued items; /refresh_queue all — every item."""
+    if not _is_admin(msg):
+        bot.reply_to(msg, "אין הרשאה.")
+        return
+    force = "all" in (msg.text or "").lower().split()[1:]
+
+    def _run(job):
+        st = refresh_queue_details(force=force, on_progress=job.progress, cancel=job.cancel_event)
+        return (
+            f"נבדקו: {st['checked']}\n"
+            f"עודכנו: {st['updated']}\n"
+            f"הוסרו (לא זמינים): {st['gone']}\n"
+            f"הוסרו (שינוי מחיר > {AE_REFRESH_MAX_PRICE_CHANGE_PCT:g}%): {st['price']}\n"
+            f"נכשלו: {st['failed']}"
+        )
+    job_submit(msg.chat.id, "refresh_queue", "רענון פרטי מוצרים בתור", _run)
+
+@bot.message_handler(commands=['targets'])
+def cmd_targets(msg):
+    """/targets — status; /targets set <json> — replace the targets list; /targets reset — back to BROADCAST_TARGETS."""
+    if not _is_admin(msg):
+        bot.reply_to(msg, "אין הרשאה.")
+        return
+    parts = (msg.text or "").split(None, 2)
+    sub = parts[1].lower() if len(parts) > 1 else ""
+    if sub == "set" and len(parts) < 3:
+        bot.reply_to(msg, html.escape('שימוש: /targets set [{"id":"main"}, {"id":"deals","chat":"@deals","delay":900}]'))
+        return
+    if sub in ("set", "reset"):
+        try:
+            targets_set(parts[2] if sub == "set" else "")
+        except ValueError as e:
+            bot.reply_to(msg, f"❌ הגדרת יעדים לא תקינה: {html.escape(str(e))}")
+            return
+    bot.reply_to(msg, html.escape(targets_status_text()))
+
+@bot.message_handler(commands=['jobs'])
+def cmd_jobs(msg):
+    if not _is_admin(msg):
+        bot.reply_to(msg, "אין הרשאה.")
+        return
+    bot.reply_to(msg, html.escape(jobs_status_text()))
 
 # ========= SENDER LOOP =========
+# ---- scheduler ----
+# במקום לדגום כל 15–60 שניות: מחשבים מתי השליחה הבאה מותרת (last_post_ts + מרווח, חלונות AUTO_SCHEDULE,
+# חלון השידור כשהתזמון אכוף) וישנים בדיוק עד אז. DELAY_EVENT מעיר מוקדם לחישוב מחדש.
+SCHED_IDLE_RECHECK_SECONDS = 600   # רשת ביטחון כשאין מה לשלוח (אירוע פוספס / שינוי שעון)
+SCHED_MAX_SLEEP_SECONDS = 3600
+SCHED_RETRY_SECONDS = 60           # אחרי שליחה שנכשלה
+
+def _send_allowed_at(when: datetime, auto_mode: bool) -> bool:
+    if is_schedule_enforced() and not should_broadcast(when):
+        return False
+    return (not auto_mode) or _auto_delay_at(when) is not None
+
+def _target_next_time(t: _Target, now: datetime, auto_mode: bool) -> tuple[datetime | None, str]:
+    """Earliest time this target may post (its interval, quiet window and the global windows)."""
+    auto = auto_mode and not t.delay  # יעד עם מרווח קבוע לא תלוי במשבצות AUTO_SCHEDULE
+    if t.delay:
+        delay = t.delay
+    elif auto:
+        delay = _auto_delay_at(now) or min(d for _, _, d in AUTO_SCHEDULE)
+    else:
+        delay = POST_DELAY_SECONDS
+    last = _get_state_float(t.state_key, 0.0)
+    base = max(now, datetime.fromtimestamp(last, tz=IL_TZ) + timedelta(seconds=delay)) if last else now
+    retry = _TARGET_RETRY_AT.get(t.tid)
+    if retry:
+        base = max(base, datetime.fromtimestamp(retry, tz=IL_TZ))
+
+    def allowed(when):
+        return _send_allowed_at(when, auto) and not t.is_quiet(when)
+
+    if allowed(base):
+        return base, "מרווח"
+    # מחוץ לחלון: הגבול הראשון (תחילת משבצת / חלון שידור / סוף השקט) שבו מותר לשלוח
+    starts = {start for start, _, _ in AUTO_SCHEDULE} | {start for start, _ in BROADCAST_WINDOWS.values()}
+    if t.quiet:
+        starts.add(t.quiet[1])
+    for day in range(8):
+        d = (base + timedelta(days=day)).date()
+        for st in sorted(starts):
+            cand = datetime.combine(d, st, tzinfo=IL_TZ)
+            if cand > base and allowed(cand):
+                return cand, "חלון שידור"
+    return None, "אין חלון שידור"
+
+def next_send_plan(now: datetime | None = None) -> tuple[datetime | None, str, _Target | None]:
+    """(fire time, reason, target) of the next send across all targets; fire is None when waiting for an event."""
+    now = (now or _now_il()).astimezone(IL_TZ)
+    if not is_broadcast_enabled():
+        return None, "שידור כבוי", None
+    auto_mode = read_auto_flag() == "on"
+    best = None
+    why = "אין פריטים מוכנים"
+    for t in targets_all():
+        if target_pick(t) is None:
+            continue
+        fire, why_t = _target_next_time(t, now, auto_mode)
+        if fire is None:
+            why = why_t
+        elif best is None or fire < best[0]:
+            best = (fire, why_t, t)
+    if best is None:
+        return None, why, None
+    fire, why, t = best
+    # פיזור בין יעדים: לא שתי שליחות צמודות גם כשכמה יעדים מגיעים לזמנם יחד
+    if _LAST_ANY_SEND and BROADCAST_MIN_GAP_SECONDS:
+        fire = max(fire, datetime.fromtimestamp(_LAST_ANY_SEND + BROADCAST_MIN_GAP_SECONDS, tz=IL_TZ))
+    return fire, why, t
+
+def next_send_time(now: datetime | None = None) -> tuple[datetime | None, str]:
+    """Earliest time the sender may post, or (None, reason) when it has to wait for an event."""
+    fire, why, _ = next_send_plan(now)
+    return fire, why
+
+def next_send_line() -> str:
+    try:
+        fire, why, t = next_send_plan()
+    except Exception:
+        return ""
+    if fire is None:
+        return f"⏭️ שליחה הבאה: ממתין ({why})"
+    when = "עכשיו" if fire <= _now_il() else fire.strftime("%a %H:%M:%S")
+    where = f" → {t.tid}" if len(targets_all()) > 1 else ""
+    return f"⏭️ שליחה הבאה: {when}{where} ({why})"
+
+def targets_status_text() -> str:
+    now = _now_il()
+    auto_mode = read_auto_flag() == "on"
+    targets = targets_all()
+    lines = [f"🎯 יעדי שידור: {len(targets)}"]
+    for t in targets:
+        last = _get_state_float(t.state_key, 0.0)
+        last_s = datetime.fromtimestamp(last, tz=IL_TZ).strftime("%d/%m %H:%M") if last else "—"
+        if target_pick(t) is None:
+            nxt = "אין פריטים מתאימים"
+        else:
+            fire, why = _target_next_time(t, now, auto_mode)
+            nxt = f"{fire:%a %H:%M} ({why})" if fire else why
+        lines.append(f"• {t.describe()}")
+        lines.append(f"   נשלחו: {target_sent_count(t.tid)} | אחרון: {last_s} | הבא: {nxt}")
+    ready = queue_peek_ready(queue_len())
+    partial = sum(1 for r in ready if any(target_has_sent(t.tid, r["_qkey"]) for t in targets))
+    orphan = sum(1 for r in ready if not any(t.accepts(r) for t in targets))
+    lines.append(f"חלקית (נשלחו לחלק מהיעדים): {partial} | ללא יעד מתאים (נשלחים ליעד הראשי): {orphan}")
+    return "\n".join(lines)
+
 def auto_post_loop():
     # Do not force schedule enforcement by default; admin can toggle from the menu.
+    tg_set_background(True)
     init_pending()
 
     while True:
-        # Hard stop: if broadcast is OFF, do not publish
-        if not is_broadcast_enabled():
-            DELAY_EVENT.wait(timeout=60)
-            DELAY_EVENT.clear()
-            continue
-
-        if read_auto_flag() == "on":
-            delay = get_auto_delay()
-            if delay is None or is_quiet_now():
-                DELAY_EVENT.wait(timeout=60)
-                DELAY_EVENT.clear()
-                continue
-
-            with FILE_LOCK:
-                pending = read_products(PENDING_CSV)
-            if not pending:
-                DELAY_EVENT.wait(timeout=15)
+        fire, why, target = next_send_plan()
+        if fire is None:
+            wait = SCHED_IDLE_RECHECK_SECONDS
+        else:
+            wait = (fire - _now_il()).total_seconds()
+        if wait > 0:
+            if DELAY_EVENT.wait(timeout=min(wait, SCHED_MAX_SLEEP_SECONDS)):
                 DELAY_EVENT.clear()
-                continue
-
-            sent = send_next_locked("auto")
-            # If nothing was sent (e.g., no AI-ready items), poll again sooner.
-            DELAY_EVENT.wait(timeout=(delay if sent else 60))
-            DELAY_EVENT.clear()
-            continue
-
-        if is_quiet_now():
-            DELAY_EVENT.wait(timeout=30)
-            DELAY_EVENT.clear()
-            continue
-
-        with FILE_LOCK:
-            pending = read_products(PENDING_CSV)
-        if not pending:
-            DELAY_EVENT.wait(timeout=30)
-            DELAY_EVENT.clear()
-            continue
+            continue  # תמיד מחשבים מחדש אחרי שינה (אירוע, או שהגיע הזמן)
 
-        sent = send_next_locked("loop")
-        DELAY_EVENT.wait(timeout=(POST_DELAY_SECONDS if sent else 60))
-        DELAY_EVENT.clear()
+        # שליחה שנכשלה לא מקדמת את התור: היעד נדחה ב-SCHED_RETRY_SECONDS (_TARGET_RETRY_AT)
+        # והתזמון הבא כבר מתחשב בזה, בלי לעכב את שאר היעדים.
+        send_next_locked("auto" if read_auto_flag() == "on" else "loop", target=target)
 
 # ========= REFILL DAEMON =========
 def refill_daemon():
@@ -6520,8 +9461,7 @@ def refill_daemon():
             continue
 
         try:
-            with FILE_LOCK:
-                qlen = len(read_products(PENDING_CSV))
+            qlen = queue_len()
 
             if qlen < AE_REFILL_MIN_QUEUE:
                 need = max(AE_REFILL_MIN_QUEUE - qlen, 30)
@@ -6633,6 +9573,10 @@ t1.start()
 t2 = threading.Thread(target=refill_daemon, daemon=True)
 t2.start()
 
+if POST_PREFETCH_AHEAD > 0:
+    threading.Thread(target=prefetch_loop, daemon=True, name="post-prefetch").start()
+    prefetch_wake()
+
 
 def _wait_for_telegram_ready(max_sleep: int = 60):
     """Block until Telegram API responds to getMe, to avoid noisy crashes on boot/network hiccups."""